@@ -1,19 +1,59 @@
-import pickle
+import os
+import sys
+import json
 import random
+import asyncio
+import itertools
 import logging
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import *
 
 import hydra
+from hydra.core.hydra_config import HydraConfig
+from hydra.utils import get_original_cwd
 from config.path import ABS_CONFIG_DIR
 from omegaconf import DictConfig, OmegaConf
-import redis
-from flask import Flask, request
+from aiohttp import web
+from flask import Flask, Response, request
 from flask_cors import CORS
 from waitress import serve
 from source.text2sql.text_to_sql import Text2SQL
+from source.text2sql.multitask import HeadPredictions
+from source.text2sql.quantization import set_torch_threads
 from source.text2intent.intent_inferer import IntentInferer
 from source.conversation.text2confidence.text_to_confidence import Text2Confidence
 from source.conversation.table2text.table_to_text import Table2Text
+from source.utils import get_spacy_model
+from source.serving.batching import InferenceWorker
+from source.serving.session_store import DEFAULT_SESSION_ID, build_session_store
+from source.serving.pipeline import StageGraph
+from source.serving.semantic_cache import build_semantic_cache, linked_entities
+from source.serving.stubs import StubIntentInferer, StubText2Confidence, StubText2SQL
+from source.serving.startup import ComponentLoader
+from source.serving.router import WorkerPool, run_router
+from source.serving import jobs
+from source.serving.jobs import JobQueue
+from source.serving.llm_gateway import build_llm_gateway
+from source.serving.admission import (
+    DEGRADE_ANALYSIS,
+    DEGRADE_INTENT,
+    Admission,
+    build_admission_controller,
+)
+from source.serving import metrics
+from source.serving.metrics import record_cache_lookup, stage_timer, timed
+from source.serving.cache import (
+    TEXT2SQL,
+    ANALYSIS,
+    USER_INTENT,
+    TABLE2TEXT,
+    build_result_cache,
+    build_async_result_cache,
+    fingerprint,
+    normalize_text,
+)
 
 
 random.seed(0)
@@ -29,21 +69,43 @@ cors = CORS(app)
 logger = logging.getLogger("FlaskServer")
 
 # These will be initialized in main()
-rd_text2sql = None
-rd_analysis = None
-rd_user_intent = None
-rd_table2text = None
+result_cache = None
+semantic_cache = None
+model_version = None
 text_to_sql_model = None
+text_to_sql_worker = None
 text_to_intent_model = None
 text_to_confidence_model = None
 table_to_text_model = None
 result_analysis_model = None
+llm_gateway = None
 analyser = None
-text_history = ""
+session_store = None
+stage_executor = None
+loader = None
+admission_controller = None
+analysis_jobs = None
+
+# Longest wait allowed to /analysis/<job_id> long polls, in seconds
+MAX_ANALYSIS_WAIT_S = 30
+
+# Endpoints answered while the models are still loading
+ALWAYS_AVAILABLE = {"/", "/health", "/ready", "/metrics"}
 
 
 def generate_redis_key(text: str, db_id: str) -> str:
-    return text + db_id
+    """Return the fixed-size cache key of a question on a database.
+
+    Case and whitespace of the question are normalised. The key also covers the
+    model configuration and the schema of db_id, so results cached before
+    either of them changed are not served.
+    """
+    return fingerprint(
+        model_version,
+        text_to_sql_model.schema_version(db_id),
+        normalize_text(text),
+        db_id,
+    )
 
 
 @app.route("/")
@@ -52,133 +114,805 @@ def Testing():
     return "<p>Hello, World!</p>"
 
 
+@app.before_request
+def reject_until_ready() -> Optional[Tuple[Dict, int, Dict]]:
+    if request.method == "OPTIONS" or request.path in ALWAYS_AVAILABLE:
+        return None
+    if not loader.ready:
+        return {"error": "Server is starting up"}, 503, {"Retry-After": "5"}
+    return None
+
+
+@app.route("/health")
+def health() -> Dict:
+    """Liveness: the process is up, whether or not the models are loaded."""
+    return {"status": "ok"}
+
+
+@app.route("/ready")
+def ready() -> Tuple[Dict, int]:
+    """Readiness: all models are loaded and warmed up (503 until then)."""
+    return loader.status(), 200 if loader.ready else 503
+
+
 @app.route("/reset_history")
 def reset_history() -> Dict:
-    global text_history
-    text_history = ""
-    logger.info("History Reset!")
+    session_id: str = request.args.get("session_id", DEFAULT_SESSION_ID)
+    session_store.reset(session_id)
+    logger.info(f"History Reset! (session: {session_id})")
     return {"response": True}
 
 
+@app.route("/metrics")
+def metrics_endpoint() -> Response:
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/table_to_text", methods=["POST"])
 def table_to_text() -> Dict:
     logger.info(f"Received table2text request from {request.remote_addr}")
     table: List[Dict] = request.json["rows"]
     print("table", table)
-    redis_key = str(table)
-    if rd_table2text.exists(redis_key):
+    redis_key = fingerprint(model_version, table)
+    summary = result_cache.get(TABLE2TEXT, redis_key)
+    record_cache_lookup(TABLE2TEXT, summary is not None)
+    if summary is not None:
         logger.info(f"Returning cached result")
-        summary = pickle.loads(rd_table2text.get(redis_key))
     else:
         if len(table) == 0 or not isinstance(table, list):
             summary = "There is no data in the table."
         else:
-            summary: str = table_to_text_model.generate(table)
+            with stage_timer("table_to_text"):
+                summary: str = table_to_text_model.generate(table)
         # Save into redis cache
-        rd_table2text.set(redis_key, pickle.dumps(summary))
+        result_cache.set(TABLE2TEXT, redis_key, summary)
     logger.info(f"Response: {summary[:20]}...")
     return {"summary": summary}
 
 
 @app.route("/text_to_sql", methods=["POST"])
 def text_to_sql() -> Dict:
-    global text_history
     logger.info(f"Received text2sql request from {request.remote_addr}")
+    admission = admission_controller.try_admit()
+    if admission is None:
+        return overloaded_response()
     response = {}
+    with admission, metrics.REQUEST_SECONDS.time(endpoint="text_to_sql"):
+        events = text_to_sql_events(request.json, admission, stream_analysis=False)
+        for _, fields in events:
+            response.update(fields)
+    logger.info(f"Response complete: {response['pred_sql']}")
+    return response
+
+
+@app.route("/text_to_sql_stream", methods=["POST"])
+def text_to_sql_stream() -> Response:
+    """Server-sent events variant of /text_to_sql.
+
+    Emits an "sql" event with pred_sql and confidence as soon as they are known,
+    then "analysis_job", "analysis" and "intent" events as those stages finish,
+    and finally a "done" (or "error") event.
+    """
+    logger.info(f"Received streaming text2sql request from {request.remote_addr}")
     params: Dict = request.json
+    admission = admission_controller.try_admit()
+    if admission is None:
+        return overloaded_response()
+
+    def stream() -> Iterator[str]:
+        with metrics.REQUEST_SECONDS.time(endpoint="text_to_sql_stream"):
+            try:
+                events = text_to_sql_events(params, admission, stream_analysis=True)
+                for event, fields in events:
+                    yield sse_event(event, fields)
+            except Exception as e:
+                logger.exception("Streaming text2sql request failed")
+                yield sse_event("error", {"error": str(e)})
+                return
+            yield sse_event("done", {})
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Also frees the slot if the client leaves before the stream starts
+    response.call_on_close(admission.release)
+    return response
+
+
+@app.route("/analysis/<job_id>")
+def analysis_result(job_id: str) -> Tuple[Dict, int]:
+    """State of a background analysis job, and its result once done.
+
+    With ?wait=<seconds> the request is held until the job finishes or the
+    wait (at most MAX_ANALYSIS_WAIT_S) is over.
+    """
+    wait = min(float(request.args.get("wait", 0)), MAX_ANALYSIS_WAIT_S)
+    return analysis_job_response(*analysis_jobs.wait(job_id, timeout=wait))
+
+
+def analysis_job_response(state: str, value: Any) -> Tuple[Dict, int]:
+    if state == jobs.DONE:
+        return {"status": state, "analyse_result": value}, 200
+    elif state == jobs.FAILED:
+        return {"status": state, "error": value}, 500
+    elif state == jobs.UNKNOWN:
+        return {"status": state}, 404
+    return {"status": state}, 202
+
+
+def overloaded_response() -> Tuple[Dict, int, Dict]:
+    retry_after = str(config.serving.admission.retry_after_s)
+    return {"error": "Server is overloaded"}, 503, {"Retry-After": retry_after}
+
+
+def sse_event(event: str, fields: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(fields)}\n\n"
+
+
+def text_to_sql_events(
+    params: Dict, admission: Admission, stream_analysis: bool
+) -> Iterator[Tuple[str, Dict]]:
+    """Serve a text2sql request, yielding parts of the response as they are ready.
+
+    The attribution analysis of a low-confidence translation runs as a
+    background job whose id is the cache key of the request; its result is
+    fetched from /analysis/<job_id> or, if stream_analysis, awaited here.
+
+    Args:
+        params: Request body with text, db_id, analyse, reset_history and an
+            optional session_id
+        admission: Admission of the request, telling which optional stages to
+            skip under load. Degraded responses list them in "degraded".
+        stream_analysis: Whether to wait for the analysis job and yield its
+            result
+
+    Yields:
+        (event, fields) pairs: "sql" with pred_sql and confidence first, then
+        "analysis_job" with the job id of a started analysis, and "analysis"
+        with analyse_result (if cached or streamed) and "intent" with
+        user_intent in the order they finish. Tuning requests only yield "sql".
+    """
     text: str = params["text"]
     print(text)
     db_id: str = params["db_id"]
     analyse: bool = params["analyse"]
     reset_history: bool = params["reset_history"]
+    session_id: str = params.get("session_id", DEFAULT_SESSION_ID)
+    if reset_history:
+        session_store.reset(session_id)
+    text_history = session_store.get_history(session_id)
     logger.info(
-        f"DB_id: {db_id}, analyse: {analyse}, text: {text} reset_history: {reset_history} text_history: {text_history}"
+        f"DB_id: {db_id}, analyse: {analyse}, text: {text} reset_history: {reset_history} session: {session_id} text_history: {text_history}"
     )
-    if reset_history:
-        text_history = ""
 
-    tune_intent = text_to_intent_model.infer(text, db_id, is_tune_check=True)[0]
+    input_text = "<s> " + text + text_history
+    redis_key = generate_redis_key(text=input_text, db_id=db_id)
+    new_text_history = text_history
+    if not new_text_history.endswith(text):
+        new_text_history += " <s> " + text
 
-    if tune_intent:
-        print("tune_intent: ", tune_intent)
-        response = {
-            "pred_sql": "conduct tuning",
-            "confidence": 100,
-            "user_intent": "database_tuning",
-        }
+    # Start the LLM tune check and, speculatively, the model stages concurrently.
+    # Whatever is still running when the request ends is cancelled.
+    stages = StageGraph(stage_executor)
+    try:
+        stages.submit(
+            "tune_check", text_to_intent_model.infer, text, db_id, is_tune_check=True
+        )
+        with stage_timer("cache_lookup"):
+            cached = result_cache.get_many(redis_key, (TEXT2SQL, ANALYSIS, USER_INTENT))
+        record_cache_lookup(TEXT2SQL, TEXT2SQL in cached)
+        record_cache_lookup(USER_INTENT, USER_INTENT in cached)
+        cache_used = TEXT2SQL in cached
+        if not cache_used:
+            stages.submit(
+                "translate",
+                generate_sql,
+                text,
+                new_text_history,
+                db_id,
+                admission.beam_size,
+            )
+        if intent_stage_needed(cached, admission):
+            stages.submit("intent", text_to_intent_model.infer, input_text, db_id)
+
+        tune_intent = stages.result("tune_check")[0]
+        if tune_intent:
+            print("tune_intent: ", tune_intent)
+            yield "sql", {
+                "pred_sql": "conduct tuning",
+                "confidence": 100,
+                "user_intent": "database_tuning",
+            }
+            return
+
+        if new_text_history != text_history:
+            session_store.set_history(session_id, new_text_history)
+
+        # Results to write back to the cache in one round trip
+        new_entries = {}
+
+        # check and return cached result
+        if cache_used:
+            logger.info(f"Returning cached result")
+            response = cached[TEXT2SQL]
+        else:
+            # translate text to sql
+            response = stages.result("translate")
+            # Translations with narrowed beams are not worth keeping
+            if admission.beam_size is None:
+                new_entries[TEXT2SQL] = dict(response)
+        yield "sql", degraded_fields(response, admission)
+
+        # analyse the result
+        if analyse and float(response["confidence"]) < 80:
+            record_cache_lookup(ANALYSIS, ANALYSIS in cached)
+            if ANALYSIS in cached:
+                yield "analysis", {"analyse_result": cached[ANALYSIS]}
+            elif not admission.skips(DEGRADE_ANALYSIS):
+                job = analysis_jobs.submit(
+                    redis_key, analyze, text, new_text_history, db_id
+                )
+                if job is not None:
+                    yield "analysis_job", {"analysis_job": redis_key}
+                    if stream_analysis:
+                        stages.add("analysis", job)
+
+        # guess the user's intent
+        if not stages.started("intent"):
+            yield "intent", {"user_intent": cached_intent(cached, response)}
+
+        for name in stages.as_completed(["analysis", "intent"]):
+            if name == "analysis":
+                # The job has stored the result in the cache already
+                yield "analysis", {"analyse_result": stages.result("analysis")}
+            else:
+                user_intent = stages.result("intent")
+                new_entries[USER_INTENT] = user_intent
+                yield "intent", {"user_intent": user_intent[0]}
+
+        # Save the results to redis
+        result_cache.set_many(redis_key, new_entries)
+    finally:
+        stages.cancel()
+
+
+def degraded_fields(response: Dict, admission: Admission) -> Dict:
+    """Response fields with the stages skipped under load, if any."""
+    if not admission.degraded:
         return response
+    return {**response, "degraded": admission.degraded}
 
-    input_text = "<s> " + text + text_history
 
-    # check and return cached result
-    redis_key = generate_redis_key(text=input_text, db_id=db_id)
-    cache_used = False
-    if rd_text2sql.exists(redis_key):
-        logger.info(f"Returning cached result")
-        response = pickle.loads(rd_text2sql.get(redis_key))
-        cache_used = True
-        if not text_history.endswith(text):
-            text_history += " <s> " + text
-    else:
-        orig_item, preproc_item = text_to_sql_model.preprocess(
-            text,
-            text_history,
-            db_id,
-        )
+def intent_stage_needed(cached: Dict[str, Any], admission: Admission) -> bool:
+    # With multi-task heads the intent comes with the translation
+    return (
+        text_to_sql_model.heads is None
+        and USER_INTENT not in cached
+        and not admission.skips(DEGRADE_INTENT)
+    )
+
+
+def cached_intent(cached: Dict[str, Any], response: Dict) -> str:
+    if "user_intent" in response:
+        return response["user_intent"]
+    # Without a cached intent the intent stage was skipped under load; plain
+    # text-to-SQL questions are by far the most common intent
+    return cached[USER_INTENT][0] if USER_INTENT in cached else "query"
+
 
-        if not text_history.endswith(text):
-            text_history += " <s> " + text
+def generate_sql(
+    text: str, text_history: str, db_id: str, beam_size: Optional[int] = None
+) -> Dict:
+    """Translate text to SQL and score it, unless a paraphrase is already cached.
 
-        # translate text to sql
+    Preprocessing and value filling run on the calling thread; only the model
+    work is handed to the batching worker. beam_size overrides the configured
+    beam size; such translations are not added to the semantic cache.
+    """
+    item = text_to_sql_model.preprocess(text, text_history, db_id)
+    embedding = entities = None
+    if semantic_cache is not None:
+        with stage_timer("embedding"):
+            embedding = text_to_sql_model.embed(["<s> " + text + text_history])[0]
+        entities = linked_entities(item[1])
+        response = semantic_cache.lookup(db_id, embedding, entities)
+        if response is not None:
+            return dict(response)
 
-        beams, inferred_code = text_to_sql_model.translate(text, text_history, db_id)
+    beams, inferred_code, heads = text_to_sql_worker.run(
+        text, text_history, db_id, item, beam_size
+    )
+    inferred_code = text_to_sql_model.fill_values(
+        text, text_history, db_id, inferred_code
+    )
+    response = sql_response(beams, inferred_code, heads)
+
+    if semantic_cache is not None and beam_size is None:
+        semantic_cache.add(db_id, embedding, dict(response), entities)
+    return response
+
+
+def sql_response(
+    beams: List[Any], inferred_code: str, heads: Optional[HeadPredictions]
+) -> Dict:
+    """Response of a translation, with the confidence (and intent) of the heads if any."""
+    if heads is not None:
+        return {
+            "confidence": f"{heads.confidence * 100:.2f}",
+            "pred_sql": inferred_code,
+            "user_intent": heads.intent,
+        }
+    with stage_timer("confidence"):
         confidence = text_to_confidence_model.calculate(beams, inferred_code)
+    return {"confidence": f"{confidence:.2f}", "pred_sql": inferred_code}
+
+
+def analyze(text: str, text_history: str, db_id: str) -> Dict:
+    """Find the most ambiguous word of a low-confidence translation."""
+    # Reuses the item preprocessed for the translation of this input
+    orig_item, preproc_item = text_to_sql_model.preprocess(text, text_history, db_id)
+    return text_to_confidence_model.analyze(orig_item.text, orig_item, preproc_item)
+
+
+# Asynchronous serving mode (serving.mode: async). Redis, LLM and DB value
+# lookups are awaited on the event loop; model work runs on the batching worker
+# and a small executor sized to the device, so waiting on I/O pins no thread.
+model_executor = None
+async_result_cache = None
+
+
+async def run_on_model_executor(stage: str, fn: Callable, *args) -> Any:
+    """Run fn(*args) on the model executor, timing it as stage."""
+    return await asyncio.get_running_loop().run_in_executor(
+        model_executor, timed, stage, fn, *args
+    )
+
+
+async def timed_async(stage: str, coroutine: Awaitable) -> Any:
+    with stage_timer(stage):
+        return await coroutine
+
+
+async def index_async(request: web.Request) -> web.Response:
+    return web.Response(text="<p>Hello, World!</p>", content_type="text/html")
+
+
+@web.middleware
+async def reject_until_ready_async(request: web.Request, handler) -> web.StreamResponse:
+    if request.method == "OPTIONS" or request.path in ALWAYS_AVAILABLE:
+        return await handler(request)
+    if not loader.ready:
+        return web.json_response(
+            {"error": "Server is starting up"},
+            status=503,
+            headers={"Retry-After": "5"},
+        )
+    return await handler(request)
+
+
+async def health_async(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+async def ready_async(request: web.Request) -> web.Response:
+    return web.json_response(loader.status(), status=200 if loader.ready else 503)
 
-        response["confidence"] = f"{confidence:.2f}"
-        response["pred_sql"] = inferred_code
 
-        # Save the result to redis
-        rd_text2sql.set(redis_key, pickle.dumps(response))
+async def reset_history_async(request: web.Request) -> web.Response:
+    session_id: str = request.query.get("session_id", DEFAULT_SESSION_ID)
+    await asyncio.to_thread(session_store.reset, session_id)
+    logger.info(f"History Reset! (session: {session_id})")
+    return web.json_response({"response": True})
 
-    # analyse the result
-    if analyse and float(response["confidence"]) < 80:
-        if rd_analysis.exists(redis_key):
-            analyze_result = pickle.loads(rd_analysis.get(redis_key))
+
+async def metrics_async(request: web.Request) -> web.Response:
+    return web.Response(
+        text=metrics.registry.render(), content_type="text/plain; version=0.0.4"
+    )
+
+
+async def table_to_text_async(request: web.Request) -> web.Response:
+    logger.info(f"Received table2text request from {request.remote}")
+    table: List[Dict] = (await request.json())["rows"]
+    redis_key = fingerprint(model_version, table)
+    summary = await async_result_cache.get(TABLE2TEXT, redis_key)
+    record_cache_lookup(TABLE2TEXT, summary is not None)
+    if summary is not None:
+        logger.info(f"Returning cached result")
+    else:
+        if len(table) == 0 or not isinstance(table, list):
+            summary = "There is no data in the table."
         else:
-            if cache_used:
-                orig_item, preproc_item = text_to_sql_model.preprocess(
-                    text,
-                    text_history,
-                    db_id,
+            with stage_timer("table_to_text"):
+                summary = await table_to_text_model.generate_async(table)
+        # Save into redis cache
+        await async_result_cache.set(TABLE2TEXT, redis_key, summary)
+    logger.info(f"Response: {summary[:20]}...")
+    return web.json_response({"summary": summary})
+
+
+async def text_to_sql_async(request: web.Request) -> web.Response:
+    logger.info(f"Received text2sql request from {request.remote}")
+    response = {}
+    params: Dict = await request.json()
+    admission = admission_controller.try_admit()
+    if admission is None:
+        return overloaded_response_async()
+    with admission, metrics.REQUEST_SECONDS.time(endpoint="text_to_sql"):
+        async with contextlib.aclosing(
+            text_to_sql_events_async(params, admission, stream_analysis=False)
+        ) as events:
+            async for _, fields in events:
+                response.update(fields)
+    logger.info(f"Response complete: {response['pred_sql']}")
+    return web.json_response(response)
+
+
+async def text_to_sql_stream_async(request: web.Request) -> web.StreamResponse:
+    logger.info(f"Received streaming text2sql request from {request.remote}")
+    params: Dict = await request.json()
+    admission = admission_controller.try_admit()
+    if admission is None:
+        return overloaded_response_async()
+    with admission:
+        return await stream_text_to_sql_events(request, params, admission)
+
+
+async def stream_text_to_sql_events(
+    request: web.Request, params: Dict, admission: Admission
+) -> web.StreamResponse:
+    stream = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await stream.prepare(request)
+    with metrics.REQUEST_SECONDS.time(endpoint="text_to_sql_stream"):
+        async with contextlib.aclosing(
+            text_to_sql_events_async(params, admission, stream_analysis=True)
+        ) as events:
+            try:
+                async for event, fields in events:
+                    await stream.write(sse_event(event, fields).encode("utf-8"))
+            except ConnectionResetError:
+                logger.info("Client closed the event stream")
+                return stream
+            except Exception as e:
+                logger.exception("Streaming text2sql request failed")
+                await stream.write(
+                    sse_event("error", {"error": str(e)}).encode("utf-8")
+                )
+                return stream
+        await stream.write(sse_event("done", {}).encode("utf-8"))
+    await stream.write_eof()
+    return stream
+
+
+def overloaded_response_async() -> web.Response:
+    retry_after = str(config.serving.admission.retry_after_s)
+    return web.json_response(
+        {"error": "Server is overloaded"},
+        status=503,
+        headers={"Retry-After": retry_after},
+    )
+
+
+async def analysis_result_async(request: web.Request) -> web.Response:
+    wait = min(float(request.query.get("wait", 0)), MAX_ANALYSIS_WAIT_S)
+    state, value = await asyncio.to_thread(
+        analysis_jobs.wait, request.match_info["job_id"], wait
+    )
+    body, status = analysis_job_response(state, value)
+    return web.json_response(body, status=status)
+
+
+async def text_to_sql_events_async(
+    params: Dict, admission: Admission, stream_analysis: bool
+) -> AsyncIterator[Tuple[str, Dict]]:
+    """Event loop variant of text_to_sql_events, yielding the same events."""
+    text: str = params["text"]
+    db_id: str = params["db_id"]
+    analyse: bool = params["analyse"]
+    reset_history: bool = params["reset_history"]
+    session_id: str = params.get("session_id", DEFAULT_SESSION_ID)
+    if reset_history:
+        await asyncio.to_thread(session_store.reset, session_id)
+    text_history = await asyncio.to_thread(session_store.get_history, session_id)
+    logger.info(
+        f"DB_id: {db_id}, analyse: {analyse}, text: {text} reset_history: {reset_history} session: {session_id} text_history: {text_history}"
+    )
+
+    input_text = "<s> " + text + text_history
+    redis_key = generate_redis_key(text=input_text, db_id=db_id)
+    new_text_history = text_history
+    if not new_text_history.endswith(text):
+        new_text_history += " <s> " + text
+
+    tasks: Dict[str, asyncio.Task] = {}
+    try:
+        tasks["tune_check"] = asyncio.create_task(
+            timed_async("tune_check", text_to_intent_model.tune_check_async(text))
+        )
+        with stage_timer("cache_lookup"):
+            cached = await async_result_cache.get_many(
+                redis_key, (TEXT2SQL, ANALYSIS, USER_INTENT)
+            )
+        record_cache_lookup(TEXT2SQL, TEXT2SQL in cached)
+        record_cache_lookup(USER_INTENT, USER_INTENT in cached)
+        if TEXT2SQL not in cached:
+            tasks["translate"] = asyncio.create_task(
+                timed_async(
+                    "translate",
+                    generate_sql_async(
+                        text, new_text_history, db_id, admission.beam_size
+                    ),
+                )
+            )
+        if intent_stage_needed(cached, admission):
+            tasks["intent"] = asyncio.create_task(
+                run_on_model_executor(
+                    "intent", text_to_intent_model.infer, input_text, db_id
                 )
-            analyze_result = text_to_confidence_model.analyze(
-                input_text, orig_item, preproc_item
             )
 
-            # Save the result to redis
-            rd_analysis.set(redis_key, pickle.dumps(analyze_result))
+        tune_intent = (await tasks["tune_check"])[0]
+        if tune_intent:
+            yield "sql", {
+                "pred_sql": "conduct tuning",
+                "confidence": 100,
+                "user_intent": "database_tuning",
+            }
+            return
 
-        response["analyse_result"] = analyze_result
+        if new_text_history != text_history:
+            await asyncio.to_thread(
+                session_store.set_history, session_id, new_text_history
+            )
 
-    # guess the user's intent
-    input_changed = input_text[len("<s> ") :]
-    input_changed = input_changed.replace("<s>", "[CLS]")
-    if rd_user_intent.exists(redis_key):
-        user_intent = pickle.loads(rd_user_intent.get(redis_key))
-    else:
-        user_intent = text_to_intent_model.infer(input_text, db_id)
-        rd_user_intent.set(redis_key, pickle.dumps(user_intent))
-    response["user_intent"] = user_intent[0]
-    logger.info(f"Response complete: {response['pred_sql']}")
+        # Results to write back to the cache in one round trip
+        new_entries = {}
+
+        if TEXT2SQL in cached:
+            logger.info(f"Returning cached result")
+            response = cached[TEXT2SQL]
+        else:
+            response = await tasks["translate"]
+            if admission.beam_size is None:
+                new_entries[TEXT2SQL] = dict(response)
+        yield "sql", degraded_fields(response, admission)
+
+        if analyse and float(response["confidence"]) < 80:
+            record_cache_lookup(ANALYSIS, ANALYSIS in cached)
+            if ANALYSIS in cached:
+                yield "analysis", {"analyse_result": cached[ANALYSIS]}
+            elif not admission.skips(DEGRADE_ANALYSIS):
+                job = analysis_jobs.submit(
+                    redis_key, analyze, text, new_text_history, db_id
+                )
+                if job is not None:
+                    yield "analysis_job", {"analysis_job": redis_key}
+                    if stream_analysis:
+                        tasks["analysis"] = asyncio.wrap_future(job)
+
+        if "intent" not in tasks:
+            yield "intent", {"user_intent": cached_intent(cached, response)}
+
+        pending = {
+            tasks[name]: name for name in ("analysis", "intent") if name in tasks
+        }
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if pending.pop(task) == "analysis":
+                    yield "analysis", {"analyse_result": task.result()}
+                else:
+                    new_entries[USER_INTENT] = task.result()
+                    yield "intent", {"user_intent": task.result()[0]}
+
+        await async_result_cache.set_many(redis_key, new_entries)
+    finally:
+        unfinished = [name for name, task in tasks.items() if not task.done()]
+        for name in unfinished:
+            tasks[name].cancel()
+        if unfinished:
+            logger.info(f"Cancelled speculative stages: {unfinished}")
+
+
+async def generate_sql_async(
+    text: str, text_history: str, db_id: str, beam_size: Optional[int] = None
+) -> Dict:
+    """Event loop variant of generate_sql."""
+    item = await asyncio.get_running_loop().run_in_executor(
+        model_executor, text_to_sql_model.preprocess, text, text_history, db_id
+    )
+    embedding = entities = None
+    if semantic_cache is not None:
+        embeddings = await run_on_model_executor(
+            "embedding", text_to_sql_model.embed, ["<s> " + text + text_history]
+        )
+        embedding = embeddings[0]
+        entities = linked_entities(item[1])
+        response = semantic_cache.lookup(db_id, embedding, entities)
+        if response is not None:
+            return dict(response)
+
+    beams, inferred_code, heads = await asyncio.wrap_future(
+        text_to_sql_worker.submit(text, text_history, db_id, item, beam_size)
+    )
+    inferred_code = await text_to_sql_model.fill_values_async(
+        text, text_history, db_id, inferred_code
+    )
+    response = sql_response(beams, inferred_code, heads)
+
+    if semantic_cache is not None and beam_size is None:
+        semantic_cache.add(db_id, embedding, dict(response), entities)
     return response
 
 
+async def preflight_async(request: web.Request) -> web.Response:
+    return web.Response()
+
+
+async def add_cors_headers(request: web.Request, response: web.StreamResponse) -> None:
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+
+
+async def start_async_clients(app: web.Application) -> None:
+    global async_result_cache
+    async_result_cache = build_async_result_cache(config.redis)
+
+
+async def close_async_clients(app: web.Application) -> None:
+    await async_result_cache.client.aclose()
+
+
+def run_async_server() -> None:
+    """Serve the API from an asyncio event loop instead of waitress threads."""
+    global model_executor
+    model_executor = ThreadPoolExecutor(
+        max_workers=config.serving.model_workers, thread_name_prefix="model"
+    )
+    metrics.registry.gauge(
+        "text2sql_model_queue_depth",
+        "Model calls waiting for a thread of the model executor.",
+        lambda: model_executor._work_queue.qsize(),
+    )
+
+    async_app = web.Application(middlewares=[reject_until_ready_async])
+    async_app.router.add_get("/", index_async)
+    async_app.router.add_get("/health", health_async)
+    async_app.router.add_get("/ready", ready_async)
+    async_app.router.add_get("/reset_history", reset_history_async)
+    async_app.router.add_get("/metrics", metrics_async)
+    async_app.router.add_post("/table_to_text", table_to_text_async)
+    async_app.router.add_post("/text_to_sql", text_to_sql_async)
+    async_app.router.add_post("/text_to_sql_stream", text_to_sql_stream_async)
+    async_app.router.add_get("/analysis/{job_id}", analysis_result_async)
+    async_app.router.add_route("OPTIONS", "/{tail:.*}", preflight_async)
+    async_app.on_response_prepare.append(add_cors_headers)
+    async_app.on_startup.append(start_async_clients)
+    async_app.on_cleanup.append(close_async_clients)
+
+    web.run_app(async_app, host=config.host, port=config.port)
+
+
+def start_models() -> None:
+    """Install the loaded models and warm them up before taking requests."""
+    global text_to_sql_model, text_to_intent_model, text_to_confidence_model
+    global table_to_text_model, text_to_sql_worker, admission_controller
+
+    text_to_sql_model = loader.result("text2sql")
+    text_to_intent_model = loader.result("text2intent")
+    text_to_confidence_model = loader.result("text2confidence")
+    table_to_text_model = loader.result("table2text")
+    text_to_sql_worker = InferenceWorker(
+        functools.partial(text_to_sql_model.translate_batch, fill_values=False),
+        batch_window_ms=config.serving.batch_window_ms,
+        max_batch_size=config.serving.max_batch_size,
+        name="text2sql-worker",
+    )
+    metrics.registry.gauge(
+        "text2sql_worker_queue_depth",
+        "Requests waiting for the text-to-SQL batching worker.",
+        lambda: text_to_sql_worker.queue_depth,
+    )
+    admission_controller = build_admission_controller(
+        config.serving, lambda: text_to_sql_worker.queue_wait
+    )
+    metrics.registry.gauge(
+        "text2sql_in_flight_requests",
+        "Text-to-SQL requests admitted and not finished.",
+        lambda: admission_controller.in_flight,
+    )
+    metrics.registry.gauge(
+        "text2sql_load",
+        "Load seen by the admission controller (1 is full load).",
+        lambda: admission_controller.load,
+    )
+    warmup(config.serving.warmup)
+
+
+def warmup(warmup_cfg: DictConfig) -> None:
+    """Run the configured warmup questions through the models.
+
+    The first calls of a model are much slower than the following ones (CUDA
+    context and kernel selection, allocator growth, lazily built tokenizer and
+    schema state), so they are made here rather than by the first users. The
+    text-to-SQL model is run at every configured batch size, as kernels are
+    selected per input shape, and its compiled encoder (if enabled) is checked
+    against eager mode.
+    """
+    questions = list(warmup_cfg.questions)
+    if not questions:
+        return
+    logger.info(f"Warming up with {len(questions)} questions...")
+    for batch_size in warmup_cfg.batch_sizes:
+        batch = [
+            (question.text, "", question.db_id, None, None)
+            for question in itertools.islice(itertools.cycle(questions), batch_size)
+        ]
+        text_to_sql_model.translate_batch(batch, fill_values=False)
+    text_to_sql_model.check_compiled_encoder(
+        [(question.text, question.db_id) for question in questions]
+    )
+    for question in questions:
+        if text_to_sql_model.heads is None:
+            text_to_intent_model.infer("<s> " + question.text, question.db_id)
+        if semantic_cache is not None:
+            text_to_sql_model.embed(["<s> " + question.text])
+    if warmup_cfg.analysis:
+        question = questions[0]
+        orig_item, preproc_item = text_to_sql_model.preprocess(
+            question.text, "", question.db_id
+        )
+        text_to_confidence_model.analyze(orig_item.text, orig_item, preproc_item)
+
+
+def run_worker_pool() -> None:
+    """Serve from serving.pool.workers model processes behind a db_id router.
+
+    Each worker is this script started again with the same overrides, listening
+    on its own port of serving.pool.base_port onwards.
+    """
+    pool_cfg = config.serving.pool
+    # Set per worker below, so that each one gets its port and its own log file
+    overridden = {"host", "port", "serving.pool.workers", "hydra.job.name"}
+    overrides = [
+        override
+        for override in HydraConfig.get().overrides.task
+        if override.split("=")[0].lstrip("+~") not in overridden
+    ]
+    pool = WorkerPool(
+        [sys.executable, os.path.abspath(__file__)]
+        + overrides
+        + ["serving.pool.workers=1", "hydra.job.name=worker{index}"],
+        num_workers=pool_cfg.workers,
+        host=pool_cfg.worker_host,
+        base_port=pool_cfg.base_port,
+        devices=list(pool_cfg.devices),
+        threads_per_worker=pool_cfg.threads_per_worker,
+        cwd=get_original_cwd(),
+    )
+    logger.info(
+        f"Routing {config.host}:{config.port} to {pool_cfg.workers} workers "
+        f"on ports {pool_cfg.base_port}-{pool_cfg.base_port + pool_cfg.workers - 1}"
+    )
+    run_router(pool, config.host, config.port, config.serving.admission.retry_after_s)
+
+
 @hydra.main(version_base=None, config_path=ABS_CONFIG_DIR, config_name="config")
 def main(cfg: DictConfig) -> None:
     """Main entry point using Hydra for configuration management"""
-    global config, rd_text2sql, rd_analysis, rd_user_intent, rd_table2text
+    global config, result_cache, model_version, semantic_cache
     global text_to_sql_model, text_to_intent_model, text_to_confidence_model, table_to_text_model
-    global result_analysis_model, analyser
+    global text_to_sql_worker, session_store, stage_executor, loader, analysis_jobs
+    global result_analysis_model, analyser, llm_gateway
 
     config = cfg
 
@@ -192,53 +926,102 @@ def main(cfg: DictConfig) -> None:
     logger.info("Initializing backend server with Hydra configuration...")
     logger.info(f"Configuration:\n{OmegaConf.to_yaml(cfg)}")
 
+    if config.serving.pool.workers > 1:
+        run_worker_pool()
+        return
+
     # Initialize redis
-    rd_text2sql = redis.StrictRedis(
-        host=config.redis.host,
-        port=config.redis.port,
-        db=config.redis.api_text2sql_cache_db,
+    result_cache = build_result_cache(config.redis)
+    # Cached results are only valid for the models they were computed with
+    model_version = fingerprint(
+        config.redis.cache_version,
+        OmegaConf.to_container(config.text2sql, resolve=True),
+        OmegaConf.to_container(config.text2intent, resolve=True),
+        OmegaConf.to_container(config.conversation, resolve=True),
     )
 
-    rd_analysis = redis.StrictRedis(
-        host=config.redis.host,
-        port=config.redis.port,
-        db=config.redis.api_analyze_cache_db,
-    )
+    if config.redis.is_flush:
+        logger.info("Flushing Redis result cache...")
+        result_cache.flush()
 
-    rd_user_intent = redis.StrictRedis(
-        host=config.redis.host,
-        port=config.redis.port,
-        db=config.redis.api_user_intent_cache_db,
+    session_store = build_session_store(config.serving, config.redis)
+    semantic_cache = build_semantic_cache(config.serving)
+    stage_executor = ThreadPoolExecutor(
+        max_workers=config.serving.stage_workers, thread_name_prefix="stage"
     )
 
-    rd_table2text = redis.StrictRedis(
-        host=config.redis.host,
-        port=config.redis.port,
-        db=config.redis.api_table2text_cache_db,
+    metrics.registry.gauge(
+        "text2sql_stage_queue_depth",
+        "Stages waiting for a thread of the stage executor.",
+        lambda: stage_executor._work_queue.qsize(),
     )
+    analysis_jobs = JobQueue(
+        "analysis",
+        result_cache,
+        ANALYSIS,
+        workers=config.serving.analysis_workers,
+        max_pending=config.serving.analysis_max_pending,
+    )
+    metrics.registry.gauge(
+        "text2sql_analysis_jobs",
+        "Analysis jobs queued or running.",
+        lambda: len(analysis_jobs),
+    )
+    if semantic_cache is not None:
+        metrics.registry.gauge(
+            "text2sql_semantic_cache_entries",
+            "Questions held by the semantic cache.",
+            lambda: len(semantic_cache),
+        )
 
-    if config.redis.is_flush:
-        logger.info("Flushing Redis databases...")
-        rd_text2sql.flushdb()
-        rd_analysis.flushdb()
-        rd_user_intent.flushdb()
-        rd_table2text.flushdb()
-
-    # Initialize models
-    logger.info("Loading text-to-sql model...")
-    text_to_sql_model = Text2SQL(config, config.text2sql)
-
-    logger.info("Loading text-to-intent model...")
-    text_to_intent_model = IntentInferer(config, config.text2intent)
-
-    logger.info("Loading result analysis model...")
-    text_to_confidence_model = Text2Confidence(config.conversation.text2confidence)
+    # One client, and so one connection pool and concurrency limit, for all
+    # the components calling the LLM
+    llm_gateway = build_llm_gateway(config.serving)
 
-    logger.info("Loading table-to-text model...")
-    table_to_text_model = Table2Text(config.conversation.table2text)
+    # Load the models concurrently in the background; requests are refused
+    # (see /ready) until all of them are loaded and warmed up
+    loader = ComponentLoader(max_workers=config.serving.load_workers)
+    if config.serving.stub_models:
+        logger.info("Using stub models (serving.stub_models)")
+        loader.submit("text2sql", StubText2SQL, config, config.serving.stub)
+        loader.submit(
+            "text2intent",
+            StubIntentInferer,
+            config.text2intent,
+            config.serving.stub,
+            llm_gateway,
+        )
+        loader.submit("text2confidence", StubText2Confidence, config.serving.stub)
+    else:
+        set_torch_threads(
+            config.serving.intra_op_threads, config.serving.inter_op_threads
+        )
+        loader.submit("text2sql", Text2SQL, config, config.text2sql, config.device)
+        # The multi-task heads of the text2sql model replace the intent model
+        loader.submit(
+            "text2intent",
+            IntentInferer,
+            config,
+            config.text2intent,
+            config.device,
+            llm_gateway,
+            load_model=config.text2sql.multitask.heads_path is None,
+        )
+        loader.submit(
+            "text2confidence",
+            Text2Confidence,
+            config.conversation.text2confidence,
+            config.device,
+        )
+        loader.submit("spacy", get_spacy_model)
+    loader.submit("table2text", Table2Text, config.conversation.table2text, llm_gateway)
+    loader.start(start_models)
 
     logger.info(f"Starting server on {config.host}:{config.port}")
-    serve(app, host=config.host, port=config.port)
+    if config.serving.mode == "async":
+        run_async_server()
+    else:
+        serve(app, host=config.host, port=config.port, threads=config.serving.threads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""Calibrate the similarity threshold of the semantic cache on Spider dev.
+
+Questions of a database with the same gold SQL are paraphrases; all other
+pairs of questions of a database are not. For each threshold, every question
+is looked up in a cache holding the other questions of its database, as the
+backend would look it up (SemanticCache). A hit on a question with other SQL
+is a false hit: the backend would serve wrong SQL without translating. The
+script reports the hit and false-hit rates with and without the entity check
+of the cache, and the lowest threshold whose false-hit rate stays within
+--max-false-hit-rate:
+
+    python demo/calibrate_semantic_cache.py --dev spider/dev.json
+
+Trailing arguments are Hydra overrides of the backend configuration. Serve
+the cache with serving.semantic_cache=true serving.semantic_threshold=<value>.
+Equivalent SQL written differently counts as other SQL, so the false-hit rate
+is an upper bound.
+"""
+
+import sys
+import json
+import logging
+import argparse
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+from hydra import compose, initialize_config_dir
+from config.path import ABS_CONFIG_DIR
+from source.serving.semantic_cache import linked_entities
+from source.text2sql.text_to_sql import Text2SQL
+
+logger = logging.getLogger("CalibrateSemanticCache")
+
+
+def normalize_sql(sql: str) -> str:
+    return " ".join(sql.lower().replace(";", " ").split())
+
+
+def embed_questions(
+    translator: Text2SQL, examples: List[Dict], batch_size: int
+) -> Dict[str, Dict[str, list]]:
+    """Embeddings, linked entities and gold SQL of the questions of each database."""
+    by_db = defaultdict(lambda: {"embeddings": [], "entities": [], "sql": []})
+    usable = []
+    for example in examples:
+        try:
+            _, preproc_item = translator.preprocess(
+                example["question"], "", example["db_id"]
+            )
+        except AssertionError:
+            # Input longer than BERT accepts
+            continue
+        usable.append((example, linked_entities(preproc_item)))
+    for start in range(0, len(usable), batch_size):
+        batch = usable[start : start + batch_size]
+        embeddings = translator.embed(
+            ["<s> " + example["question"] for example, _ in batch]
+        )
+        for (example, entities), embedding in zip(batch, embeddings):
+            questions = by_db[example["db_id"]]
+            questions["embeddings"].append(embedding)
+            questions["entities"].append(entities)
+            questions["sql"].append(normalize_sql(example["query"]))
+    logger.info(f"Embedded {len(usable)} of {len(examples)} questions")
+    return by_db
+
+
+def best_matches(by_db: Dict[str, Dict[str, list]], check_entities: bool):
+    """Best cached match of each question, as the backend would look it up.
+
+    Returns:
+        Similarity of the match of each question, whether the match has the
+        same SQL, and whether the question has a paraphrase at all
+    """
+    similarities, same_sql, has_paraphrase = [], [], []
+    for questions in by_db.values():
+        if len(questions["sql"]) < 2:
+            continue
+        embeddings = np.asarray(questions["embeddings"], dtype=np.float32)
+        scores = embeddings @ embeddings.T
+        np.fill_diagonal(scores, -np.inf)
+        if check_entities:
+            ids = {}
+            entity_ids = np.array(
+                [
+                    ids.setdefault(entities, len(ids))
+                    for entities in questions["entities"]
+                ]
+            )
+            scores[entity_ids[:, None] != entity_ids[None, :]] = -np.inf
+        best = scores.argmax(axis=1)
+        sql = questions["sql"]
+        similarities.extend(scores[np.arange(len(best)), best])
+        same_sql.extend(sql[i] == sql[j] for i, j in enumerate(best))
+        has_paraphrase.extend(sql.count(query) > 1 for query in sql)
+    return np.asarray(similarities), np.asarray(same_sql), np.asarray(has_paraphrase)
+
+
+def rates(
+    similarities: np.ndarray,
+    same_sql: np.ndarray,
+    has_paraphrase: np.ndarray,
+    threshold: float,
+) -> Dict[str, float]:
+    """Hit rates of the questions looked up in a cache of the others at threshold.
+
+    paraphrase_hit_rate is the share of questions with a paraphrase that get its
+    SQL, false_hit_rate the share of all questions that get other SQL.
+    """
+    hits = similarities >= threshold
+    return {
+        "hit_rate": float(hits.mean()),
+        "paraphrase_hit_rate": (
+            float((hits & same_sql)[has_paraphrase].mean())
+            if has_paraphrase.any()
+            else 0.0
+        ),
+        "false_hit_rate": float((hits & ~same_sql).mean()),
+    }
+
+
+def main() -> int:
+    logging.basicConfig(
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s",
+        datefmt="%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dev", required=True, help="Spider dev.json")
+    parser.add_argument("--max-false-hit-rate", type=float, default=0.001)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.9, 0.93, 0.95, 0.96, 0.97, 0.98, 0.985, 0.99, 0.995, 0.999],
+    )
+    parser.add_argument("overrides", nargs="*", help="Hydra config overrides")
+    args = parser.parse_args()
+
+    with initialize_config_dir(version_base=None, config_dir=ABS_CONFIG_DIR):
+        cfg = compose(config_name="config", overrides=args.overrides)
+    translator = Text2SQL(cfg, cfg.text2sql, device=cfg.device)
+    with open(args.dev) as f:
+        examples = json.load(f)
+    by_db = embed_questions(translator, examples, args.batch_size)
+
+    with_entities = best_matches(by_db, check_entities=True)
+    embedding_only = best_matches(by_db, check_entities=False)
+    report = {"questions": len(with_entities[0]), "thresholds": []}
+    for threshold in sorted(args.thresholds):
+        report["thresholds"].append(
+            {
+                "threshold": threshold,
+                **rates(*with_entities, threshold),
+                "embedding_only": rates(*embedding_only, threshold),
+            }
+        )
+    report["recommended_threshold"] = next(
+        (
+            entry["threshold"]
+            for entry in report["thresholds"]
+            if entry["false_hit_rate"] <= args.max_false_hit_rate
+        ),
+        None,
+    )
+    print(json.dumps(report, indent=2))
+    if report["recommended_threshold"] is None:
+        logger.error(
+            f"No threshold keeps the false-hit rate within {args.max_false_hit_rate}; "
+            f"leave the semantic cache off"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
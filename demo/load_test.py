@@ -0,0 +1,329 @@
+"""Load generator for the backend server.
+
+Without a GPU, Redis or Postgres, start a fake LLM and the backend with stub
+models, then run the load test against it:
+
+    python demo/load_test.py fake-llm --port 30000
+    python demo/backend_server.py serving=loadtest redis.backend=memory \\
+        data.value_store=sqlite
+    python demo/load_test.py run --concurrency 16 --duration 60
+
+The host and port of the fake LLM must match text2intent and
+conversation.table2text. With --max-p99-ms the exit status is non-zero when the
+p99 latency exceeds the limit, so runs can gate changes to the serving layer.
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+
+logger = logging.getLogger("LoadTest")
+
+# Questions on the concert_singer database of Spider
+DEFAULT_QUESTIONS = [
+    "How many singers do we have?",
+    "Show the name, country and age of all singers ordered by age",
+    "What is the average, minimum and maximum age of singers from France?",
+    "Show the name and release year of the song by the youngest singer",
+    "What are all distinct countries where singers above age 20 are from?",
+    "Show all countries and the number of singers in each country",
+    "List all song names by singers above the average age",
+    "Show location and name for all stadiums with a capacity between 5000 and 10000",
+    "What is the maximum capacity and the average of all stadiums?",
+    "Show the stadium name and the number of concerts in each stadium",
+    "Show the names of singers from Netherlands",
+    "Only name and capacity",
+]
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    """p50/p90/p99/max of latencies in seconds, reported in milliseconds."""
+    if not latencies:
+        return {}
+    values = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+async def send_request(
+    session: aiohttp.ClientSession, url: str, body: Dict, stream: bool
+) -> Optional[float]:
+    """Send one text2sql request.
+
+    Returns:
+        Seconds until the first "sql" event when streaming, otherwise None
+    """
+    if not stream:
+        async with session.post(f"{url}/text_to_sql", json=body) as response:
+            response.raise_for_status()
+            await response.json()
+        return None
+
+    start = time.perf_counter()
+    time_to_sql = None
+    async with session.post(f"{url}/text_to_sql_stream", json=body) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.decode("utf-8").strip()
+            if line == "event: sql" and time_to_sql is None:
+                time_to_sql = time.perf_counter() - start
+            elif line == "event: error":
+                raise RuntimeError("Server sent an error event")
+    return time_to_sql
+
+
+async def user_loop(
+    user: int,
+    args: argparse.Namespace,
+    questions: List[str],
+    session: aiohttp.ClientSession,
+    deadline: float,
+    results: Dict[str, List],
+) -> None:
+    """Send requests of one simulated user back to back until the deadline."""
+    rng = random.Random(user)
+    session_id = f"load-test-{user}"
+    reset_history = True
+    while time.perf_counter() < deadline:
+        body = {
+            "text": rng.choice(questions),
+            "db_id": args.db_id,
+            "analyse": rng.random() < args.analyse_ratio,
+            "reset_history": reset_history,
+            "session_id": session_id,
+        }
+        start = time.perf_counter()
+        try:
+            time_to_sql = await send_request(session, args.url, body, args.stream)
+        except Exception as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status == 503:
+                # Turned away by admission control; back off as asked
+                results["rejected"].append(time.perf_counter() - start)
+                retry_after = e.headers.get("Retry-After", "1") if e.headers else "1"
+                await asyncio.sleep(float(retry_after))
+                continue
+            logger.warning(f"Request of user {user} failed: {e}")
+            results["errors"].append(str(e))
+            await asyncio.sleep(1)
+            continue
+        results["latencies"].append(time.perf_counter() - start)
+        if time_to_sql is not None:
+            results["time_to_sql"].append(time_to_sql)
+        # Start a new conversation every few turns, like the demo users do
+        reset_history = rng.random() < 1 / args.turns
+
+
+async def fetch_metrics(session: aiohttp.ClientSession, url: str) -> str:
+    """Text of the /metrics endpoint, empty if unavailable."""
+    async with session.get(f"{url}/metrics") as response:
+        if response.status != 200:
+            return ""
+        return await response.text()
+
+
+def stage_latencies(metrics_text: str) -> Dict[str, float]:
+    """Mean latency in milliseconds of each stage."""
+    sums, counts = {}, {}
+    for line in metrics_text.splitlines():
+        if not line.startswith("text2sql_stage_seconds_"):
+            continue
+        name, value = line.rsplit(" ", 1)
+        stage = name.split('stage="')[1].split('"')[0]
+        if name.startswith("text2sql_stage_seconds_sum"):
+            sums[stage] = float(value)
+        elif name.startswith("text2sql_stage_seconds_count"):
+            counts[stage] = float(value)
+    return {
+        stage: sums[stage] / counts[stage] * 1000 for stage in sums if counts.get(stage)
+    }
+
+
+def llm_prompt_tokens(metrics_text: str) -> Dict[str, float]:
+    """Prompt tokens sent to the LLM, and the share the server had cached."""
+    tokens = {}
+    for line in metrics_text.splitlines():
+        if line.startswith("text2sql_llm_prompt_tokens_total{"):
+            name, value = line.rsplit(" ", 1)
+            tokens[name.split('cache="')[1].split('"')[0]] = float(value)
+    total = sum(tokens.values())
+    if not total:
+        return {}
+    return {"total": total, "cached_share": tokens.get("hit", 0) / total}
+
+
+async def wait_until_ready(
+    session: aiohttp.ClientSession, url: str, timeout: float
+) -> None:
+    """Poll /ready until the backend has loaded and warmed up its models."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            async with session.get(f"{url}/ready") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{url} not ready after {timeout}s")
+        await asyncio.sleep(1)
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict:
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        questions = DEFAULT_QUESTIONS
+
+    results = {"latencies": [], "time_to_sql": [], "errors": [], "rejected": []}
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await wait_until_ready(session, args.url, args.ready_timeout)
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *(
+                user_loop(user, args, questions, session, deadline, results)
+                for user in range(args.concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        try:
+            metrics_text = await fetch_metrics(session, args.url)
+        except aiohttp.ClientError:
+            metrics_text = ""
+
+    completed = len(results["latencies"])
+    report = {
+        "concurrency": args.concurrency,
+        "duration_s": elapsed,
+        "requests": completed,
+        "errors": len(results["errors"]),
+        "rejected": len(results["rejected"]),
+        "throughput_rps": completed / elapsed,
+        "latency": percentiles(results["latencies"]),
+        "stage_mean_ms": stage_latencies(metrics_text),
+        "llm_prompt_tokens": llm_prompt_tokens(metrics_text),
+    }
+    if args.stream:
+        report["time_to_sql"] = percentiles(results["time_to_sql"])
+    return report
+
+
+def run(args: argparse.Namespace) -> int:
+    report = asyncio.run(run_load_test(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if report["requests"] == 0:
+        logger.error("No request completed")
+        return 1
+    error_rate = report["errors"] / (report["requests"] + report["errors"])
+    if error_rate > args.max_error_rate:
+        logger.error(f"Error rate {error_rate:.2%} above {args.max_error_rate:.2%}")
+        return 1
+    if args.max_p99_ms is not None and report["latency"]["p99_ms"] > args.max_p99_ms:
+        logger.error(
+            f"p99 latency {report['latency']['p99_ms']:.0f} ms above {args.max_p99_ms} ms"
+        )
+        return 1
+    return 0
+
+
+def fake_llm(args: argparse.Namespace) -> int:
+    from source.serving.fake_llm import run_fake_llm
+
+    run_fake_llm(
+        args.host,
+        args.port,
+        args.latency_ms,
+        args.failure_rate,
+        args.prefill_ms_per_1k_tokens,
+    )
+    return 0
+
+
+def main() -> int:
+    logging.basicConfig(
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s",
+        datefmt="%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Send load to the backend")
+    run_parser.add_argument("--url", default="http://localhost:7000")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=30, help="Seconds")
+    run_parser.add_argument("--db-id", default="concert_singer")
+    run_parser.add_argument(
+        "--questions", help="File with one question per line (default: built-in)"
+    )
+    run_parser.add_argument(
+        "--analyse-ratio",
+        type=float,
+        default=0.2,
+        help="Fraction of requests asking for the analysis",
+    )
+    run_parser.add_argument(
+        "--turns", type=float, default=3, help="Mean turns per conversation"
+    )
+    run_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Use /text_to_sql_stream and report the time to the SQL",
+    )
+    run_parser.add_argument("--timeout", type=float, default=120, help="Seconds")
+    run_parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=600,
+        help="Seconds to wait for the backend to become ready",
+    )
+    run_parser.add_argument("--output", help="Also write the report to this file")
+    run_parser.add_argument("--max-p99-ms", type=float)
+    run_parser.add_argument("--max-error-rate", type=float, default=0.0)
+    run_parser.set_defaults(func=run)
+
+    llm_parser = subparsers.add_parser(
+        "fake-llm", help="Serve a fake LLM /generate endpoint"
+    )
+    llm_parser.add_argument("--host", default="0.0.0.0")
+    llm_parser.add_argument("--port", type=int, default=30000)
+    llm_parser.add_argument("--latency-ms", type=float, default=50)
+    llm_parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0,
+        help="Share of requests failed with 503",
+    )
+    llm_parser.add_argument(
+        "--prefill-ms-per-1k-tokens",
+        type=float,
+        default=0,
+        help="Prefill time per thousand prompt tokens not in the prefix cache",
+    )
+    llm_parser.set_defaults(func=fake_llm)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Accuracy and latency of the text2sql model on CPU with and without quantization.
+
+Translates the Spider dev set on the CPU once with the full-precision model
+and once per quantization scheme, then reports exact-match accuracy, latency
+percentiles and how often the quantized model predicts the same SQL:
+
+    python demo/quantization_report.py --dev-path /path/to/spider/dev.json \\
+        --limit 200 --threads 8 --output report.json
+
+Trailing arguments are Hydra overrides of the backend configuration (e.g.
+data.database_path=...). Values are not filled in, as exact match ignores them.
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from hydra import compose, initialize_config_dir
+from config.path import ABS_CONFIG_DIR
+from source.text2sql.text_to_sql import Text2SQL
+from source.text2sql.quantization import INT8_DYNAMIC, set_torch_threads
+from source.text2sql.ratsql.datasets.spider_lib import evaluation
+
+logger = logging.getLogger("QuantizationReport")
+
+# Examples translated before timing starts, per profile
+WARMUP_EXAMPLES = 3
+
+
+def translate_dev_set(
+    translator: Text2SQL, examples: List[Dict], items: List[Any]
+) -> Dict[str, List]:
+    """Translate every example with its preprocessed item, timing each one."""
+    warmup = [
+        (example["question"], "", example["db_id"], item, None)
+        for example, item in zip(examples[:WARMUP_EXAMPLES], items)
+    ]
+    for request in warmup:
+        translator.translate_batch([request], fill_values=False)
+
+    predictions, latencies = [], []
+    for example, item in zip(examples, items):
+        start = time.perf_counter()
+        _, inferred_code, _ = translator.translate_batch(
+            [(example["question"], "", example["db_id"], item, None)],
+            fill_values=False,
+        )[0]
+        latencies.append(time.perf_counter() - start)
+        predictions.append(inferred_code)
+    return {"predictions": predictions, "latencies": latencies}
+
+
+def exact_match(cfg, examples: List[Dict], predictions: List[str]) -> float:
+    """Spider exact-match accuracy of predictions."""
+    with open(cfg.data.table_path) as f:
+        tables = json.load(f)
+    kmaps = evaluation.build_foreign_key_map_from_json(cfg.data.table_path)
+    evaluator = evaluation.Evaluator(
+        cfg.data.database_path, kmaps, tables, "match", grammar="spider"
+    )
+    for example, predicted in zip(examples, predictions):
+        evaluator.evaluate_one(example["db_id"], example["query"], predicted)
+    evaluator.finalize()
+    return evaluator.scores["all"]["exact"]
+
+
+def build_report(
+    cfg, examples: List[Dict], schemes: List[Optional[str]]
+) -> Dict[str, Any]:
+    results = {}
+    items = None
+    for scheme in schemes:
+        name = scheme or "float32"
+        cfg.text2sql.quantize = scheme
+        logger.info(f"Loading the {name} model...")
+        translator = Text2SQL(cfg, cfg.text2sql, device="cpu")
+        if items is None:
+            # Shared by all profiles, so only the model time is compared
+            items = [
+                translator.preprocess(example["question"], "", example["db_id"])
+                for example in examples
+            ]
+        logger.info(f"Translating {len(examples)} examples with the {name} model...")
+        results[name] = translate_dev_set(translator, examples, items)
+
+    baseline = results["float32"]
+    report = {"examples": len(examples), "profiles": {}}
+    for name, result in results.items():
+        latencies_ms = np.asarray(result["latencies"]) * 1000
+        agreement = np.mean(
+            [
+                predicted == reference
+                for predicted, reference in zip(
+                    result["predictions"], baseline["predictions"]
+                )
+            ]
+        )
+        report["profiles"][name] = {
+            "exact_match": exact_match(cfg, examples, result["predictions"]),
+            "agreement_with_float32": float(agreement),
+            "mean_ms": float(latencies_ms.mean()),
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p90_ms": float(np.percentile(latencies_ms, 90)),
+            "speedup": float(
+                np.mean(baseline["latencies"]) / np.mean(result["latencies"])
+            ),
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Spider dev, {report['examples']} examples, CPU")
+    print(
+        f"{'profile':<14}{'exact':>8}{'agree':>8}{'mean ms':>10}"
+        f"{'p50 ms':>10}{'p90 ms':>10}{'speedup':>9}"
+    )
+    for name, row in report["profiles"].items():
+        print(
+            f"{name:<14}{row['exact_match']:>8.3f}{row['agreement_with_float32']:>8.3f}"
+            f"{row['mean_ms']:>10.1f}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}"
+            f"{row['speedup']:>8.2f}x"
+        )
+
+
+def main() -> int:
+    logging.basicConfig(
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s",
+        datefmt="%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dev-path", required=True, help="Spider dev.json")
+    parser.add_argument("--limit", type=int, help="Only the first N examples")
+    parser.add_argument("--threads", type=int, help="Torch intra-op threads")
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("overrides", nargs="*", help="Hydra config overrides")
+    args = parser.parse_args()
+
+    with initialize_config_dir(version_base=None, config_dir=ABS_CONFIG_DIR):
+        cfg = compose(config_name="config", overrides=args.overrides)
+    set_torch_threads(args.threads, 1)
+
+    with open(args.dev_path) as f:
+        examples = json.load(f)[: args.limit]
+    report = build_report(cfg, examples, [None, INT8_DYNAMIC])
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""Train the intent and confidence heads of the text2sql model.
+
+The heads read the encoder state of the text2sql model, so that the backend
+encodes each question once for its SQL, its intent and the confidence in its
+SQL (text2sql.multitask). Training has two phases:
+
+1. Intent: the intent head learns on CoSQL-format dialogues (utterance_toks,
+   intent and database_id per turn). With --encoder-lr above 0, the encoder
+   and the SQL decoder are trained jointly on the preprocessed training set of
+   the text2sql model, each step encoding its SQL and intent examples in one
+   pass; otherwise the text2sql model is left unchanged.
+2. Confidence: the confidence head learns whether the best beam is an exact
+   match on a Spider-format dev set, half of which fits its temperature.
+
+    python demo/train_multitask.py --intent-train cosql/train.json \\
+        --intent-dev cosql/dev.json --confidence-dev spider/dev.json \\
+        --output multitask_heads.pt
+
+Trailing arguments are Hydra overrides of the backend configuration. Serve the
+heads with text2sql.multitask.heads_path=multitask_heads.pt.
+"""
+
+import sys
+import json
+import random
+import logging
+import argparse
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import torch
+from hydra import compose, initialize_config_dir
+from config.path import ABS_CONFIG_DIR
+from source.text2sql.text_to_sql import Text2SQL
+from source.text2sql.multitask import MultiTaskHeads, MultiTaskModel, beam_features
+from source.text2sql.ratsql.commands.train import LONG_DBS
+from source.text2sql.ratsql.datasets.spider_lib import evaluation
+from source.text2sql.ratsql.models.spider import spider_beam_search
+
+logger = logging.getLogger("TrainMultiTask")
+
+
+def read_intent_examples(path: str) -> List[Tuple[str, str, str, str]]:
+    """(text, text_history, db_id, intent) of each turn of CoSQL-format dialogues.
+
+    The history is built as in CosqlDataset and formatted as the backend
+    formats it for the text2sql model, current turn included.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    examples = []
+    history, prev_db_id = [], None
+    for entry in entries:
+        if entry["intent"] in [[None], None]:
+            continue
+        if entry["database_id"] != prev_db_id:
+            history = []
+        text = " ".join(entry["utterance_toks"])
+        history.append(text)
+        text_history = "".join(" <s> " + turn for turn in history)
+        examples.append(
+            (text, text_history, entry["database_id"], entry["intent"][0].lower())
+        )
+        prev_db_id = entry["database_id"]
+        if "GOOD_BYE" in entry["intent"]:
+            history = []
+    return examples
+
+
+def preprocess_intents(
+    translator: Text2SQL, examples: List[Tuple[str, str, str, str]], classes: List[str]
+) -> List[Tuple[Dict, str]]:
+    """(enc_input, intent) pairs of the examples the encoder and the heads accept."""
+    items = []
+    for text, text_history, db_id, intent in examples:
+        if intent not in classes or db_id in LONG_DBS:
+            continue
+        try:
+            _, preproc_item = translator.preprocess(text, text_history, db_id)
+        except AssertionError:
+            # Input longer than BERT accepts
+            continue
+        items.append((preproc_item, intent))
+    logger.info(f"Preprocessed {len(items)} of {len(examples)} intent examples")
+    return items
+
+
+def intent_accuracy(
+    model: MultiTaskModel, items: List[Tuple[Dict, str]], batch_size: int
+) -> float:
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, len(items), batch_size):
+            batch = items[start : start + batch_size]
+            enc_states = model.sql_model.encoder([enc_input for enc_input, _ in batch])
+            pooled = torch.stack([enc_state.pooled for enc_state in enc_states])
+            for intent_id, (_, intent) in zip(
+                model.heads.intent(pooled).argmax(dim=1).tolist(), batch
+            ):
+                correct += model.heads.intent_classes[intent_id] == intent
+    return correct / max(len(items), 1)
+
+
+def train_intent(
+    model: MultiTaskModel,
+    intent_items: List[Tuple[Dict, str]],
+    sql_items: List[Tuple[Dict, Any]],
+    args: argparse.Namespace,
+) -> None:
+    """Train the intent head, jointly with the text2sql model if sql_items are given."""
+    param_groups = [{"params": model.heads.intent.parameters(), "lr": args.lr}]
+    if sql_items:
+        param_groups.append(
+            {"params": model.sql_model.parameters(), "lr": args.encoder_lr}
+        )
+    else:
+        model.sql_model.requires_grad_(False)
+    optimizer = torch.optim.AdamW(param_groups)
+
+    rng = random.Random(0)
+    model.train()
+    if not sql_items:
+        # Frozen, so without dropout, as when serving
+        model.sql_model.eval()
+    for step in range(1, args.steps + 1):
+        intent_batch = rng.sample(intent_items, min(args.batch_size, len(intent_items)))
+        sql_batch = (
+            rng.sample(sql_items, min(args.batch_size, len(sql_items)))
+            if sql_items
+            else []
+        )
+        loss, losses = model.compute_loss(sql_batch, intent_batch, args.intent_weight)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if step % 100 == 0:
+            parts = ", ".join(f"{task} {value:.4f}" for task, value in losses.items())
+            logger.info(f"Step {step}: loss {loss.item():.4f} ({parts})")
+    model.sql_model.requires_grad_(True)
+    model.eval()
+
+
+def confidence_examples(
+    translator: Text2SQL, examples: List[Dict], evaluator: Any
+) -> Dict[str, torch.Tensor]:
+    """Pooled states, beam features and exact match of translated dev examples."""
+    pooled, features, correct = [], [], []
+    for example in examples:
+        try:
+            orig_item, preproc_item = translator.preprocess(
+                example["question"], "", example["db_id"]
+            )
+        except AssertionError:
+            continue
+        with torch.no_grad():
+            (enc_state,) = translator.model.encode_batch([(preproc_item, None)])
+            beams = spider_beam_search.beam_search_with_heuristics(
+                translator.model,
+                orig_item,
+                (preproc_item, None),
+                beam_size=translator.cfg.beam_size,
+                max_steps=translator.cfg.max_steps,
+                enc_state=enc_state,
+            )
+        if not beams:
+            continue
+        _, inferred_code = beams[0].inference_state.finalize()
+        result = evaluator.evaluate_one(
+            example["db_id"], example["query"], inferred_code
+        )
+        pooled.append(enc_state.pooled)
+        features.append(beam_features(beams))
+        correct.append(float(result["exact"]))
+    return {
+        "pooled": torch.stack(pooled),
+        "features": torch.stack(features).to(pooled[0].device),
+        "correct": torch.tensor(correct, device=pooled[0].device),
+    }
+
+
+def expected_calibration_error(
+    probabilities: np.ndarray, correct: np.ndarray, bins: int = 10
+) -> float:
+    """Mean gap between confidence and accuracy over equal-width confidence bins."""
+    indices = np.minimum((probabilities * bins).astype(int), bins - 1)
+    error = 0.0
+    for index in range(bins):
+        in_bin = indices == index
+        if in_bin.any():
+            gap = probabilities[in_bin].mean() - correct[in_bin].mean()
+            error += in_bin.mean() * abs(gap)
+    return float(error)
+
+
+def train_confidence(
+    model: MultiTaskModel, data: Dict[str, torch.Tensor], args: argparse.Namespace
+) -> Dict[str, float]:
+    """Fit the confidence head on half of data and its temperature on the other half.
+
+    Returns:
+        Calibration of the head and of the softmax over beam scores on the
+        second half
+    """
+    size = len(data["correct"])
+    order = torch.randperm(size, generator=torch.Generator().manual_seed(0))
+    fit, calibrate = order[: size // 2], order[size // 2 :]
+
+    head = model.heads.confidence
+    optimizer = torch.optim.AdamW(head.parameters(), lr=args.lr, weight_decay=0.01)
+    head.train()
+    for _ in range(args.confidence_epochs):
+        loss = model.confidence_loss(
+            data["pooled"][fit], data["features"][fit], data["correct"][fit]
+        )
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    head.eval()
+
+    pooled, features = data["pooled"][calibrate], data["features"][calibrate]
+    correct = data["correct"][calibrate]
+    with torch.no_grad():
+        logits = head.logits(pooled, features)
+    temperature = head.fit_temperature(logits, correct)
+    with torch.no_grad():
+        probabilities = head(pooled, features).cpu().numpy()
+    correct = correct.cpu().numpy()
+    # The third beam feature is the former confidence score
+    beam_softmax = features[:, 2].cpu().numpy()
+    return {
+        "examples": size,
+        "accuracy": float(correct.mean()),
+        "temperature": temperature,
+        "heads_ece": expected_calibration_error(probabilities, correct),
+        "beam_softmax_ece": expected_calibration_error(beam_softmax, correct),
+    }
+
+
+def main() -> int:
+    logging.basicConfig(
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s",
+        datefmt="%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--intent-train", required=True, help="CoSQL train.json")
+    parser.add_argument("--intent-dev", required=True, help="CoSQL dev.json")
+    parser.add_argument("--confidence-dev", required=True, help="Spider dev.json")
+    parser.add_argument("--output", required=True, help="Path of the saved heads")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--lr", type=float, default=1e-3, help="Heads learning rate")
+    parser.add_argument(
+        "--encoder-lr",
+        type=float,
+        default=0.0,
+        help="Learning rate of the text2sql model; 0 leaves it unchanged",
+    )
+    parser.add_argument("--intent-weight", type=float, default=1.0)
+    parser.add_argument("--confidence-epochs", type=int, default=300)
+    parser.add_argument("overrides", nargs="*", help="Hydra config overrides")
+    args = parser.parse_args()
+
+    with initialize_config_dir(version_base=None, config_dir=ABS_CONFIG_DIR):
+        cfg = compose(config_name="config", overrides=args.overrides)
+    # Trained in full precision and eager mode, from scratch
+    cfg.text2sql.quantize = None
+    cfg.text2sql.compiled_encoder.backend = None
+    cfg.text2sql.multitask.heads_path = None
+    translator = Text2SQL(cfg, cfg.text2sql, device=cfg.device)
+    encoder = translator.model.encoder
+    heads = MultiTaskHeads(encoder.bert_model.config.hidden_size)
+    model = MultiTaskModel(translator.model, heads.to(encoder._device))
+
+    intent_train = preprocess_intents(
+        translator, read_intent_examples(args.intent_train), heads.intent_classes
+    )
+    intent_dev = preprocess_intents(
+        translator, read_intent_examples(args.intent_dev), heads.intent_classes
+    )
+    sql_items = []
+    if args.encoder_lr > 0:
+        sql_items = [
+            (enc_input, dec_output)
+            for enc_input, dec_output in translator.model.preproc.dataset("train")
+            if enc_input["db_id"] not in LONG_DBS
+        ]
+        logger.info(f"Training jointly with {len(sql_items)} SQL examples")
+    train_intent(model, intent_train, sql_items, args)
+    report = {
+        "intent_dev_accuracy": intent_accuracy(model, intent_dev, args.batch_size)
+    }
+
+    with open(args.confidence_dev) as f:
+        dev_examples = json.load(f)
+    kmaps = evaluation.build_foreign_key_map_from_json(cfg.data.table_path)
+    with open(cfg.data.table_path) as f:
+        tables = json.load(f)
+    evaluator = evaluation.Evaluator(
+        cfg.data.database_path, kmaps, tables, "match", grammar="spider"
+    )
+    data = confidence_examples(translator, dev_examples, evaluator)
+    report["confidence"] = train_confidence(model, data, args)
+    print(json.dumps(report, indent=2))
+
+    model.save(args.output, with_sql_model=bool(sql_items))
+    logger.info(f"Saved the heads to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
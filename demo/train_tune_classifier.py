@@ -0,0 +1,88 @@
+"""Train the local tune check classifier on logged decisions of the LLM.
+
+With text2intent.tune_classifier.decision_log_path set, the backend logs every
+tune check the LLM answers. This script fits a TuneClassifier on such logs,
+reports by cross-validation how many questions it would decide without the
+LLM and how often it would disagree with it, and saves the model:
+
+    python demo/train_tune_classifier.py --log decisions.jsonl \\
+        --output tune_classifier.json --low 0.1 --high 0.9
+
+Serve it with text2intent.tune_classifier.model_path=tune_classifier.json.
+"""
+
+import sys
+import json
+import random
+import logging
+import argparse
+from typing import Dict, List
+
+from source.text2intent.tune_classifier import TuneClassifier, TuneDecisionLog
+
+logger = logging.getLogger("TrainTuneClassifier")
+
+
+def cross_validate(
+    texts: List[str], labels: List[bool], folds: int, low: float, high: float
+) -> Dict[str, float]:
+    """Share of questions decided locally, and accuracy on them, over folds."""
+    order = list(range(len(texts)))
+    random.Random(0).shuffle(order)
+    decided, correct = 0, 0
+    for fold in range(folds):
+        test = set(order[fold::folds])
+        classifier = TuneClassifier.fit(
+            [texts[i] for i in order if i not in test],
+            [labels[i] for i in order if i not in test],
+            low=low,
+            high=high,
+        )
+        for i in test:
+            decision = classifier.decide(texts[i])
+            if decision is not None:
+                decided += 1
+                correct += decision == labels[i]
+    return {
+        "examples": len(texts),
+        "tune_share": sum(labels) / len(labels),
+        "local_share": decided / len(texts),
+        "local_accuracy": correct / decided if decided else 0.0,
+    }
+
+
+def main() -> int:
+    logging.basicConfig(
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s",
+        datefmt="%m/%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--log", required=True, nargs="+", help="Decision logs (JSON lines)"
+    )
+    parser.add_argument("--output", required=True, help="Path of the saved model")
+    parser.add_argument("--low", type=float, default=0.1)
+    parser.add_argument("--high", type=float, default=0.9)
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    texts, labels = [], []
+    for path in args.log:
+        log_texts, log_labels = TuneDecisionLog.read(path)
+        texts += log_texts
+        labels += log_labels
+    if len(set(labels)) < 2:
+        logger.error("The logs need decisions of both kinds")
+        return 1
+
+    report = cross_validate(texts, labels, args.folds, args.low, args.high)
+    print(json.dumps(report, indent=2))
+
+    TuneClassifier.fit(texts, labels).save(args.output)
+    logger.info(f"Saved the classifier trained on {len(texts)} questions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+import math
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def approx_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """Rough number of LLM tokens in text, without loading the LLM's tokenizer."""
+    return math.ceil(len(text) / chars_per_token)
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            number = float(value)
+        else:
+            number = float(str(value).replace(",", ""))
+    except (ValueError, OverflowError):
+        return None
+    # NaN and infinities would show up as "min nan" or "max inf"
+    return number if math.isfinite(number) else None
+
+
+def _format_number(number: float) -> str:
+    return str(int(number)) if number.is_integer() else f"{number:.4g}"
+
+
+def _coarse_to_fine(length: int) -> List[int]:
+    """Indices 0..length-1 ordered first, last, middle, then quarter points..."""
+    order = [0, length - 1] if length > 1 else [0]
+    intervals = deque([(0, length - 1)])
+    while intervals:
+        start, end = intervals.popleft()
+        if end - start < 2:
+            continue
+        middle = (start + end) // 2
+        order.append(middle)
+        intervals.extend([(start, middle), (middle, end)])
+    return order
+
+
+@dataclass
+class ColumnStats:
+    """Statistics of one result column, computed over every row of the table."""
+
+    name: str
+    count: int
+    missing: int
+    distinct: int
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+    mean: Optional[float] = None
+    top_values: List = field(default_factory=list)
+
+    @property
+    def numeric(self) -> bool:
+        return self.minimum is not None
+
+    def describe(self, with_top_values: bool = True) -> str:
+        parts = [f"{self.count} values"]
+        if self.missing:
+            parts.append(f"{self.missing} missing")
+        parts.append(f"{self.distinct} distinct")
+        if self.numeric:
+            parts.append(
+                f"min {_format_number(self.minimum)}, "
+                f"max {_format_number(self.maximum)}, "
+                f"mean {_format_number(self.mean)}"
+            )
+        if self.top_values and with_top_values:
+            top = ", ".join(f"{value} ({count})" for value, count in self.top_values)
+            parts.append(f"top values {top}")
+        return f"{self.name}: {', '.join(parts)}"
+
+
+class TableSummarizer:
+    """Compacts a query result table to a token budget before it goes to the LLM.
+
+    Tables that fit the budget are rendered row by row, as in the few-shot
+    examples. Larger ones are replaced by per-column statistics (counts,
+    min/max, top values) over all rows, followed by as many representative
+    rows as the remaining budget holds: the rows holding the extremes of the
+    numeric columns and the most frequent values of the other columns, then
+    rows spread over the table. Statistics are shortened, then dropped, when
+    they alone would exceed the budget. The prompt thus grows with the budget
+    rather than with the size of the result.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1024,
+        max_rows: int = 30,
+        max_columns: int = 16,
+        max_cell_chars: int = 64,
+        top_values: int = 3,
+        chars_per_token: float = 4.0,
+    ):
+        """Initialize the summarizer.
+
+        Args:
+            max_tokens: Approximate token budget of the rendered table
+            max_rows: Rows shown at most in summarized tables, even if the
+                budget allows more
+            max_columns: Columns kept at most in summarized tables; the
+                others are only counted
+            max_cell_chars: Cell values longer than this are truncated in
+                summarized tables
+            top_values: Most frequent values listed per column
+            chars_per_token: Characters per token of the token estimate
+        """
+        self.max_tokens = max_tokens
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+        self.max_cell_chars = max_cell_chars
+        self.top_values = top_values
+        self.chars_per_token = chars_per_token
+
+    def _tokens(self, text: str) -> int:
+        return approx_tokens(text, self.chars_per_token)
+
+    def _cell(self, value: Any) -> str:
+        text = str(value)
+        if len(text) > self.max_cell_chars:
+            return text[: self.max_cell_chars - 3] + "..."
+        return text
+
+    def _row_line(
+        self, index: int, row: Dict, columns: List[str], truncate: bool = True
+    ) -> str:
+        values = [
+            self._cell(row.get(column)) if truncate else str(row.get(column))
+            for column in columns
+        ]
+        return f"Row {index + 1}: ({', '.join(values)})"
+
+    def _line_cost(self, line: str) -> int:
+        # One more for the line break; summing per line overestimates the
+        # tokens of the joined text, so the budget holds for it too
+        return self._tokens(line) + 1
+
+    def column_stats(self, table: List[Dict], column: str) -> ColumnStats:
+        values = [row.get(column) for row in table]
+        present = [value for value in values if value is not None and value != ""]
+        counts = Counter(self._cell(value) for value in present)
+        stats = ColumnStats(
+            name=column,
+            count=len(present),
+            missing=len(values) - len(present),
+            distinct=len(counts),
+        )
+        numbers = [_as_number(value) for value in present]
+        if numbers and all(number is not None for number in numbers):
+            stats.minimum = min(numbers)
+            stats.maximum = max(numbers)
+            stats.mean = sum(numbers) / len(numbers)
+        # Values seen once say nothing the row count does not
+        stats.top_values = [
+            (value, count)
+            for value, count in counts.most_common(self.top_values)
+            if count > 1
+        ]
+        return stats
+
+    def _representative_rows(
+        self, table: List[Dict], stats: List[ColumnStats]
+    ) -> List[int]:
+        """Row indices in the order they are worth showing, without duplicates."""
+        candidates = []
+        for column in stats:
+            values = [row.get(column.name) for row in table]
+            if column.numeric:
+                numbers = [_as_number(value) for value in values]
+                for extreme in (column.minimum, column.maximum):
+                    candidates.append(numbers.index(extreme))
+            cells = [self._cell(value) for value in values]
+            for top_value, _ in column.top_values:
+                candidates.append(cells.index(top_value))
+        # Then rows spread over the table, so the sample also covers the
+        # typical case; coarse to fine, so a tight budget still spans it all
+        candidates += _coarse_to_fine(len(table))
+        return list(dict.fromkeys(candidates))
+
+    def to_string(self, table: List[Dict]) -> str:
+        """Renders table within the token budget.
+
+        Args:
+            table: List of dictionaries representing table rows
+
+        Returns:
+            Formatted string representation of the table
+        """
+        if not table:
+            return ""
+
+        all_columns = list(table[0].keys())
+        full = self._full(table, all_columns)
+        if full is not None:
+            return full
+        columns = all_columns[: self.max_columns]
+
+        # Everything but the statistics and the rows, the sample title
+        # counted at its longest
+        sample_title = f"Sample Rows ({len(table)} of {len(table)}):"
+        while True:
+            lines = [
+                self._header(columns, all_columns),
+                f"Row Count: {len(table)}.",
+                "Column Statistics:",
+            ]
+            budget = self.max_tokens - sum(
+                self._line_cost(line) for line in lines + [sample_title]
+            )
+            if budget >= 0 or len(columns) == 1:
+                break
+            columns = columns[:-1]
+
+        stats = [self.column_stats(table, column) for column in columns]
+        stat_lines = self._stat_lines(stats, budget)
+        lines += stat_lines
+        budget -= sum(self._line_cost(line) for line in stat_lines)
+
+        shown = {}
+        for index in self._representative_rows(table, stats):
+            if len(shown) == self.max_rows or budget <= 1:
+                break
+            # Only the lines of rows considered for the sample are rendered
+            line = self._row_line(index, table[index], columns)
+            cost = self._line_cost(line)
+            if cost > budget:
+                continue
+            shown[index] = line
+            budget -= cost
+
+        lines.append(f"Sample Rows ({len(shown)} of {len(table)}):")
+        lines += [shown[index] for index in sorted(shown)]
+        logger.debug(
+            f"Summarized a table of {len(table)} rows and {len(all_columns)} "
+            f"columns to {len(shown)} rows and {len(columns)} columns"
+        )
+        return "\n".join(lines) + "\n"
+
+    def _full(self, table: List[Dict], columns: List[str]) -> Optional[str]:
+        """Every row and column of table, or None if that exceeds the budget.
+
+        Tables that fit go to the LLM unchanged. Rows are rendered until the
+        budget is exceeded, so large tables cost little.
+        """
+        lines = [self._header(columns, columns)]
+        length = len(lines[0])
+        for i, row in enumerate(table):
+            lines.append(self._row_line(i, row, columns, truncate=False))
+            # Length of the joined lines so far
+            length += 1 + len(lines[-1])
+            if math.ceil(length / self.chars_per_token) > self.max_tokens:
+                return None
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _header(columns: List[str], all_columns: List[str]) -> str:
+        header = f"Column Names: {', '.join(columns)}."
+        if len(columns) < len(all_columns):
+            header += f" ({len(all_columns) - len(columns)} more columns omitted)"
+        return header
+
+    def _stat_lines(self, stats: List[ColumnStats], budget: int) -> List[str]:
+        """Statistics lines of stats fitting budget.
+
+        Top values are left out first, then the statistics of the last columns.
+        """
+        for with_top_values in (True, False):
+            lines = [f"- {column.describe(with_top_values)}" for column in stats]
+            if sum(self._line_cost(line) for line in lines) <= budget:
+                return lines
+        # Keep a line counting the statistics left out
+        budget -= self._line_cost(f"- ({len(stats)} more columns)")
+        if budget < 0:
+            return []
+        kept = []
+        for line in lines:
+            budget -= self._line_cost(line)
+            if budget < 0:
+                break
+            kept.append(line)
+        if len(kept) < len(stats):
+            kept.append(f"- ({len(stats) - len(kept)} more columns)")
+        return kept
@@ -1,9 +1,11 @@
 import hydra
 import logging
-import requests
+import functools
 from config.path import ABS_CONFIG_DIR
 from omegaconf import DictConfig
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
+from source.conversation.table2text.table_summarizer import TableSummarizer
+from source.serving.llm_gateway import LLMGateway, LLMGatewayError
 
 logger = logging.getLogger(__name__)
 
@@ -11,15 +13,20 @@ logger = logging.getLogger(__name__)
 class Table2Text:
     """Converts database query result tables to natural language summaries using LLM."""
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, gateway: Optional[LLMGateway] = None):
         """Initialize Table2Text with configuration.
 
         Args:
-            cfg: Configuration object with host, port, max_new_tokens, and temperature
+            cfg: Configuration object with host, port, max_new_tokens, temperature,
+                timeout_s and the summarizer budget
+            gateway: Client of the LLM server (default: a private one)
         """
         self.api_address = f"http://{cfg.host}:{cfg.port}"
         self.max_new_tokens = cfg.max_new_tokens
         self.temperature = cfg.temperature
+        self.timeout_s = cfg.timeout_s
+        self.gateway = gateway or LLMGateway()
+        self.summarizer = TableSummarizer(**cfg.summarizer)
 
     @property
     def instruction(self) -> str:
@@ -165,28 +172,34 @@ class Table2Text:
 
         return "\n".join(lines) + "\n"
 
-    def format_user_input(self, table_in_dict: List[Dict]) -> str:
-        """Formats the user input with few-shot examples and the target table.
+    @functools.cached_property
+    def prompt_prefix(self) -> str:
+        """Constant start of the prompt: the instruction and few-shot examples.
 
-        Args:
-            table_in_dict: Table to summarize as list of dictionaries
-
-        Returns:
-            Formatted prompt string with examples and target table
+        Built once, so that it is byte-identical across requests and the LLM
+        server can reuse its cached computation.
         """
         prompt_parts = []
-
-        # Add few-shot examples
         for example in self.few_shot_examples:
             example_table = self.table_to_string(example["table"])
             prompt_parts.append(f"{self.table_prefix}{example_table}")
             prompt_parts.append(f"{self.summary_prefix}{example['summary']}\n")
 
-        # Add target table
-        target_table = self.table_to_string(table_in_dict)
-        prompt_parts.append(f"{self.table_prefix}{target_table}")
+        # Format for LLM (simple concatenation for Llama models)
+        return f"{self.instruction}\n\n" + "\n".join(prompt_parts) + "\n"
+
+    def prompt_suffix(self, table: List[Dict]) -> str:
+        """Variable end of the prompt: the table to summarize.
 
-        return "\n".join(prompt_parts)
+        Args:
+            table: List of dictionaries representing table rows
+
+        Returns:
+            Target table, compacted to the token budget, followed by the summary
+            prefix
+        """
+        target_table = self.summarizer.to_string(table)
+        return f"{self.table_prefix}{target_table}\n{self.summary_prefix}"
 
     def parse_response(self, response: str) -> str:
         """Extracts summary from LLM response.
@@ -201,6 +214,24 @@ class Table2Text:
             return response.split("\n")[0].split(self.summary_prefix)[-1].strip()
         return response.strip()
 
+    def prompt(self, table: List[Dict]) -> str:
+        """Builds the LLM prompt summarizing table.
+
+        Args:
+            table: List of dictionaries representing table rows
+
+        Returns:
+            Prompt ending where the summary should start
+        """
+        return self.prompt_prefix + self.prompt_suffix(table)
+
+    @property
+    def sampling_params(self) -> Dict[str, Any]:
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+        }
+
     def generate(self, table: List[Dict]) -> Optional[str]:
         """Generates a natural language summary for the given table.
 
@@ -214,50 +245,44 @@ class Table2Text:
             logger.warning("Empty table provided for summarization")
             return None
 
-        # Prepare prompts
-        instruction_prompt = self.instruction
-        user_prompt = self.format_user_input(table_in_dict=table)
-
-        # Format for LLM (simple concatenation for Llama models)
-        formatted_prompt = (
-            f"{instruction_prompt}\n\n{user_prompt}\n{self.summary_prefix}"
-        )
-
         try:
-            # Call LLM API
-            response = requests.post(
+            response = self.gateway.generate(
                 f"{self.api_address}/generate",
-                json={
-                    "text": [formatted_prompt],
-                    "sampling_params": {
-                        "max_new_tokens": self.max_new_tokens,
-                        "temperature": self.temperature,
-                    },
-                },
-                timeout=30,
+                self.prompt_suffix(table),
+                self.sampling_params,
+                timeout_s=self.timeout_s,
+                prefix=self.prompt_prefix,
             )
-            response.raise_for_status()
-
-            response_data = response.json()
-
-            if not response_data or not isinstance(response_data, list):
-                logger.error(f"Unexpected API response format: {response_data}")
-                return None
+        except LLMGatewayError as e:
+            logger.error(f"Table summarization failed: {e}")
+            return None
+        return self.parse_response(response)
 
-            generated_text = response_data[0].get("text", "")
-            summary = self.parse_response(generated_text)
+    async def generate_async(self, table: List[Dict]) -> Optional[str]:
+        """Non-blocking variant of generate for the event loop.
 
-            return summary
+        Args:
+            table: List of dictionaries representing table rows
 
-        except requests.exceptions.Timeout:
-            logger.error(f"Request to {self.api_address} timed out")
-            return None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request to {self.api_address} failed: {e}")
+        Returns:
+            Natural language summary of the table, or None if generation fails
+        """
+        if not table:
+            logger.warning("Empty table provided for summarization")
             return None
-        except (KeyError, IndexError, ValueError) as e:
-            logger.error(f"Failed to parse API response: {e}")
+
+        try:
+            response = await self.gateway.generate_async(
+                f"{self.api_address}/generate",
+                self.prompt_suffix(table),
+                self.sampling_params,
+                timeout_s=self.timeout_s,
+                prefix=self.prompt_prefix,
+            )
+        except LLMGatewayError as e:
+            logger.error(f"Table summarization failed: {e}")
             return None
+        return self.parse_response(response)
 
 
 @hydra.main(version_base=None, config_path=ABS_CONFIG_DIR, config_name="config")
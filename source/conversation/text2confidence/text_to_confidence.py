@@ -1,14 +1,12 @@
-import os
-import json
+import attr
 import torch
 import hydra
-import _jsonnet
 from typing import List, Dict, Any
 from config.path import ABS_CONFIG_DIR
 from omegaconf import DictConfig
 from source.utils import token_score_to_noun_score
 from source.text2sql.ratsql.commands.analysis import Attribution
-from source.text2sql.ratsql.commands.infer import Inferer
+from source.text2sql.model_registry import load_experiment_config, model_registry
 from source.text2sql.text_to_sql import Text2SQL
 
 
@@ -33,27 +31,13 @@ class Text2Confidence:
         experiment_config_path = cfg.experiment_config_path
         model_ckpt_dir_path = cfg.model_ckpt_dir_path
 
-        if os.path.isfile(experiment_config_path):
-            exp_config = json.loads(_jsonnet.evaluate_file(experiment_config_path))
-            model_config_file = exp_config["model_config"]
-            model_config_args = exp_config["model_config_args"]
-            model_config = json.loads(
-                _jsonnet.evaluate_file(
-                    model_config_file,
-                    tla_codes={"args": json.dumps(model_config_args)},
-                )
-            )
-            model_config["model"]["encoder_preproc"]["save_path"] = model_ckpt_dir_path
-            model_config["model"]["decoder_preproc"]["save_path"] = model_ckpt_dir_path
-        else:
-            raise RuntimeError(f"config file does not exist: {experiment_config_path}")
+        model_config = load_experiment_config(
+            experiment_config_path, model_ckpt_dir_path
+        )
 
         self.analyser = Attribution(model_config)
 
-        inferer = Inferer(model_config)
-        model, _ = inferer.load_model(model_ckpt_dir_path)
-        model.to(device)
-        self.model = model
+        self.model = model_registry.get_model(model_config, model_ckpt_dir_path, device)
 
     def calculate(self, beams: List[Any], inferred_code: str) -> float:
         """Calculate confidence score from beam search results with heuristic refinement.
@@ -101,6 +85,10 @@ class Text2Confidence:
         Note:
             Retries up to 6 times on failure, falling back to uniform attribution.
         """
+        # The attribution rewrites the question of the items it is given, while
+        # the preprocessed items are shared with other stages; work on copies
+        orig_item = attr.evolve(orig_item)
+        preproc_item = dict(preproc_item)
         while_cnt = 6
         while while_cnt:
             try:
@@ -167,7 +155,7 @@ def main(cfg: DictConfig) -> None:
         "concert_singer",
     )
     calculator = Text2Confidence(cfg.conversation.text2confidence)
-    beams, inferred_code = translator.translate(
+    beams, inferred_code, _ = translator.translate(
         input_text,
         input_text,
         "concert_singer",
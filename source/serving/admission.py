@@ -0,0 +1,136 @@
+import logging
+import threading
+from typing import Callable, List, Optional
+
+from source.serving.metrics import ADMISSIONS
+
+logger = logging.getLogger(__name__)
+
+# Optional stages, in the order they are given up as the load grows
+DEGRADE_ANALYSIS = "analysis"
+DEGRADE_INTENT = "intent"
+DEGRADE_BEAMS = "beams"
+
+
+class Admission:
+    """Slot of one admitted request and the stages it has to do without.
+
+    Release it (or use it as a context manager) once the request is done.
+    """
+
+    def __init__(
+        self,
+        controller: "AdmissionController",
+        degraded: List[str],
+        beam_size: Optional[int],
+    ):
+        self.controller = controller
+        self.degraded = degraded
+        # Beam size to use instead of the configured one (None: configured)
+        self.beam_size = beam_size
+        self._released = False
+
+    def skips(self, stage: str) -> bool:
+        """Whether the optional stage is disabled for this request."""
+        return stage in self.degraded
+
+    def release(self) -> None:
+        """Free the slot. Safe to call more than once."""
+        if not self._released:
+            self._released = True
+            self.controller._release()
+
+    def __enter__(self) -> "Admission":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """Load-aware admission of text-to-SQL requests.
+
+    The load is the larger of two ratios: requests in flight to max_in_flight,
+    and the recent queue wait of the batching worker to target_queue_wait_s.
+    As it grows, admitted requests give up optional stages one after another
+    (the attribution analysis, then the intent model, then wide beam search),
+    so the work per request shrinks before any request has to be turned away.
+    Requests are rejected once max_in_flight requests are in progress, or once
+    the load reaches reject_at, which bounds their wait in the queue even when
+    few of them are in flight.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        target_queue_wait_s: float,
+        degrade_at: List[float],
+        reject_at: float = 2.0,
+        narrow_beam_size: int = 1,
+        queue_wait_fn: Callable[[], float] = lambda: 0.0,
+    ):
+        """Initialize the controller.
+
+        Args:
+            max_in_flight: Number of concurrent requests above which new ones
+                are rejected
+            target_queue_wait_s: Queue wait of the batching worker regarded as
+                full load
+            degrade_at: Loads (between 0 and 1) from which analysis, intent and
+                wide beams are disabled, in that order
+            reject_at: Load from which requests are rejected
+            narrow_beam_size: Beam size used once wide beams are disabled
+            queue_wait_fn: Returns the recent queue wait of the batching worker
+                in seconds
+        """
+        assert len(degrade_at) == 3, "degrade_at needs thresholds for 3 stages"
+        self.max_in_flight = max_in_flight
+        self.target_queue_wait_s = target_queue_wait_s
+        self.degrade_at = list(
+            zip((DEGRADE_ANALYSIS, DEGRADE_INTENT, DEGRADE_BEAMS), degrade_at)
+        )
+        self.reject_at = reject_at
+        self.narrow_beam_size = narrow_beam_size
+        self.queue_wait_fn = queue_wait_fn
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def load(self) -> float:
+        return max(
+            self.in_flight / self.max_in_flight,
+            self.queue_wait_fn() / self.target_queue_wait_s,
+        )
+
+    def try_admit(self) -> Optional[Admission]:
+        """Admit a request, or return None if the server is overloaded."""
+        with self._lock:
+            load = self.load
+            if self.in_flight >= self.max_in_flight or load >= self.reject_at:
+                ADMISSIONS.inc(outcome="rejected")
+                return None
+            self.in_flight += 1
+        degraded = [stage for stage, threshold in self.degrade_at if load >= threshold]
+        ADMISSIONS.inc(outcome="degraded" if degraded else "full")
+        if degraded:
+            logger.info(f"Load {load:.2f}, degrading stages {degraded}")
+        beam_size = self.narrow_beam_size if DEGRADE_BEAMS in degraded else None
+        return Admission(self, degraded, beam_size)
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+
+def build_admission_controller(
+    cfg, queue_wait_fn: Callable[[], float]
+) -> AdmissionController:
+    """Create the admission controller from the serving configuration."""
+    return AdmissionController(
+        max_in_flight=cfg.admission.max_in_flight,
+        target_queue_wait_s=cfg.admission.target_queue_wait_ms / 1000,
+        degrade_at=list(cfg.admission.degrade_at),
+        reject_at=cfg.admission.reject_at,
+        narrow_beam_size=cfg.admission.narrow_beam_size,
+        queue_wait_fn=queue_wait_fn,
+    )
@@ -0,0 +1,164 @@
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple
+from source.serving.metrics import BATCH_SIZE, QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceWorker:
+    """Collects concurrent requests into micro-batches for a batched model call.
+
+    Requests are put on a queue and served by a single background thread. The
+    thread waits for the first request, keeps gathering requests for up to
+    ``batch_window_ms`` milliseconds (or until ``max_batch_size`` is reached),
+    and then hands the whole batch to ``batch_fn`` at once.
+
+    The time requests spend in the queue is recorded in the queue wait metric
+    and as an exponential moving average in ``queue_wait``, a measure of how
+    far the worker lags behind its load.
+    """
+
+    # Weight of the latest batch in the queue_wait moving average
+    QUEUE_WAIT_SMOOTHING = 0.2
+    # Time over which the average halves while no batch is served
+    QUEUE_WAIT_HALF_LIFE_S = 2.0
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Tuple[Any, ...]]], List[Any]],
+        batch_window_ms: float = 5.0,
+        max_batch_size: int = 8,
+        name: str = "inference-worker",
+    ):
+        """Initialize the worker and start its background thread.
+
+        Args:
+            batch_fn: Function mapping a list of argument tuples to a list of results
+            batch_window_ms: How long to wait for more requests after the first one
+            max_batch_size: Maximum number of requests passed to batch_fn at once
+            name: Name of the background thread
+        """
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.batch_fn = batch_fn
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self._queue_wait = 0.0
+        self._queue_wait_at = time.monotonic()
+        self._queue: "queue.Queue[Optional[Tuple[Tuple[Any, ...], Future, float]]]" = (
+            queue.Queue()
+        )
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting to be batched."""
+        return self._queue.qsize()
+
+    @property
+    def queue_wait(self) -> float:
+        """Recent queue wait in seconds.
+
+        The moving average of the served batches decays while the worker is
+        idle, so that a past spike does not count as load with no traffic.
+        The wait of the oldest queued request is a lower bound, so that a
+        stalled worker still shows its load.
+        """
+        now = time.monotonic()
+        average = self._decayed_queue_wait(now)
+        with self._queue.mutex:
+            oldest = self._queue.queue[0] if self._queue.queue else None
+        return max(average, now - oldest[2] if oldest is not None else 0.0)
+
+    def _decayed_queue_wait(self, now: float) -> float:
+        elapsed = now - self._queue_wait_at
+        return self._queue_wait * 0.5 ** (elapsed / self.QUEUE_WAIT_HALF_LIFE_S)
+
+    def submit(self, *args: Any) -> Future:
+        """Enqueue one request.
+
+        Args:
+            *args: Arguments of a single request, as expected by batch_fn
+
+        Returns:
+            Future resolved with the result of this request
+        """
+        future = Future()
+        self._queue.put((args, future, time.monotonic()))
+        return future
+
+    def run(self, *args: Any, timeout: Optional[float] = None) -> Any:
+        """Enqueue one request and block until its result is available."""
+        return self.submit(*args).result(timeout=timeout)
+
+    def stop(self) -> None:
+        """Stop the background thread after the queued requests are served."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self) -> Tuple[List[Tuple[Tuple[Any, ...], Future, float]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self) -> None:
+        stopped = False
+        while not stopped:
+            batch, stopped = self._collect()
+            if batch:
+                self._record_queue_wait([enqueued_at for _, _, enqueued_at in batch])
+            # Skip requests whose caller has given up on them
+            batch = [
+                (args, future)
+                for args, future, _ in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if batch:
+                BATCH_SIZE.observe(len(batch), worker=self.name)
+                self._serve(batch)
+
+    def _record_queue_wait(self, enqueue_times: List[float]) -> None:
+        now = time.monotonic()
+        waits = [now - enqueued_at for enqueued_at in enqueue_times]
+        for wait in waits:
+            QUEUE_WAIT_SECONDS.observe(wait, worker=self.name)
+        average = self._decayed_queue_wait(now)
+        self._queue_wait = average + self.QUEUE_WAIT_SMOOTHING * (max(waits) - average)
+        self._queue_wait_at = now
+
+    def _serve(self, batch: List[Tuple[Tuple[Any, ...], Future]]) -> None:
+        requests = [args for args, _ in batch]
+        try:
+            results = self.batch_fn(requests)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Isolate the failing request instead of failing the whole batch
+            logger.warning(f"Batch of {len(batch)} failed ({e}), retrying one by one")
+            for item in batch:
+                self._serve([item])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,187 @@
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+import msgpack
+import redis
+import redis.asyncio
+from source.serving.memory_redis import AsyncInMemoryRedis, get_in_memory_redis
+
+logger = logging.getLogger(__name__)
+
+TEXT2SQL = "text2sql"
+ANALYSIS = "analysis"
+USER_INTENT = "user_intent"
+TABLE2TEXT = "table2text"
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form of a question: lower-cased with whitespace collapsed."""
+    return " ".join(text.lower().split())
+
+
+def fingerprint(*parts: Any) -> str:
+    """Fixed-size hash of JSON-like parts, used for cache keys and versions."""
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _default(obj: Any) -> Any:
+    # numpy and torch scalars/arrays (e.g. attribution scores)
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Cannot serialize object of type {type(obj).__name__}")
+
+
+def pack(value: Any) -> bytes:
+    """Serialize a JSON-like value with msgpack."""
+    return msgpack.packb(value, default=_default, use_bin_type=True)
+
+
+def unpack(data: bytes) -> Any:
+    """Deserialize a value written by pack."""
+    return msgpack.unpackb(data, raw=False)
+
+
+class ResultCache:
+    """Cached results of the API endpoints, kept in a single Redis database.
+
+    Every cache is a key prefix of the same database, so the entries of several
+    caches for one request are fetched with a single MGET and written with a
+    single pipelined round trip. Values are msgpack encoded and expire after
+    the TTL configured for their cache.
+    """
+
+    def __init__(self, client: redis.Redis, ttls: Dict[str, Optional[int]]):
+        """Initialize the cache on top of an existing Redis client.
+
+        Args:
+            client: Redis client pointing at the cache database
+            ttls: Expiry in seconds of each cache (None for no expiry)
+        """
+        self.client = client
+        self.ttls = ttls
+
+    @staticmethod
+    def _key(cache: str, key: str) -> str:
+        return f"{cache}:{key}"
+
+    def get_many(self, key: str, caches: Iterable[str]) -> Dict[str, Any]:
+        """Fetch the entries of key in several caches with one MGET.
+
+        Returns:
+            Dictionary from cache name to value, containing only the hits
+        """
+        caches = list(caches)
+        values = self.client.mget([self._key(cache, key) for cache in caches])
+        return {
+            cache: unpack(value)
+            for cache, value in zip(caches, values)
+            if value is not None
+        }
+
+    def get(self, cache: str, key: str) -> Optional[Any]:
+        """Return the entry of key in cache, or None on a miss."""
+        return self.get_many(key, [cache]).get(cache)
+
+    def set_many(self, key: str, values: Dict[str, Any]) -> None:
+        """Store the entries of key in several caches in one round trip."""
+        if not values:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for cache, value in values.items():
+            pipe.set(self._key(cache, key), pack(value), ex=self.ttls.get(cache))
+        pipe.execute()
+
+    def set(self, cache: str, key: str, value: Any) -> None:
+        """Store the entry of key in cache."""
+        self.set_many(key, {cache: value})
+
+    def flush(self) -> None:
+        """Remove all cached results."""
+        self.client.flushdb()
+
+
+class AsyncResultCache:
+    """ResultCache for the event loop, with the same layout in Redis."""
+
+    def __init__(self, client: redis.asyncio.Redis, ttls: Dict[str, Optional[int]]):
+        """Initialize the cache on top of an existing asyncio Redis client.
+
+        Args:
+            client: Redis client pointing at the cache database
+            ttls: Expiry in seconds of each cache (None for no expiry)
+        """
+        self.client = client
+        self.ttls = ttls
+
+    async def get_many(self, key: str, caches: Iterable[str]) -> Dict[str, Any]:
+        """Fetch the entries of key in several caches with one MGET."""
+        caches = list(caches)
+        values = await self.client.mget(
+            [ResultCache._key(cache, key) for cache in caches]
+        )
+        return {
+            cache: unpack(value)
+            for cache, value in zip(caches, values)
+            if value is not None
+        }
+
+    async def get(self, cache: str, key: str) -> Optional[Any]:
+        """Return the entry of key in cache, or None on a miss."""
+        return (await self.get_many(key, [cache])).get(cache)
+
+    async def set_many(self, key: str, values: Dict[str, Any]) -> None:
+        """Store the entries of key in several caches in one round trip."""
+        if not values:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for cache, value in values.items():
+            pipe.set(ResultCache._key(cache, key), pack(value), ex=self.ttls.get(cache))
+        await pipe.execute()
+
+    async def set(self, cache: str, key: str, value: Any) -> None:
+        """Store the entry of key in cache."""
+        await self.set_many(key, {cache: value})
+
+
+def build_result_cache(redis_cfg) -> ResultCache:
+    """Create the result cache from the Redis configuration.
+
+    Args:
+        redis_cfg: Redis configuration with host, port, cache_db, max_connections
+            and the per-cache ttl_s
+
+    Returns:
+        ResultCache whose connections come from one shared, bounded pool, or
+        one kept in process memory if redis.backend is "memory"
+    """
+    ttls = {cache: ttl for cache, ttl in redis_cfg.ttl_s.items()}
+    if redis_cfg.backend == "memory":
+        return ResultCache(get_in_memory_redis(redis_cfg.cache_db), ttls)
+    pool = redis.BlockingConnectionPool(
+        host=redis_cfg.host,
+        port=redis_cfg.port,
+        db=redis_cfg.cache_db,
+        max_connections=redis_cfg.max_connections,
+    )
+    return ResultCache(redis.StrictRedis(connection_pool=pool), ttls)
+
+
+def build_async_result_cache(redis_cfg) -> AsyncResultCache:
+    """Create the result cache used by the asynchronous server.
+
+    Must be called from the event loop that uses it.
+    """
+    ttls = {cache: ttl for cache, ttl in redis_cfg.ttl_s.items()}
+    if redis_cfg.backend == "memory":
+        client = AsyncInMemoryRedis(get_in_memory_redis(redis_cfg.cache_db))
+        return AsyncResultCache(client, ttls)
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=redis_cfg.host,
+        port=redis_cfg.port,
+        db=redis_cfg.cache_db,
+        max_connections=redis_cfg.max_connections,
+    )
+    return AsyncResultCache(redis.asyncio.StrictRedis(connection_pool=pool), ttls)
@@ -0,0 +1,111 @@
+import os
+import re
+import random
+import asyncio
+import logging
+from collections import deque
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+_TUNE_PATTERN = re.compile(r"tun(e|ing)|optimi[sz]e|performance|slow", re.I)
+
+# Characters per token of the simulated tokenizer
+CHARS_PER_TOKEN = 4
+
+
+class _PrefixCache:
+    """Recent prompts, standing in for the radix cache of sglang.
+
+    The cached part of a prompt is its longest common prefix with a prompt
+    whose prefill has finished.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.prompts = deque(maxlen=capacity)
+
+    def cached_chars(self, prompt: str) -> int:
+        return max(
+            (len(os.path.commonprefix([prompt, seen])) for seen in self.prompts),
+            default=0,
+        )
+
+    def add(self, prompt: str) -> None:
+        self.prompts.append(prompt)
+
+
+def fake_llm_app(
+    latency_ms: float = 50, failure_rate: float = 0, prefill_ms_per_1k: float = 0
+) -> web.Application:
+    """aiohttp app answering /generate like the sglang server of the LLM.
+
+    Tune check prompts are answered with f_tune([True]) when the question
+    mentions tuning or performance, and f_tune([False]) otherwise; any other
+    prompt (table-to-text) gets a fixed summary. Like sglang, the answers
+    report the prompt tokens and how many of them were cached in meta_info.
+
+    Args:
+        latency_ms: Simulated generation time of each request, whatever the
+            number of prompts it holds
+        failure_rate: Share of requests answered with 503, as by an overloaded
+            server
+        prefill_ms_per_1k: Simulated prefill time per thousand uncached
+            prompt tokens
+    """
+    prefix_cache = _PrefixCache()
+
+    async def generate(request: web.Request) -> web.Response:
+        body = await request.json()
+        prompts = body["text"] if isinstance(body["text"], list) else [body["text"]]
+        outputs = []
+        uncached_tokens = 0
+        for prompt in prompts:
+            prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+            cached_tokens = prefix_cache.cached_chars(prompt) // CHARS_PER_TOKEN
+            uncached_tokens += prompt_tokens - cached_tokens
+            if "f_tune" in prompt:
+                # The question follows the few-shot examples on the last user line
+                questions = re.findall(r"^\s*user: (.*)$", prompt, re.M)
+                is_tune = bool(questions and _TUNE_PATTERN.search(questions[-1]))
+                text = f"f_tune([{is_tune}])"
+            else:
+                text = "The table lists the requested rows."
+            outputs.append(
+                {
+                    "text": text,
+                    "meta_info": {
+                        "prompt_tokens": prompt_tokens,
+                        "cached_tokens": cached_tokens,
+                    },
+                }
+            )
+        await asyncio.sleep(
+            (latency_ms + prefill_ms_per_1k * uncached_tokens / 1000) / 1000
+        )
+        if random.random() < failure_rate:
+            return web.json_response({"error": "overloaded"}, status=503)
+        for prompt in prompts:
+            prefix_cache.add(prompt)
+        return web.json_response(outputs)
+
+    app = web.Application()
+    app.router.add_post("/generate", generate)
+    return app
+
+
+def run_fake_llm(
+    host: str,
+    port: int,
+    latency_ms: float = 50,
+    failure_rate: float = 0,
+    prefill_ms_per_1k: float = 0,
+) -> None:
+    """Serve fake_llm_app until interrupted."""
+    logger.info(f"Fake LLM listening on {host}:{port} ({latency_ms} ms per request)")
+    web.run_app(
+        fake_llm_app(latency_ms, failure_rate, prefill_ms_per_1k),
+        host=host,
+        port=port,
+        print=None,
+    )
@@ -0,0 +1,146 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from source.serving.lru import TTLCache
+from source.serving.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+
+def _follow(job: Future) -> Future:
+    """New future completed with the outcome of job.
+
+    Cancelling it leaves job running, so callers can stop waiting for a job
+    shared with other requests without affecting them.
+    """
+    follower = Future()
+
+    def copy(job: Future) -> None:
+        if job.cancelled():
+            follower.cancel()
+        elif follower.set_running_or_notify_cancel():
+            if job.exception() is not None:
+                follower.set_exception(job.exception())
+            else:
+                follower.set_result(job.result())
+
+    job.add_done_callback(copy)
+    return follower
+
+
+class JobQueue:
+    """Background jobs whose results are stored in a result cache.
+
+    A job is identified by the cache key of its result, so submitting a job
+    that is already queued or running joins it instead of starting a second
+    one, and finished jobs are looked up in the cache. Failures are kept for a
+    while so that pollers can tell them apart from unknown jobs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        result_cache,
+        cache: str,
+        workers: int = 1,
+        max_pending: int = 256,
+        failure_ttl_s: float = 300,
+    ):
+        """Initialize the queue and its worker threads.
+
+        Args:
+            name: Name of the job type, used for the thread names and as the
+                stage name of the job latency metric
+            result_cache: ResultCache the results are written to
+            cache: Name of the cache of the results in result_cache
+            workers: Number of jobs run at the same time
+            max_pending: Number of queued and running jobs above which new jobs
+                are refused
+            failure_ttl_s: How long the errors of failed jobs are kept
+        """
+        self.name = name
+        self.result_cache = result_cache
+        self.cache = cache
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._jobs: Dict[str, Future] = {}
+        self._failures = TTLCache(maxsize=max_pending, ttl_seconds=failure_ttl_s)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of queued and running jobs."""
+        return len(self._jobs)
+
+    def submit(self, job_id: str, fn: Callable[..., Any], *args) -> Optional[Future]:
+        """Run fn(*args) in the background as job job_id, unless already running.
+
+        Returns:
+            Future of the job result, which the caller may cancel to stop
+            waiting, or None if the queue is full
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                if len(self._jobs) >= self.max_pending:
+                    logger.warning(f"{self.name} queue full, refusing job {job_id}")
+                    return None
+                job = self.executor.submit(self._run, job_id, fn, *args)
+                self._jobs[job_id] = job
+        return _follow(job)
+
+    def _run(self, job_id: str, fn: Callable[..., Any], *args) -> Any:
+        try:
+            result = timed(self.name, fn, *args)
+            self.result_cache.set(self.cache, job_id, result)
+            return result
+        except Exception as e:
+            logger.exception(f"{self.name} job {job_id} failed")
+            self._failures.set(job_id, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            # The result or error is stored by now, so status stays consistent
+            with self._lock:
+                del self._jobs[job_id]
+
+    def watch(self, job_id: str) -> Optional[Future]:
+        """Future of job job_id if it is queued or running, else None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return _follow(job) if job is not None else None
+
+    def status(self, job_id: str) -> Tuple[str, Any]:
+        """State of job job_id and its result (or error).
+
+        Returns:
+            (PENDING | RUNNING, None), (DONE, result), (FAILED, error) or
+            (UNKNOWN, None) for jobs never submitted or expired from the cache
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return (RUNNING if job.running() else PENDING), None
+        result = self.result_cache.get(self.cache, job_id)
+        if result is not None:
+            return DONE, result
+        error = self._failures.get(job_id)
+        if error is not None:
+            return FAILED, error
+        return UNKNOWN, None
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Tuple[str, Any]:
+        """status(job_id) after waiting up to timeout seconds for the job."""
+        job = self.watch(job_id)
+        if job is not None:
+            try:
+                job.result(timeout=timeout)
+            except Exception:
+                pass
+        return self.status(job_id)
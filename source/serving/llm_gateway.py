@@ -0,0 +1,390 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from source.serving.metrics import BATCH_SIZE, LLM_PROMPT_TOKENS, LLM_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth another attempt: the server is overloaded or restarting
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Time allowed to the request loading a prompt prefix into the server cache
+PRIME_TIMEOUT_S = 30
+
+# Time blocking callers wait beyond the deadline of their prompt, for the
+# gateway to report its own timeout first
+RESULT_GRACE_S = 1
+
+
+class LLMGatewayError(RuntimeError):
+    """Raised when the LLM server gives no answer before the deadline."""
+
+
+def _describe(error: Exception) -> str:
+    return str(error) or type(error).__name__
+
+
+class _Pending:
+    """Prompts waiting to be sent together to one address with the same sampling."""
+
+    def __init__(self):
+        self.prompts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.deadline = float("inf")
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class LLMGateway:
+    """Client of the sglang /generate endpoints shared by all LLM callers.
+
+    Requests run on an event loop of their own, in a background thread, so
+    the same client serves the threaded server (generate) and the event loop
+    of the async one (generate_async). It keeps connections to the LLM servers
+    alive across requests, bounds the number of requests in flight, retries
+    failed requests with jittered backoff while their deadline allows, and can
+    merge prompts arriving within batch_window_ms into one batched call.
+
+    Prompts may be split into a constant prefix (instruction and few-shot
+    examples) and a variable part. The server (sglang, with its radix cache)
+    reuses the computation of a prompt prefix it has already seen, so before
+    the first prompt with a given prefix, the gateway sends the prefix on its
+    own and makes the prompts arriving meanwhile wait for it. Every prompt
+    then only prefills its variable part, including the first concurrent
+    ones, which would otherwise all compute the prefix. The server evicts
+    cached prefixes under memory pressure, so a prefix is primed again once
+    prime_ttl_s has passed.
+    """
+
+    def __init__(
+        self,
+        connections: int = 64,
+        max_concurrency: int = 16,
+        retries: int = 2,
+        backoff_ms: float = 100,
+        batch_window_ms: float = 0,
+        max_batch_size: int = 8,
+        prime_prefixes: bool = True,
+        prime_ttl_s: float = 300,
+        max_primed: int = 256,
+    ):
+        """Initialize the gateway and start its event loop thread.
+
+        Args:
+            connections: Connections kept open to the LLM servers
+            max_concurrency: Requests sent to the LLM servers at once; the
+                others wait for a slot
+            retries: Attempts made after a failed one, deadline permitting
+            backoff_ms: Base delay before a retry, doubled per attempt and
+                drawn uniformly below that bound (full jitter)
+            batch_window_ms: How long a prompt waits for others to share its
+                request; 0 sends every prompt on its own
+            max_batch_size: Prompts sent at most in one request
+            prime_prefixes: Send each prompt prefix on its own before its
+                first prompt, for the server to cache it
+            prime_ttl_s: Time after which a prefix is primed again
+            max_primed: Prefixes remembered as primed at most; the least
+                recently used ones are primed again when next used
+        """
+        self.connections = connections
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff_ms / 1000
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.prime_prefixes = prime_prefixes
+        self.prime_ttl = prime_ttl_s
+        self.max_primed = max_primed
+        # Priming request and time it was sent, by address and prefix, least
+        # recently used first
+        self._primed: "OrderedDict[Tuple[str, str], Tuple[asyncio.Task, float]]" = (
+            OrderedDict()
+        )
+        self._pending: Dict[Tuple[str, str], _Pending] = {}
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_loop, name="llm-gateway", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._open())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _open(self) -> None:
+        # Timeouts are set per request, from the deadline of its prompts
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.connections, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=None),
+        )
+        self._limiter = asyncio.Semaphore(self.max_concurrency)
+
+    def close(self) -> None:
+        """Close the connections and stop the event loop thread."""
+        if not self._loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def submit(
+        self,
+        address: str,
+        prompt: str,
+        sampling_params: Dict[str, Any],
+        timeout_s: float = 30,
+        prefix: str = "",
+    ) -> Future:
+        """Start generating from prompt.
+
+        Args:
+            address: /generate URL of the LLM server
+            prompt: Prompt to complete, after prefix
+            sampling_params: sglang sampling parameters (max_new_tokens, ...)
+            timeout_s: Time allowed for the answer, retries included
+            prefix: Start of the prompt shared by many requests, byte for byte.
+                It should end at a line break, so that it is tokenized the same
+                on its own and followed by prompt.
+
+        Returns:
+            Future resolved with the generated text, or failed with
+            LLMGatewayError
+        """
+        deadline = time.monotonic() + timeout_s
+        return asyncio.run_coroutine_threadsafe(
+            self._generate(address, prefix, prompt, sampling_params, deadline),
+            self._loop,
+        )
+
+    def generate(
+        self,
+        address: str,
+        prompt: str,
+        sampling_params: Dict[str, Any],
+        timeout_s: float = 30,
+        prefix: str = "",
+    ) -> str:
+        """Blocking variant of submit, returning the generated text.
+
+        Raises:
+            LLMGatewayError: If no answer came before the deadline, even if the
+                event loop thread is stalled
+        """
+        future = self.submit(address, prompt, sampling_params, timeout_s, prefix)
+        try:
+            return future.result(timeout=timeout_s + RESULT_GRACE_S)
+        except concurrent.futures.TimeoutError as e:
+            future.cancel()
+            LLM_REQUESTS.inc(outcome="error")
+            raise LLMGatewayError(
+                f"No answer from {address} within {timeout_s} s"
+            ) from e
+
+    async def generate_async(
+        self,
+        address: str,
+        prompt: str,
+        sampling_params: Dict[str, Any],
+        timeout_s: float = 30,
+        prefix: str = "",
+    ) -> str:
+        """Variant of generate awaitable from any event loop."""
+        future = self.submit(address, prompt, sampling_params, timeout_s, prefix)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout_s + RESULT_GRACE_S
+            )
+        except asyncio.TimeoutError as e:
+            future.cancel()
+            LLM_REQUESTS.inc(outcome="error")
+            raise LLMGatewayError(
+                f"No answer from {address} within {timeout_s} s"
+            ) from e
+
+    async def _prime(self, address: str, prefix: str, deadline: float) -> None:
+        """Have the server cache prefix, once per address and prefix."""
+        key = (address, prefix)
+        now = time.monotonic()
+        task, primed_at = self._primed.get(key, (None, 0.0))
+        if task is None or (task.done() and now - primed_at > self.prime_ttl):
+            task = self._loop.create_task(
+                self._post(
+                    address, [prefix], {"max_new_tokens": 1}, now + PRIME_TIMEOUT_S
+                )
+            )
+            # Failures are reported to the waiting prompts, if any are left
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._primed[key] = (task, now)
+            while len(self._primed) > self.max_primed:
+                self._primed.popitem(last=False)
+        self._primed.move_to_end(key)
+        try:
+            # Leave the prompt half of its time, should the server be slow
+            await asyncio.wait_for(
+                asyncio.shield(task), max(deadline - time.monotonic(), 0) / 2
+            )
+        except asyncio.TimeoutError:
+            pass
+        except LLMGatewayError as e:
+            # Tried again by the next prompt; this one goes on uncached
+            logger.warning(f"Could not cache a prompt prefix on {address}: {e}")
+            if self._primed.get(key, (None,))[0] is task:
+                del self._primed[key]
+
+    async def _generate(
+        self,
+        address: str,
+        prefix: str,
+        prompt: str,
+        sampling_params: Dict[str, Any],
+        deadline: float,
+    ) -> str:
+        if prefix and self.prime_prefixes:
+            await self._prime(address, prefix, deadline)
+        prompt = prefix + prompt
+        if self.batch_window <= 0:
+            return (await self._post(address, [prompt], sampling_params, deadline))[0]
+
+        # Prompts can only share a request if they share sampling parameters
+        key = (address, json.dumps(sampling_params, sort_keys=True))
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _Pending()
+            pending.timer = self._loop.call_later(
+                self.batch_window, self._flush, key, sampling_params
+            )
+        future = self._loop.create_future()
+        pending.prompts.append(prompt)
+        pending.futures.append(future)
+        pending.deadline = min(pending.deadline, deadline)
+        if len(pending.prompts) >= self.max_batch_size:
+            pending.timer.cancel()
+            self._flush(key, sampling_params)
+        return await future
+
+    def _flush(self, key: Tuple[str, str], sampling_params: Dict[str, Any]) -> None:
+        pending = self._pending.pop(key)
+        self._loop.create_task(self._send_batch(key[0], pending, sampling_params))
+
+    async def _send_batch(
+        self, address: str, pending: _Pending, sampling_params: Dict[str, Any]
+    ) -> None:
+        BATCH_SIZE.observe(len(pending.prompts), worker="llm")
+        try:
+            texts = await self._post(
+                address, pending.prompts, sampling_params, pending.deadline
+            )
+        except Exception as e:
+            for future in pending.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, text in zip(pending.futures, texts):
+            if not future.done():
+                future.set_result(text)
+
+    async def _acquire_slot(self, address: str, deadline: float) -> None:
+        """Wait for a request slot, no longer than until deadline."""
+        try:
+            await asyncio.wait_for(
+                self._limiter.acquire(), max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError as e:
+            LLM_REQUESTS.inc(outcome="error")
+            raise LLMGatewayError(
+                f"No free slot for a request to {address} before the deadline"
+            ) from e
+
+    async def _post(
+        self,
+        address: str,
+        prompts: List[str],
+        sampling_params: Dict[str, Any],
+        deadline: float,
+    ) -> List[str]:
+        """Send prompts in one /generate request, retrying until deadline."""
+        body = {"text": prompts, "sampling_params": sampling_params}
+        attempt = 0
+        while True:
+            try:
+                await self._acquire_slot(address, deadline)
+                try:
+                    async with self._session.post(
+                        address,
+                        json=body,
+                        timeout=aiohttp.ClientTimeout(
+                            total=max(deadline - time.monotonic(), 0.001)
+                        ),
+                    ) as response:
+                        response.raise_for_status()
+                        outputs = await response.json()
+                finally:
+                    self._limiter.release()
+                texts = [output["text"] for output in outputs]
+                if len(texts) != len(prompts):
+                    raise ValueError(f"{len(texts)} outputs for {len(prompts)} prompts")
+                for output in outputs:
+                    meta_info = output.get("meta_info", {})
+                    if "prompt_tokens" in meta_info:
+                        cached = meta_info.get("cached_tokens", 0)
+                        LLM_PROMPT_TOKENS.inc(cached, cache="hit")
+                        LLM_PROMPT_TOKENS.inc(
+                            meta_info["prompt_tokens"] - cached, cache="miss"
+                        )
+                LLM_REQUESTS.inc(outcome="ok")
+                return texts
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUSES:
+                    LLM_REQUESTS.inc(outcome="error")
+                    raise LLMGatewayError(f"Request to {address} failed: {e}") from e
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except (ValueError, KeyError, TypeError) as e:
+                LLM_REQUESTS.inc(outcome="error")
+                raise LLMGatewayError(f"Malformed answer from {address}: {e}") from e
+
+            if attempt >= self.retries or time.monotonic() >= deadline:
+                LLM_REQUESTS.inc(outcome="error")
+                raise LLMGatewayError(
+                    f"Request to {address} failed: {_describe(error)}"
+                )
+            attempt += 1
+            LLM_REQUESTS.inc(outcome="retry")
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            logger.warning(
+                f"Request to {address} failed ({_describe(error)}), "
+                f"retry {attempt}/{self.retries} in {delay * 1000:.0f} ms"
+            )
+            await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+
+
+def build_llm_gateway(serving_cfg) -> LLMGateway:
+    """LLMGateway configured by serving.llm."""
+    cfg = serving_cfg.llm
+    return LLMGateway(
+        connections=cfg.connections,
+        max_concurrency=cfg.max_concurrency,
+        retries=cfg.retries,
+        backoff_ms=cfg.backoff_ms,
+        batch_window_ms=cfg.batch_window_ms,
+        max_batch_size=cfg.max_batch_size,
+        prime_prefixes=cfg.prime_prefixes,
+        prime_ttl_s=cfg.prime_ttl_s,
+        max_primed=cfg.max_primed,
+    )
@@ -0,0 +1,52 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a fixed idle time."""
+
+    def __init__(self, maxsize: int, ttl_seconds: Optional[float] = None):
+        """Initialize an empty cache.
+
+        Args:
+            maxsize: Maximum number of entries; the least recently used is evicted
+            ttl_seconds: Idle time after which an entry expires (None for never)
+        """
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the value of key and mark it as recently used."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, last_access = entry
+            if self.ttl_seconds is not None and now - last_access > self.ttl_seconds:
+                del self._entries[key]
+                return default
+            self._entries[key] = (value, now)
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Insert or replace the value of key, evicting old entries if needed."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove key and return its value."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
@@ -0,0 +1,117 @@
+import time
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+Value = Union[bytes, str]
+
+
+class InMemoryRedis:
+    """The subset of the redis.Redis API used by the caches and session store.
+
+    Data lives in process memory, so it is only a stand-in for Redis in
+    single-process setups such as load tests on a laptop.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(value: Value) -> bytes:
+        return value.encode("utf-8") if isinstance(value, str) else value
+
+    def _get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def getex(self, key: str, ex: Optional[int] = None) -> Optional[bytes]:
+        with self._lock:
+            value = self._get(key)
+            if value is not None and ex is not None:
+                self._data[key] = (value, time.monotonic() + ex)
+            return value
+
+    def set(self, key: str, value: Value, ex: Optional[int] = None) -> bool:
+        expires_at = time.monotonic() + ex if ex is not None else None
+        with self._lock:
+            self._data[key] = (self._encode(value), expires_at)
+        return True
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def flushdb(self) -> bool:
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def pipeline(self, transaction: bool = True) -> "InMemoryPipeline":
+        return InMemoryPipeline(self)
+
+
+class InMemoryPipeline:
+    """Buffers set commands and applies them on execute."""
+
+    def __init__(self, client: InMemoryRedis):
+        self.client = client
+        self._commands: List[Tuple[str, Value, Optional[int]]] = []
+
+    def set(self, key: str, value: Value, ex: Optional[int] = None) -> None:
+        self._commands.append((key, value, ex))
+
+    def execute(self) -> List[bool]:
+        return [self.client.set(*command) for command in self._commands]
+
+
+class AsyncInMemoryRedis:
+    """redis.asyncio-style wrapper around an InMemoryRedis."""
+
+    def __init__(self, client: InMemoryRedis):
+        self.client = client
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self.client.mget(keys)
+
+    async def set(self, key: str, value: Value, ex: Optional[int] = None) -> bool:
+        return self.client.set(key, value, ex=ex)
+
+    def pipeline(self, transaction: bool = True) -> "AsyncInMemoryPipeline":
+        return AsyncInMemoryPipeline(self.client)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class AsyncInMemoryPipeline(InMemoryPipeline):
+    async def execute(self) -> List[bool]:
+        return super().execute()
+
+
+_databases: Dict[int, InMemoryRedis] = {}
+_databases_lock = threading.Lock()
+
+
+def get_in_memory_redis(db: int) -> InMemoryRedis:
+    """Return the process-wide in-memory database number db."""
+    with _databases_lock:
+        if db not in _databases:
+            _databases[db] = InMemoryRedis()
+        return _databases[db]
@@ -0,0 +1,264 @@
+import time
+import bisect
+import threading
+import contextlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        assert set(labels) == set(
+            self.label_names
+        ), f"{self.name} expects labels {self.label_names}, got {tuple(labels)}"
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ] + self._samples()
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of cache hits."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {value}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """Current value read from a callback at scrape time, e.g. a queue depth."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]):
+        super().__init__(name, documentation, ())
+        self.fn = fn
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name} {float(self.fn())}"]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, e.g. stage latencies."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: counts of each bucket (+Inf last), sum, count
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            counts, total = self._series[key]
+            counts[index] += 1
+            total[0] += value
+            total[1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the wall-clock duration of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            series = {
+                key: (list(counts), list(total))
+                for key, (counts, total) in self._series.items()
+            }
+        samples = []
+        for key, (counts, (total, count)) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.label_names, key, le=le)
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            samples.append(f"{self.name}_sum{labels} {total}")
+            samples.append(f"{self.name}_count{labels} {count}")
+        return samples
+
+
+class MetricsRegistry:
+    """Named metrics of the process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name: str, documentation: str, fn: Callable[[], float]) -> Gauge:
+        """Register (or replace) a gauge reading its value from fn."""
+        return self._register(Gauge(name, documentation, fn))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "text2sql_stage_seconds",
+    "Latency of each stage of a request.",
+    ["stage"],
+)
+REQUEST_SECONDS = registry.histogram(
+    "text2sql_request_seconds",
+    "End-to-end latency of each endpoint.",
+    ["endpoint"],
+)
+CACHE_LOOKUPS = registry.counter(
+    "text2sql_cache_lookups_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ["cache", "result"],
+)
+ADMISSIONS = registry.counter(
+    "text2sql_admissions_total",
+    "Text-to-SQL requests by admission outcome (full, degraded or rejected).",
+    ["outcome"],
+)
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "text2sql_queue_wait_seconds",
+    "Time requests wait in the queue of a batching worker.",
+    ["worker"],
+)
+ROUTED_REQUESTS = registry.counter(
+    "text2sql_routed_requests_total",
+    "Requests forwarded by the worker pool router, by worker.",
+    ["worker"],
+)
+LLM_REQUESTS = registry.counter(
+    "text2sql_llm_requests_total",
+    "Requests of the LLM gateway, by outcome (ok, retry, error).",
+    ["outcome"],
+)
+LLM_PROMPT_TOKENS = registry.counter(
+    "text2sql_llm_prompt_tokens_total",
+    "Prompt tokens sent to the LLM, by whether the server had them cached (hit, miss).",
+    ["cache"],
+)
+TUNE_CHECKS = registry.counter(
+    "text2sql_tune_checks_total",
+    "Tune checks, by what decided them (classifier, llm).",
+    ["decided_by"],
+)
+BATCH_SIZE = registry.histogram(
+    "text2sql_batch_size",
+    "Number of requests per micro-batch.",
+    ["worker"],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+
+def stage_timer(stage: str):
+    """Context manager recording the duration of a stage in STAGE_SECONDS."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def timed(stage: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call fn(*args, **kwargs), recording its duration as stage."""
+    with stage_timer(stage):
+        return fn(*args, **kwargs)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    """Count one lookup of cache in CACHE_LOOKUPS."""
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
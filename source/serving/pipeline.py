@@ -0,0 +1,70 @@
+import logging
+from concurrent.futures import Executor, Future, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from source.serving.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    """Concurrently running stages of a single request.
+
+    Each stage is a named future, either run on the shared executor or handed
+    in from elsewhere (e.g. an InferenceWorker). Stages started speculatively
+    can be cancelled together once their results are known to be unneeded.
+    """
+
+    def __init__(self, executor: Executor):
+        """Initialize an empty graph.
+
+        Args:
+            executor: Executor shared by the stages of all requests
+        """
+        self.executor = executor
+        self.stages: Dict[str, Future] = {}
+
+    def submit(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Start fn(*args, **kwargs) on the executor as stage name.
+
+        The run time of the stage (excluding its wait for a free thread) is
+        recorded in the stage latency histogram.
+        """
+        return self.add(name, self.executor.submit(timed, name, fn, *args, **kwargs))
+
+    def add(self, name: str, future: Future) -> Future:
+        """Track an already scheduled future as stage name."""
+        assert name not in self.stages, f"Stage {name} already started"
+        self.stages[name] = future
+        return future
+
+    def started(self, name: str) -> bool:
+        """Whether stage name has been started."""
+        return name in self.stages
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        """Block until stage name finishes and return its result."""
+        return self.stages[name].result(timeout=timeout)
+
+    def as_completed(self, names: Iterable[str]) -> Iterator[str]:
+        """Yield the names of the started stages among names as they finish."""
+        futures = {self.stages[name]: name for name in names if name in self.stages}
+        for future in as_completed(futures):
+            yield futures[future]
+
+    def cancel(self) -> List[str]:
+        """Cancel all unfinished stages.
+
+        Stages that already started running cannot be interrupted; they finish
+        in the background and their results are discarded.
+
+        Returns:
+            Names of the stages that were still unfinished
+        """
+        unfinished = []
+        for name, future in self.stages.items():
+            if not future.done():
+                future.cancel()
+                unfinished.append(name)
+        if unfinished:
+            logger.info(f"Cancelled speculative stages: {unfinished}")
+        return unfinished
@@ -0,0 +1,306 @@
+import os
+import asyncio
+import logging
+import itertools
+import subprocess
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from source.serving import metrics
+from source.serving.cache import fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Headers describing the connection to the worker rather than the response
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-length",
+    "content-encoding",
+    "keep-alive",
+    "transfer-encoding",
+}
+
+# Seconds between checks for exited worker processes
+SUPERVISE_INTERVAL_S = 5
+
+
+def affinity_worker(db_id: str, num_workers: int) -> int:
+    """Index of the worker serving requests on db_id.
+
+    Stable across processes and restarts (unlike hash()), so a database keeps
+    hitting the worker whose schema caches already hold it.
+    """
+    return int(fingerprint(db_id)[:8], 16) % num_workers
+
+
+class WorkerPool:
+    """Model server processes started from the same command on their own ports.
+
+    Each worker is the backend server itself, run with host, port and the
+    given overrides appended to command. Workers that exit are started again.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        num_workers: int,
+        host: str,
+        base_port: int,
+        devices: Optional[List[str]] = None,
+        threads_per_worker: Optional[int] = None,
+        cwd: Optional[str] = None,
+    ):
+        """Initialize the pool without starting the workers.
+
+        Args:
+            command: Command starting a backend server, without host and port.
+                "{index}" in an argument is replaced by the worker index.
+            num_workers: Number of worker processes
+            host: Host the workers listen on
+            base_port: Port of the first worker; worker i listens on
+                base_port + i
+            devices: CUDA devices assigned round-robin to the workers (through
+                CUDA_VISIBLE_DEVICES). Empty or None leaves them unchanged.
+            threads_per_worker: Intra-op threads of each worker (OMP and MKL),
+                so CPU workers do not oversubscribe the cores. None leaves the
+                library defaults.
+            cwd: Working directory of the workers
+        """
+        self.command = command
+        self.num_workers = num_workers
+        self.host = host
+        self.base_port = base_port
+        self.devices = list(devices or [])
+        self.threads_per_worker = threads_per_worker
+        self.cwd = cwd
+        self.processes: List[Optional[subprocess.Popen]] = [None] * num_workers
+
+    @property
+    def urls(self) -> List[str]:
+        return [
+            f"http://{self.host}:{self.base_port + i}" for i in range(self.num_workers)
+        ]
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        if self.devices:
+            env["CUDA_VISIBLE_DEVICES"] = str(self.devices[index % len(self.devices)])
+        if self.threads_per_worker:
+            env["OMP_NUM_THREADS"] = str(self.threads_per_worker)
+            env["MKL_NUM_THREADS"] = str(self.threads_per_worker)
+        return env
+
+    def _spawn(self, index: int) -> None:
+        command = [part.replace("{index}", str(index)) for part in self.command]
+        command += [
+            f"host={self.host}",
+            f"port={self.base_port + index}",
+        ]
+        logger.info(f"Starting worker {index}: {' '.join(command)}")
+        self.processes[index] = subprocess.Popen(
+            command, env=self._worker_env(index), cwd=self.cwd
+        )
+
+    def start(self) -> None:
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+    def restart_exited(self) -> None:
+        """Start again the workers whose process has exited."""
+        for index, process in enumerate(self.processes):
+            if process is not None and process.poll() is not None:
+                logger.warning(
+                    f"Worker {index} exited with code {process.returncode}, restarting"
+                )
+                self._spawn(index)
+
+    def alive(self) -> int:
+        """Number of running worker processes."""
+        return sum(
+            process is not None and process.poll() is None for process in self.processes
+        )
+
+    def stop(self) -> None:
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+class AffinityRouter:
+    """Front server forwarding requests to the workers of a WorkerPool.
+
+    Text-to-SQL requests go to the worker chosen by affinity_worker for their
+    db_id, so each worker only preprocesses, caches and holds the sqlite copies
+    of its share of the databases. History resets are sent to every worker,
+    /analysis polls ask the workers until one knows the job, and the rest of
+    the endpoints are spread round-robin.
+    """
+
+    def __init__(self, pool: WorkerPool, retry_after_s: float = 2):
+        """Initialize the router.
+
+        Args:
+            pool: Workers to forward to
+            retry_after_s: Retry-After of the 503 sent when a worker is
+                unreachable
+        """
+        self.pool = pool
+        self.retry_after_s = retry_after_s
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._round_robin = itertools.cycle(range(pool.num_workers))
+
+    async def _forward(
+        self, request: web.Request, worker: int, body: bytes
+    ) -> web.StreamResponse:
+        """Send request to worker and stream its response back."""
+        metrics.ROUTED_REQUESTS.inc(worker=worker)
+        url = self.pool.urls[worker] + request.path_qs
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "host"
+        }
+        response = None
+        try:
+            async with self.session.request(
+                request.method, url, data=body, headers=headers
+            ) as upstream:
+                response = web.StreamResponse(
+                    status=upstream.status,
+                    headers={
+                        name: value
+                        for name, value in upstream.headers.items()
+                        if name.lower() not in HOP_BY_HOP_HEADERS
+                    },
+                )
+                await response.prepare(request)
+                # Chunks are written as they arrive, so SSE events are not held
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientConnectionError as e:
+            logger.warning(f"Worker {worker} unreachable: {e}")
+            if response is not None and response.prepared:
+                # Too late for an error status; the client sees a cut stream
+                return response
+            return web.json_response(
+                {"error": f"Worker {worker} is unavailable"},
+                status=503,
+                headers={"Retry-After": str(self.retry_after_s)},
+            )
+
+    async def text_to_sql(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        try:
+            params = await request.json()
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            return web.json_response(
+                {"error": "The request body must be a JSON object"}, status=400
+            )
+        worker = affinity_worker(params.get("db_id", ""), self.pool.num_workers)
+        return await self._forward(request, worker, body)
+
+    async def round_robin(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        return await self._forward(request, next(self._round_robin), body)
+
+    async def _get_all(self, path_qs: str) -> List[Optional[aiohttp.ClientResponse]]:
+        """GET path_qs from every worker; None for unreachable ones."""
+
+        async def get(url: str) -> Optional[aiohttp.ClientResponse]:
+            try:
+                async with self.session.get(url + path_qs) as response:
+                    await response.read()
+                    return response
+            except aiohttp.ClientError:
+                return None
+
+        return await asyncio.gather(*(get(url) for url in self.pool.urls))
+
+    async def reset_history(self, request: web.Request) -> web.Response:
+        # The conversation may have visited databases of several workers
+        await self._get_all(request.path_qs)
+        return web.json_response({"response": True})
+
+    async def analysis(self, request: web.Request) -> web.Response:
+        responses = await self._get_all(request.path_qs)
+        for response in responses:
+            if response is not None and response.status != 404:
+                return web.json_response(await response.json(), status=response.status)
+        return web.json_response({"status": "unknown"}, status=404)
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "workers_alive": self.pool.alive()})
+
+    async def ready(self, request: web.Request) -> web.Response:
+        """Ready once every worker is ready."""
+        responses = await self._get_all("/ready")
+        workers = [
+            await response.json() if response is not None else {"state": "down"}
+            for response in responses
+        ]
+        all_ready = all(
+            response is not None and response.status == 200 for response in responses
+        )
+        return web.json_response({"workers": workers}, status=200 if all_ready else 503)
+
+    async def metrics_endpoint(self, request: web.Request) -> web.Response:
+        # Only the router's own metrics; the workers are scraped on their ports
+        return web.Response(text=metrics.registry.render(), content_type="text/plain")
+
+    async def _supervise(self) -> None:
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL_S)
+            self.pool.restart_exited()
+
+    async def _start(self, app: web.Application) -> None:
+        # No total timeout: streams last as long as the analysis they wait for
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=5),
+            connector=aiohttp.TCPConnector(limit=0),
+        )
+        app["supervisor"] = asyncio.create_task(self._supervise())
+
+    async def _stop(self, app: web.Application) -> None:
+        app["supervisor"].cancel()
+        await self.session.close()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/text_to_sql", self.text_to_sql)
+        app.router.add_post("/text_to_sql_stream", self.text_to_sql)
+        app.router.add_get("/reset_history", self.reset_history)
+        app.router.add_get("/analysis/{job_id}", self.analysis)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/ready", self.ready)
+        app.router.add_get("/metrics", self.metrics_endpoint)
+        app.router.add_route("*", "/{tail:.*}", self.round_robin)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
+
+
+def run_router(pool: WorkerPool, host: str, port: int, retry_after_s: float) -> None:
+    """Start the workers of pool and route requests to them until interrupted."""
+    pool.start()
+    metrics.registry.gauge(
+        "text2sql_workers_alive",
+        "Worker processes of the pool that are running.",
+        pool.alive,
+    )
+    router = AffinityRouter(pool, retry_after_s=retry_after_s)
+    try:
+        web.run_app(router.app(), host=host, port=port)
+    finally:
+        pool.stop()
@@ -0,0 +1,190 @@
+import logging
+import threading
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from source.serving.metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+
+def _is_number(word: str) -> bool:
+    try:
+        float(word)
+        return True
+    except ValueError:
+        return False
+
+
+def _word_at(question: List[str], q_id: int) -> str:
+    """Word starting at the BERT token q_id of question, with its "##" pieces."""
+    pieces = [question[q_id]]
+    for piece in question[q_id + 1 :]:
+        if not piece.startswith("##"):
+            break
+        pieces.append(piece[2:])
+    return "".join(pieces).lower()
+
+
+def linked_entities(preproc_item: Dict[str, Any]) -> FrozenSet[Tuple]:
+    """Schema elements and values the linker found in a preprocessed question.
+
+    Columns and tables come from the schema linking (sc_link), values from the
+    cell value linking (cv_link) with the words they were found at. Numbers
+    count as values whether or not a column could hold them, as they also set
+    LIMIT clauses. Two questions with the same SQL mention the same entities,
+    whereas questions differing by one entity or literal ("singers from
+    France", "singers from Japan") embed almost the same.
+    """
+    question = preproc_item.get("question", [])
+    sc_link = preproc_item.get("sc_link", {})
+    cv_link = preproc_item.get("cv_link", {})
+    entities = set()
+    for match_type, kind in (("q_col_match", "column"), ("q_tab_match", "table")):
+        for link in sc_link.get(match_type, {}):
+            entities.add((kind, int(link.split(",")[1])))
+    for link in cv_link.get("cell_match", {}):
+        q_id, col_id = (int(index) for index in link.split(","))
+        entities.add(("value", col_id, _word_at(question, q_id)))
+    for q_id, piece in enumerate(question):
+        if not piece.startswith("##") and _is_number(_word_at(question, q_id)):
+            entities.add(("number", _word_at(question, q_id)))
+    return frozenset(entities)
+
+
+class _VectorIndex:
+    """Fixed-capacity store of unit vectors searched by exact cosine similarity.
+
+    Once full, the oldest entries are overwritten. A brute-force matrix product
+    over a few thousand vectors takes well under a millisecond, so no
+    approximate structure is needed at this scale.
+    """
+
+    def __init__(self, dim: int, capacity: int):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.values: List[Any] = [None] * capacity
+        self.entities: List[Optional[FrozenSet[Tuple]]] = [None] * capacity
+        self.size = 0
+        self.next = 0
+
+    def search(self, vector: np.ndarray, entities: FrozenSet[Tuple], threshold: float):
+        """Value of the most similar vector above threshold with the same entities.
+
+        Returns:
+            The value (None if there is none) and the similarity of the most
+            similar vector above threshold, whatever its entities
+        """
+        if self.size == 0:
+            return None, 0.0
+        similarities = self.vectors[: self.size] @ vector
+        candidates = np.flatnonzero(similarities >= threshold)
+        candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+        for candidate in candidates:
+            if self.entities[candidate] == entities:
+                return self.values[candidate], float(similarities[candidate])
+        return None, float(similarities.max())
+
+    def add(self, vector: np.ndarray, value: Any, entities: FrozenSet[Tuple]) -> None:
+        self.vectors[self.next] = vector
+        self.values[self.next] = value
+        self.entities[self.next] = entities
+        self.next = (self.next + 1) % len(self.values)
+        self.size = min(self.size + 1, len(self.values))
+
+
+class SemanticCache:
+    """Approximate cache of text-to-SQL results keyed by question embeddings.
+
+    Each db_id has its own index. A lookup returns the result cached for the
+    most similar earlier question when their cosine similarity reaches
+    ``threshold`` and the linker found the same entities in both (see
+    linked_entities), so paraphrases of a question skip beam search. Hits and
+    misses are counted in the cache lookup metrics.
+
+    Raw BERT embeddings of unrelated questions are close too, so the threshold
+    has to be calibrated on the model serving it (demo/calibrate_semantic_cache.py).
+    """
+
+    def __init__(self, threshold: float, max_entries_per_db: int = 10000):
+        """Initialize an empty cache.
+
+        Args:
+            threshold: Minimum cosine similarity for a hit
+            max_entries_per_db: Capacity of the index of each database
+        """
+        self.threshold = threshold
+        self.max_entries_per_db = max_entries_per_db
+        self._indexes: Dict[str, _VectorIndex] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def lookup(
+        self, db_id: str, embedding: np.ndarray, entities: FrozenSet[Tuple]
+    ) -> Optional[Any]:
+        """Return the result of the closest cached question, or None on a miss.
+
+        Args:
+            db_id: Database of the question
+            embedding: Embedding of the question
+            entities: linked_entities of the preprocessed question
+        """
+        embedding = self._normalize(embedding)
+        with self._lock:
+            index = self._indexes.get(db_id)
+            value, similarity = (
+                index.search(embedding, entities, self.threshold)
+                if index is not None
+                else (None, 0.0)
+            )
+            if value is not None:
+                record_cache_lookup("semantic", True)
+                logger.info(
+                    f"Semantic cache hit on {db_id} (similarity {similarity:.3f})"
+                )
+                return value
+            if similarity >= self.threshold:
+                logger.debug(
+                    f"Semantic cache miss on {db_id}: similarity {similarity:.3f} "
+                    f"but other entities"
+                )
+            record_cache_lookup("semantic", False)
+            return None
+
+    def add(
+        self,
+        db_id: str,
+        embedding: np.ndarray,
+        value: Any,
+        entities: FrozenSet[Tuple],
+    ) -> None:
+        """Cache the result of a question on db_id, with its linked_entities."""
+        embedding = self._normalize(embedding)
+        with self._lock:
+            if db_id not in self._indexes:
+                self._indexes[db_id] = _VectorIndex(
+                    len(embedding), self.max_entries_per_db
+                )
+            self._indexes[db_id].add(embedding, value, entities)
+
+    def __len__(self) -> int:
+        """Number of cached questions over all databases."""
+        with self._lock:
+            return sum(index.size for index in self._indexes.values())
+
+
+def build_semantic_cache(cfg) -> Optional[SemanticCache]:
+    """Create the semantic cache if it is enabled in the serving configuration."""
+    if not cfg.semantic_cache:
+        return None
+    if cfg.semantic_threshold is None:
+        raise ValueError(
+            "serving.semantic_threshold must be set to use the semantic cache; "
+            "calibrate it with demo/calibrate_semantic_cache.py"
+        )
+    return SemanticCache(
+        threshold=cfg.semantic_threshold, max_entries_per_db=cfg.semantic_max_entries
+    )
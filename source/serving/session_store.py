@@ -0,0 +1,104 @@
+import logging
+from typing import Optional
+
+import redis
+from source.serving.lru import TTLCache
+from source.serving.memory_redis import get_in_memory_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_ID = "default"
+
+
+class InMemorySessionStore:
+    """Process-local conversation histories keyed by session id.
+
+    Sessions expire ``ttl_seconds`` after their last access, and the least
+    recently used session is evicted once ``max_sessions`` is exceeded.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, max_sessions: int = 10000):
+        """Initialize an empty store.
+
+        Args:
+            ttl_seconds: Idle time after which a session is forgotten
+            max_sessions: Maximum number of sessions kept at once
+        """
+        self._sessions = TTLCache(maxsize=max_sessions, ttl_seconds=ttl_seconds)
+
+    def get_history(self, session_id: str) -> str:
+        """Return the conversation history of a session ("" if unknown or expired)."""
+        return self._sessions.get(session_id, "")
+
+    def set_history(self, session_id: str, history: str) -> None:
+        """Store the conversation history of a session."""
+        self._sessions.set(session_id, history)
+
+    def reset(self, session_id: str) -> None:
+        """Forget the conversation history of a session."""
+        self._sessions.pop(session_id)
+
+
+class RedisSessionStore:
+    """Conversation histories kept in Redis, shared by all server processes.
+
+    Every access refreshes the session's expiry, so idle sessions disappear
+    after ``ttl_seconds``. LRU eviction under memory pressure is left to the
+    Redis ``maxmemory-policy`` of the instance.
+    """
+
+    def __init__(
+        self, client: redis.Redis, ttl_seconds: float = 3600, prefix: str = "session:"
+    ):
+        """Initialize the store on top of an existing Redis client.
+
+        Args:
+            client: Redis client pointing at the session database
+            ttl_seconds: Idle time after which a session expires
+            prefix: Prefix of the Redis keys holding the histories
+        """
+        self.client = client
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def get_history(self, session_id: str) -> str:
+        history: Optional[bytes] = self.client.getex(
+            self._key(session_id), ex=self.ttl_seconds
+        )
+        return history.decode("utf-8") if history is not None else ""
+
+    def set_history(self, session_id: str, history: str) -> None:
+        self.client.set(
+            self._key(session_id), history.encode("utf-8"), ex=self.ttl_seconds
+        )
+
+    def reset(self, session_id: str) -> None:
+        self.client.delete(self._key(session_id))
+
+
+def build_session_store(cfg, redis_cfg):
+    """Create the session store selected in the serving configuration.
+
+    Args:
+        cfg: Serving configuration with session_backend, session_ttl_s and max_sessions
+        redis_cfg: Redis configuration with host, port and session_db
+
+    Returns:
+        InMemorySessionStore or RedisSessionStore
+    """
+    if cfg.session_backend == "redis":
+        if redis_cfg.backend == "memory":
+            client = get_in_memory_redis(redis_cfg.session_db)
+        else:
+            client = redis.StrictRedis(
+                host=redis_cfg.host, port=redis_cfg.port, db=redis_cfg.session_db
+            )
+        return RedisSessionStore(client, ttl_seconds=cfg.session_ttl_s)
+    elif cfg.session_backend == "memory":
+        return InMemorySessionStore(
+            ttl_seconds=cfg.session_ttl_s, max_sessions=cfg.max_sessions
+        )
+    raise ValueError(f"Unknown session backend: {cfg.session_backend}")
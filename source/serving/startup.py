@@ -0,0 +1,119 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LOADING = "loading"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+
+
+class ComponentLoader:
+    """Loads the components of the server concurrently in the background.
+
+    The server starts listening right away and reports readiness (all
+    components loaded and warmed up) through ``ready`` and ``status``, so
+    health checks are answered while the models are still loading.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """Initialize the loader.
+
+        Args:
+            max_workers: Number of components loaded at the same time
+        """
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="loader"
+        )
+        self.components: Dict[str, Future] = {}
+        self.load_seconds: Dict[str, float] = {}
+        self.state = LOADING
+        self.error: Optional[str] = None
+        self._started_at = time.perf_counter()
+
+    def submit(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Load component name with fn(*args, **kwargs) on a loader thread.
+
+        Returns:
+            Future of the component
+        """
+
+        def load() -> Any:
+            start = time.perf_counter()
+            logger.info(f"Loading {name}...")
+            component = fn(*args, **kwargs)
+            self.load_seconds[name] = time.perf_counter() - start
+            logger.info(f"Loaded {name} in {self.load_seconds[name]:.1f}s")
+            return component
+
+        self.components[name] = self.executor.submit(load)
+        return self.components[name]
+
+    def result(self, name: str) -> Any:
+        """Block until component name is loaded and return it."""
+        return self.components[name].result()
+
+    def finish(self, on_loaded: Optional[Callable[[], None]] = None) -> None:
+        """Wait for all components, run on_loaded, then mark the server ready.
+
+        on_loaded installs the components and warms them up. Failures are
+        logged and reported by status instead of raised, so a broken component
+        leaves the server alive but never ready.
+        """
+        wait(self.components.values())
+        try:
+            for future in self.components.values():
+                future.result()
+            if on_loaded is not None:
+                self.state = WARMING_UP
+                start = time.perf_counter()
+                on_loaded()
+                self.load_seconds["warmup"] = time.perf_counter() - start
+        except Exception as e:
+            logger.exception("Server startup failed")
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = FAILED
+        else:
+            self.state = READY
+            logger.info(
+                f"Server ready after {time.perf_counter() - self._started_at:.1f}s"
+            )
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def start(self, on_loaded: Optional[Callable[[], None]] = None) -> threading.Thread:
+        """Run finish(on_loaded) on a background thread."""
+        thread = threading.Thread(
+            target=self.finish, args=(on_loaded,), name="startup", daemon=True
+        )
+        thread.start()
+        return thread
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def status(self) -> Dict[str, Any]:
+        """Readiness report served by the /ready endpoint."""
+        components = {}
+        for name, future in self.components.items():
+            if not future.done():
+                components[name] = LOADING
+            elif future.exception() is not None:
+                components[name] = FAILED
+            else:
+                components[name] = READY
+        status = {
+            "state": self.state,
+            "components": components,
+            "load_seconds": {
+                name: round(seconds, 2) for name, seconds in self.load_seconds.items()
+            },
+        }
+        if self.error is not None:
+            status["error"] = self.error
+        return status
@@ -0,0 +1,164 @@
+import time
+import logging
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from source.serving.cache import fingerprint
+from source.serving.metrics import stage_timer
+from source.serving.llm_gateway import LLMGateway
+from source.text2intent.intent_inferer import IntentInferer
+from source.text2sql.multitask import HeadPredictions
+from source.text2sql.value_store import (
+    build_value_store,
+    fill_values,
+    fill_values_async,
+)
+
+logger = logging.getLogger(__name__)
+
+# Stand-ins for the models of the backend, used to measure the serving layer on
+# machines without a GPU or model checkpoints (serving.stub_models: true). Each
+# stub exposes the methods the backend calls on the model it replaces and
+# sleeps for the latency configured in serving.stub, so queueing, batching and
+# caching behave as with real models of that speed.
+
+
+def _sleep_ms(ms: float) -> None:
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+class StubText2SQL:
+    """Text2SQL returning a fixed SQL query after simulated model latency."""
+
+    def __init__(self, global_cfg, stub_cfg):
+        """Initialize the stub.
+
+        Args:
+            global_cfg: Global configuration, whose data.value_store is used for
+                value filling
+            stub_cfg: serving.stub configuration with the simulated latencies
+        """
+        self.stub_cfg = stub_cfg
+        self.value_store = (
+            build_value_store(global_cfg.data) if stub_cfg.fill_values else None
+        )
+        self.heads = None
+
+    def preprocess(self, text: str, text_history: str, db_id: str) -> Tuple[Any, Any]:
+        input_text = "<s> " + text + text_history
+        with stage_timer("preprocess"):
+            _sleep_ms(self.stub_cfg.preprocess_ms)
+        return SimpleNamespace(text=input_text, db_id=db_id), {}
+
+    def translate_batch(
+        self,
+        requests: List[Tuple[str, str, str, Optional[Tuple[Any, Any]], Optional[int]]],
+        fill_values: bool = True,
+    ) -> List[Tuple[List[Any], str, Optional[HeadPredictions]]]:
+        for text, text_history, db_id, item, _ in requests:
+            if item is None:
+                self.preprocess(text, text_history, db_id)
+        with stage_timer("encoder"):
+            _sleep_ms(self.stub_cfg.encoder_ms)
+        results = []
+        for text, text_history, db_id, _, beam_size in requests:
+            # Beam search time grows about linearly with the beam size
+            scale = beam_size / self.stub_cfg.beam_size if beam_size else 1.0
+            with stage_timer("beam_search"):
+                _sleep_ms(self.stub_cfg.beam_search_ms * scale)
+            inferred_code = self.stub_cfg.sql
+            if fill_values:
+                inferred_code = self.fill_values(
+                    text, text_history, db_id, inferred_code
+                )
+            results.append(([], inferred_code, None))
+        return results
+
+    def translate(
+        self,
+        text: str,
+        text_history: str,
+        db_id: str,
+        item: Optional[Tuple[Any, Any]] = None,
+        beam_size: Optional[int] = None,
+    ) -> Tuple[List[Any], str, Optional[HeadPredictions]]:
+        return self.translate_batch([(text, text_history, db_id, item, beam_size)])[0]
+
+    def fill_values(
+        self, text: str, text_history: str, db_id: str, inferred_code: str
+    ) -> str:
+        if self.value_store is None:
+            return inferred_code
+        if not text_history.endswith(text):
+            text_history += " <s> " + text
+        with stage_timer("value_filling"):
+            return fill_values(
+                self.value_store, text, db_id, inferred_code, text_history
+            )
+
+    async def fill_values_async(
+        self, text: str, text_history: str, db_id: str, inferred_code: str
+    ) -> str:
+        if self.value_store is None:
+            return inferred_code
+        if not text_history.endswith(text):
+            text_history += " <s> " + text
+        with stage_timer("value_filling"):
+            return await fill_values_async(
+                self.value_store, text, db_id, inferred_code, text_history
+            )
+
+    def schema_version(self, db_id: str) -> Optional[str]:
+        return None
+
+    def check_compiled_encoder(self, questions: List[Tuple[str, str]]) -> None:
+        pass
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Random unit vectors, one per distinct text (so repeats are cache hits)."""
+        _sleep_ms(self.stub_cfg.embedding_ms)
+        embeddings = []
+        for text in texts:
+            rng = np.random.default_rng(int(fingerprint(text)[:8], 16))
+            embedding = rng.standard_normal(self.stub_cfg.embedding_dim)
+            embeddings.append(embedding / np.linalg.norm(embedding))
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+class StubIntentInferer(IntentInferer):
+    """IntentInferer whose classifier always predicts "query".
+
+    The tune check still goes to the LLM server configured in text2intent, which
+    can be the fake one of source.serving.fake_llm.
+    """
+
+    def __init__(self, cfg, stub_cfg, gateway: Optional[LLMGateway] = None):
+        # Only the tune check of IntentInferer; no preprocessor or model
+        self.init_tune_check(cfg, gateway)
+        self.stub_cfg = stub_cfg
+
+    def infer(self, input_text: str, db_id: str, is_tune_check=False) -> List[Any]:
+        if is_tune_check:
+            return super().infer(input_text, db_id, is_tune_check=True)
+        _sleep_ms(self.stub_cfg.intent_ms)
+        return ["query"]
+
+
+class StubText2Confidence:
+    """Text2Confidence with a fixed confidence and simulated attribution latency."""
+
+    def __init__(self, stub_cfg):
+        self.stub_cfg = stub_cfg
+
+    def calculate(self, beams: List[Any], inferred_code: str) -> float:
+        _sleep_ms(self.stub_cfg.confidence_ms)
+        return self.stub_cfg.confidence
+
+    def analyze(
+        self, input_text: str, orig_item: Any, preproc_item: Any
+    ) -> Dict[str, Any]:
+        _sleep_ms(self.stub_cfg.analysis_ms)
+        words = input_text.replace("<s>", " ").split()
+        return {"raw_input": words[-1] if words else "", "word_attributions": 0.1}
@@ -1,14 +1,20 @@
-import os
 import re
-import json
 import hydra
-import requests
-import _jsonnet
-from typing import List, Any, Dict
+import logging
+import functools
+from typing import List, Any, Dict, Optional, Tuple
 from config.path import ABS_CONFIG_DIR
 from omegaconf import DictConfig
 from source.utils import One_time_Preprocesser
-from source.text2sql.ratsql.commands.infer import Inferer
+from source.serving.llm_gateway import LLMGateway, LLMGatewayError
+from source.serving.metrics import TUNE_CHECKS
+from source.text2intent.tune_classifier import (
+    build_tune_classifier,
+    build_tune_decision_log,
+)
+from source.text2sql.model_registry import load_experiment_config, model_registry
+
+logger = logging.getLogger(__name__)
 
 
 class IntentInferer:
@@ -18,16 +24,29 @@ class IntentInferer:
     execute a query or perform database tuning/administration tasks.
     """
 
-    def __init__(self, global_cfg, cfg):
+    def __init__(
+        self,
+        global_cfg,
+        cfg,
+        device: Optional[str] = None,
+        gateway: Optional[LLMGateway] = None,
+        load_model: bool = True,
+    ):
         """Initialize IntentInferer with model and preprocessor.
 
         Args:
             global_cfg: Global configuration with database, table, and text2sql paths
             cfg: Intent-specific configuration with model paths
+            device: Device to load the model on (default: CUDA if available)
+            gateway: Client of the LLM server of the tune check (default: a
+                private one)
+            load_model: Whether to load the intent model; not needed when the
+                intent comes from the multi-task heads of the text2sql model
+                (text2sql.multitask), in which case only the tune check is
+                available
 
         Raises:
-            RuntimeError: If text2sql experiment config file does not exist
-            AssertionError: If intent experiment config file does not exist
+            RuntimeError: If the intent or text2sql experiment config file does not exist
         """
         intent_experiment_config_path = cfg.experiment_config_path
         intent_model_ckpt_dir_path = cfg.model_ckpt_dir_path
@@ -35,55 +54,45 @@ class IntentInferer:
         text2sql_model_ckpt_dir_path = global_cfg.text2sql.model_ckpt_dir_path
         db_path = global_cfg.data.database_path
         table_path = global_cfg.data.table_path
-        self.tune_check_example_num = cfg.tune_check_example_num
-        self.llm_address = f"http://{cfg.host}:{cfg.port}/generate"
-        self.max_new_tokens = cfg.max_new_tokens
-        self.temperature = cfg.temperature
-
-        if os.path.isfile(intent_experiment_config_path):
-            exp_config = json.loads(
-                _jsonnet.evaluate_file(intent_experiment_config_path)
-            )
-            intent_model_config_file = exp_config["model_config"]
-            intent_model_config_args = exp_config["model_config_args"]
-            intent_model_config = json.loads(
-                _jsonnet.evaluate_file(
-                    intent_model_config_file,
-                    tla_codes={"args": json.dumps(intent_model_config_args)},
-                )
-            )
-        else:
-            assert "config file does not exist"
+        self.init_tune_check(cfg, gateway)
+        self.model = None
+        if not load_model:
+            return
 
-        if os.path.isfile(text2sql_experiment_config_path):
-            exp_config = json.loads(
-                _jsonnet.evaluate_file(text2sql_experiment_config_path)
-            )
-            text2sql_model_config_file = exp_config["model_config"]
-            text2sql_model_config_args = exp_config["model_config_args"]
-            text2sql_model_config = json.loads(
-                _jsonnet.evaluate_file(
-                    text2sql_model_config_file,
-                    tla_codes={"args": json.dumps(text2sql_model_config_args)},
-                )
-            )
-            text2sql_model_config["model"]["encoder_preproc"][
-                "save_path"
-            ] = text2sql_model_ckpt_dir_path
-            text2sql_model_config["model"]["decoder_preproc"][
-                "save_path"
-            ] = text2sql_model_ckpt_dir_path
-        else:
-            raise RuntimeError(
-                f"config file does not exist: {text2sql_experiment_config_path}"
-            )
+        intent_model_config = load_experiment_config(intent_experiment_config_path)
+        text2sql_model_config = load_experiment_config(
+            text2sql_experiment_config_path, text2sql_model_ckpt_dir_path
+        )
 
         self.preprocessor = One_time_Preprocesser(
-            db_path, table_path, text2sql_model_config["model"]["encoder_preproc"]
+            db_path,
+            table_path,
+            text2sql_model_config["model"]["encoder_preproc"],
+            db_cache_max_bytes=global_cfg.data.db_cache_max_mb * 2**20,
+            item_cache_size=global_cfg.serving.preproc_cache_size,
+            item_cache_ttl_s=global_cfg.serving.preproc_cache_ttl_s,
+        )
+
+        self.model = model_registry.get_model(
+            intent_model_config, intent_model_ckpt_dir_path, device
         )
 
-        inferer = Inferer(intent_model_config)
-        self.model, _ = inferer.load_model(intent_model_ckpt_dir_path)
+    def init_tune_check(self, cfg, gateway: Optional[LLMGateway] = None) -> None:
+        """Set up the tune check: LLM settings, local classifier and decision log.
+
+        Args:
+            cfg: Intent-specific configuration with the LLM and tune_classifier
+                settings
+            gateway: Client of the LLM server (default: a private one)
+        """
+        self.tune_check_example_num = cfg.tune_check_example_num
+        self.llm_address = f"http://{cfg.host}:{cfg.port}/generate"
+        self.max_new_tokens = cfg.max_new_tokens
+        self.temperature = cfg.temperature
+        self.timeout_s = cfg.timeout_s
+        self.gateway = gateway or LLMGateway()
+        self.tune_classifier = build_tune_classifier(cfg.tune_classifier)
+        self.tune_decision_log = build_tune_decision_log(cfg.tune_classifier)
 
     @property
     def tune_check_instruction(self) -> str:
@@ -128,13 +137,100 @@ class IntentInferer:
                 """,
         ]
 
-    def tune_check_prompt_generate(self, input_text):
-        return self.tune_check_instruction.format(
-            question=input_text,
+    @functools.cached_property
+    def tune_check_prompt_parts(self) -> Tuple[str, str]:
+        """The tune check prompt as a constant prefix and a template of the rest.
+
+        The prefix holds the instruction and the few-shot examples, up to the
+        line of the question, and is built once so that it is byte-identical
+        across requests and the LLM server can reuse its cached computation.
+        """
+        instruction = self.tune_check_instruction
+        split = instruction.rindex("\n", 0, instruction.index("{question}")) + 1
+        prefix = instruction[:split].format(
             few_shot_examples="\n\n".join(
                 self.tune_check_few_shot_examples[: self.tune_check_example_num]
-            ),
+            )
         )
+        return prefix, instruction[split:]
+
+    def tune_check_prompt_generate(self, input_text):
+        prefix, question_template = self.tune_check_prompt_parts
+        return prefix + question_template.format(question=input_text)
+
+    @property
+    def sampling_params(self) -> Dict[str, Any]:
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+        }
+
+    def local_tune_check(self, input_text: str) -> Optional[bool]:
+        """Decision of the local classifier, or None if the LLM must decide."""
+        if self.tune_classifier is None:
+            return None
+        decision = self.tune_classifier.decide(input_text)
+        if decision is not None:
+            TUNE_CHECKS.inc(decided_by="classifier")
+        return decision
+
+    def record_llm_tune_check(self, input_text: str, response: str) -> bool:
+        """Parse the LLM answer to the tune check, logging it for training."""
+        TUNE_CHECKS.inc(decided_by="llm")
+        is_tune = self.tune_check_preprocess(response)
+        if self.tune_decision_log is not None:
+            self.tune_decision_log.record(input_text, is_tune)
+        return is_tune
+
+    def tune_check(self, input_text: str) -> bool:
+        """Whether input_text asks for database tuning.
+
+        The local classifier answers when it is confident, and the LLM
+        otherwise. An LLM failure counts as no, so the question is still
+        translated.
+        """
+        decision = self.local_tune_check(input_text)
+        if decision is not None:
+            return decision
+        prefix, question_template = self.tune_check_prompt_parts
+        try:
+            response = self.gateway.generate(
+                self.llm_address,
+                question_template.format(question=input_text),
+                self.sampling_params,
+                timeout_s=self.timeout_s,
+                prefix=prefix,
+            )
+        except LLMGatewayError as e:
+            logger.error(f"Tune check failed: {e}")
+            return False
+        return self.record_llm_tune_check(input_text, response)
+
+    async def tune_check_async(self, input_text: str) -> List[bool]:
+        """Non-blocking variant of infer(input_text, db_id, is_tune_check=True).
+
+        Args:
+            input_text: Current user query text
+
+        Returns:
+            Single-element list with whether the user asks for database tuning
+        """
+        decision = self.local_tune_check(input_text)
+        if decision is not None:
+            return [decision]
+        prefix, question_template = self.tune_check_prompt_parts
+        try:
+            response = await self.gateway.generate_async(
+                self.llm_address,
+                question_template.format(question=input_text),
+                self.sampling_params,
+                timeout_s=self.timeout_s,
+                prefix=prefix,
+            )
+        except LLMGatewayError as e:
+            logger.error(f"Tune check failed: {e}")
+            return [False]
+        return [self.record_llm_tune_check(input_text, response)]
 
     def infer(self, input_text: str, db_id: str, is_tune_check=False) -> List[str]:
         """Infer user intent from input text.
@@ -147,25 +243,13 @@ class IntentInferer:
             List of predicted intent labels (e.g., ['query'] or ['database_tuning'])
         """
         if is_tune_check:
-            # generate prompt
-            prompt = self.tune_check_prompt_generate(input_text)
-
-            # send request to llm
-            response_list = requests.post(
-                self.llm_address,
-                json={
-                    "text": [prompt],
-                    "sampling_params": {
-                        "max_new_tokens": self.max_new_tokens,
-                        "temperature": self.temperature,
-                    },
-                },
-                timeout=None,
-            ).json()
-            tune_check_result = response_list[0]["text"]
-            is_tune = self.tune_check_preprocess(tune_check_result)
-            return [is_tune]
+            return [self.tune_check(input_text)]
 
+        elif self.model is None:
+            raise RuntimeError(
+                "The intent model is not loaded; intents come from the "
+                "text2sql multi-task heads"
+            )
         else:
             model_input = self.preprocess(input_text, db_id)
             enc_features = self.model.encoder(model_input)
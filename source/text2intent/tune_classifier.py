@@ -0,0 +1,233 @@
+import re
+import json
+import math
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+def features(text: str) -> Counter:
+    """Word unigrams and bigrams, and character trigrams of words, of text.
+
+    The trigrams let spelling variants (optimise, optimize, tuning, tune)
+    share features.
+    """
+    words = _WORD.findall(text.lower())
+    counts = Counter(f"w:{word}" for word in words)
+    counts.update(f"b:{first} {second}" for first, second in zip(words, words[1:]))
+    for word in words:
+        padded = f"<{word}>"
+        counts.update(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    return counts
+
+
+def sigmoid(logit: float) -> float:
+    """Logistic function, without overflow for logits of large magnitude."""
+    if logit >= 0:
+        return 1 / (1 + math.exp(-logit))
+    odds = math.exp(logit)
+    return odds / (1 + odds)
+
+
+class TuneClassifier:
+    """Logistic regression on TF-IDF features deciding whether text asks for tuning.
+
+    Trained on tune check decisions of the LLM (see TuneDecisionLog), it
+    answers the common, clear-cut questions locally in microseconds. The
+    questions it is unsure about, with a probability between low and high,
+    are left to the LLM.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        idf: np.ndarray,
+        weights: np.ndarray,
+        bias: float,
+        low: float = 0.1,
+        high: float = 0.9,
+    ):
+        """Initialize a trained classifier (see fit and load).
+
+        Args:
+            vocabulary: Index of each feature
+            idf: Inverse document frequency of each feature
+            weights: Weight of each feature
+            bias: Bias of the logistic regression
+            low: Probabilities up to low are decided as no tuning
+            high: Probabilities from high are decided as tuning
+        """
+        self.vocabulary = vocabulary
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.low = low
+        self.high = high
+
+    @staticmethod
+    def _tf_idf(
+        texts: Iterable[str], vocabulary: Dict[str, int], idf: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Sparse L2-normalized TF-IDF rows of texts, as (rows, columns, values)."""
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            entries = [
+                (vocabulary[feature], 1 + math.log(count))
+                for feature, count in features(text).items()
+                if feature in vocabulary
+            ]
+            if not entries:
+                continue
+            cols = np.array([column for column, _ in entries])
+            vals = np.array([tf for _, tf in entries]) * idf[cols]
+            rows.extend([row] * len(cols))
+            columns.extend(cols)
+            values.extend(vals / np.linalg.norm(vals))
+        return (
+            np.asarray(rows, dtype=np.int64),
+            np.asarray(columns, dtype=np.int64),
+            np.asarray(values, dtype=np.float64),
+        )
+
+    @classmethod
+    def fit(
+        cls,
+        texts: List[str],
+        labels: List[bool],
+        l2: float = 1e-4,
+        learning_rate: float = 2.0,
+        epochs: int = 300,
+        **kwargs,
+    ) -> "TuneClassifier":
+        """Train a classifier on texts labeled by whether they ask for tuning.
+
+        Both classes weigh the same in the loss, as tuning requests are rare.
+        Further keyword arguments are passed to the constructor.
+        """
+        num_texts = len(texts)
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(features(text).keys())
+        vocabulary = {
+            feature: index for index, feature in enumerate(sorted(document_frequency))
+        }
+        idf = np.array(
+            [
+                math.log((1 + num_texts) / (1 + document_frequency[feature])) + 1
+                for feature in sorted(document_frequency)
+            ]
+        )
+        rows, columns, values = cls._tf_idf(texts, vocabulary, idf)
+
+        y = np.asarray(labels, dtype=np.float64)
+        positives = max(y.sum(), 1)
+        negatives = max(num_texts - y.sum(), 1)
+        sample_weight = np.where(
+            y == 1, num_texts / (2 * positives), num_texts / (2 * negatives)
+        )
+        weights = np.zeros(len(vocabulary))
+        bias = 0.0
+        # Full-batch gradient descent; the sparse products are bincounts
+        for _ in range(epochs):
+            logits = (
+                np.bincount(rows, values * weights[columns], minlength=num_texts) + bias
+            )
+            # Logistic function in a form that cannot overflow
+            probabilities = 0.5 * (1 + np.tanh(logits / 2))
+            error = sample_weight * (probabilities - y) / num_texts
+            gradient = np.bincount(
+                columns, values * error[rows], minlength=len(vocabulary)
+            )
+            weights -= learning_rate * (gradient + l2 * weights)
+            bias -= learning_rate * error.sum()
+        return cls(vocabulary, idf, weights, bias, **kwargs)
+
+    def probability(self, text: str) -> float:
+        """Probability that text asks for tuning."""
+        _, columns, values = self._tf_idf([text], self.vocabulary, self.idf)
+        logit = float(values @ self.weights[columns]) + self.bias
+        return sigmoid(logit)
+
+    def decide(self, text: str) -> Optional[bool]:
+        """Whether text asks for tuning, or None if the margin is too small."""
+        probability = self.probability(text)
+        if probability >= self.high:
+            return True
+        if probability <= self.low:
+            return False
+        return None
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "vocabulary": self.vocabulary,
+                    "idf": self.idf.tolist(),
+                    "weights": self.weights.tolist(),
+                    "bias": self.bias,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "TuneClassifier":
+        """Load a classifier saved by save; keyword arguments set the margins."""
+        with open(path) as f:
+            state = json.load(f)
+        return cls(
+            state["vocabulary"], state["idf"], state["weights"], state["bias"], **kwargs
+        )
+
+
+class TuneDecisionLog:
+    """Appends the tune check decisions of the LLM to a JSON lines file.
+
+    The file is the training data of TuneClassifier.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1)
+
+    def record(self, text: str, is_tune: bool) -> None:
+        line = json.dumps({"text": text, "is_tune": is_tune})
+        with self._lock:
+            self._file.write(line + "\n")
+
+    @staticmethod
+    def read(path: str) -> Tuple[List[str], List[bool]]:
+        """Texts and decisions of a log, the latest decision of each text."""
+        decisions = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    decisions[entry["text"]] = bool(entry["is_tune"])
+        return list(decisions), list(decisions.values())
+
+
+def build_tune_classifier(cfg) -> Optional[TuneClassifier]:
+    """Load the classifier configured in text2intent.tune_classifier, if any."""
+    if not cfg.model_path:
+        return None
+    classifier = TuneClassifier.load(cfg.model_path, low=cfg.low, high=cfg.high)
+    logger.info(
+        f"Tune check classifier loaded from {cfg.model_path} "
+        f"({len(classifier.vocabulary)} features)"
+    )
+    return classifier
+
+
+def build_tune_decision_log(cfg) -> Optional[TuneDecisionLog]:
+    """Open the decision log configured in text2intent.tune_classifier, if any."""
+    if not cfg.decision_log_path:
+        return None
+    return TuneDecisionLog(cfg.decision_log_path)
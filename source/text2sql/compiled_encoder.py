@@ -0,0 +1,241 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Backends accepted by text2sql.compiled_encoder.backend
+TRACE = "trace"
+TORCH_COMPILE = "torch_compile"
+
+
+def bucket(size: int, buckets: Sequence[int]) -> Optional[int]:
+    """Smallest bucket holding size, or None if size exceeds the largest one."""
+    for bucket_size in sorted(buckets):
+        if size <= bucket_size:
+            return bucket_size
+    return None
+
+
+class _BertForward(torch.nn.Module):
+    """BERT forward returning the last hidden state only, as tracing needs tensors."""
+
+    def __init__(self, bert_model: torch.nn.Module):
+        super().__init__()
+        self.bert_model = bert_model
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        token_type_ids: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        return self.bert_model(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            return_dict=False,
+        )[0]
+
+
+class _RelationalForward(torch.nn.Module):
+    """Relation-aware transformer layers with a key mask for padded positions."""
+
+    def __init__(self, encoder: torch.nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(
+        self, enc: torch.Tensor, relation: torch.Tensor, mask: torch.Tensor
+    ) -> torch.Tensor:
+        return self.encoder(enc, relation, mask)[0]
+
+
+class BucketedGraphs:
+    """Compiled graphs of a module, one per padded input shape.
+
+    Inputs are padded up to a fixed set of shapes, so only a bounded number of
+    graphs is ever built and no request triggers a recompile once every
+    bucket has been seen.
+    """
+
+    def __init__(self, module: torch.nn.Module, backend: str, max_graphs: int):
+        if backend not in (TRACE, TORCH_COMPILE):
+            raise ValueError(f"Unknown encoder compile backend: {backend}")
+        self.module = module
+        self.backend = backend
+        self.graphs: Dict[Tuple, Callable[..., torch.Tensor]] = {}
+        self._lock = threading.Lock()
+        if backend == TORCH_COMPILE:
+            # Each bucket is a distinct static shape of the same code
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, max_graphs
+            )
+
+    def _compile(self, inputs: Tuple[torch.Tensor, ...]) -> Callable[..., torch.Tensor]:
+        if self.backend == TRACE:
+            return torch.jit.trace(self.module, inputs, check_trace=False)
+        return torch.compile(self.module, dynamic=False)
+
+    def __call__(self, key: Tuple, *inputs: torch.Tensor) -> torch.Tensor:
+        graph = self.graphs.get(key)
+        if graph is None:
+            with self._lock:
+                graph = self.graphs.get(key)
+                if graph is None:
+                    logger.info(f"Compiling {type(self.module).__name__} for {key}")
+                    graph = self._compile(inputs)
+                    self.graphs[key] = graph
+        return graph(*inputs)
+
+
+class CompiledBert:
+    """Runs the BERT model of SpiderEncoderBert through shape-bucketed graphs.
+
+    Token ids are padded to the next sequence length bucket (attention mask 0)
+    and the batch to the next batch size bucket; the padding is cut off the
+    output. Inputs longer than the largest bucket run in eager mode.
+    """
+
+    def __init__(
+        self,
+        bert_model: torch.nn.Module,
+        backend: str,
+        seq_buckets: Sequence[int],
+        batch_buckets: Sequence[int],
+        pad_id: int,
+    ):
+        self.bert_model = bert_model
+        self.seq_buckets = list(seq_buckets)
+        self.batch_buckets = list(batch_buckets)
+        self.pad_id = pad_id
+        self.graphs = BucketedGraphs(
+            _BertForward(bert_model),
+            backend,
+            max_graphs=2 * len(self.seq_buckets) * len(self.batch_buckets),
+        )
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        token_type_ids: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        batch_size, length = input_ids.shape
+        padded_length = bucket(length, self.seq_buckets)
+        padded_batch_size = bucket(batch_size, self.batch_buckets)
+        if padded_length is None or padded_batch_size is None:
+            return self.bert_model(
+                input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+            )[0]
+
+        def pad(tensor: torch.Tensor, value: int) -> torch.Tensor:
+            padded = tensor.new_full((padded_batch_size, padded_length), value)
+            padded[:batch_size, :length] = tensor
+            return padded
+
+        inputs = [pad(input_ids, self.pad_id), pad(attention_mask, 0)]
+        if token_type_ids is not None:
+            inputs.append(pad(token_type_ids, 0))
+        key = (padded_batch_size, padded_length, token_type_ids is not None)
+        return self.graphs(key, *inputs)[:batch_size, :length]
+
+
+class CompiledRelationalEncoder:
+    """Runs the layers of RelationalTransformerUpdate through shape-bucketed graphs.
+
+    The sequence of question, column and table encodings is padded to the
+    next length bucket, and padded positions are masked out as attention keys,
+    so the outputs at the real positions match the unpadded eager run.
+    """
+
+    def __init__(
+        self, encoder: torch.nn.Module, backend: str, length_buckets: Sequence[int]
+    ):
+        self.encoder = encoder
+        self.length_buckets = list(length_buckets)
+        self.graphs = BucketedGraphs(
+            _RelationalForward(encoder), backend, max_graphs=len(self.length_buckets)
+        )
+
+    def __call__(self, enc: torch.Tensor, relation: torch.Tensor) -> torch.Tensor:
+        """Encode enc (1 x length x hidden) with relations (length x length)."""
+        length = enc.shape[1]
+        padded_length = bucket(length, self.length_buckets)
+        if padded_length is None:
+            return self.encoder(enc, relation, mask=None)[0]
+
+        padded_enc = enc.new_zeros((1, padded_length, enc.shape[2]))
+        padded_enc[:, :length] = enc
+        padded_relation = relation.new_zeros((padded_length, padded_length))
+        padded_relation[:length, :length] = relation
+        mask = enc.new_zeros((1, padded_length, padded_length), dtype=torch.long)
+        mask[:, :, :length] = 1
+        return self.graphs((padded_length,), padded_enc, padded_relation, mask)[
+            :, :length
+        ]
+
+
+def compile_encoder(model: torch.nn.Module, cfg) -> None:
+    """Install the compiled inference path on the encoder of a text2sql model.
+
+    Args:
+        model: Text2SQL model with a SpiderEncoderBert encoder, in eval mode
+        cfg: text2sql.compiled_encoder configuration (backend and buckets)
+    """
+    encoder = model.encoder
+    if getattr(encoder, "compiled_bert", None) is not None:
+        return
+    encoder.compiled_bert = CompiledBert(
+        encoder.bert_model,
+        cfg.backend,
+        cfg.seq_buckets,
+        cfg.batch_buckets,
+        encoder.tokenizer.pad_token_id,
+    )
+    if hasattr(encoder.encs_update, "compiled_encoder"):
+        encoder.encs_update.compiled_encoder = CompiledRelationalEncoder(
+            encoder.encs_update.encoder, cfg.backend, cfg.relation_buckets
+        )
+    logger.info(f"Compiled encoder path enabled ({cfg.backend})")
+
+
+def _swap_compiled(encoder: torch.nn.Module, compiled: Tuple) -> Tuple:
+    """Install the (BERT, relational) compiled runners, returning the previous ones."""
+    update = encoder.encs_update
+    previous = (encoder.compiled_bert, getattr(update, "compiled_encoder", None))
+    encoder.compiled_bert = compiled[0]
+    if hasattr(update, "compiled_encoder"):
+        update.compiled_encoder = compiled[1]
+    return previous
+
+
+def max_difference_from_eager(model: torch.nn.Module, enc_inputs: List[Any]) -> float:
+    """Largest absolute difference between the compiled and the eager encoder.
+
+    Encodes enc_inputs both ways and compares the memories and alignment
+    matrices the decoder uses.
+    """
+    encoder = model.encoder
+    compiled = _swap_compiled(encoder, (None, None))
+    with torch.no_grad():
+        try:
+            eager_states = encoder(enc_inputs)
+        finally:
+            _swap_compiled(encoder, compiled)
+        compiled_states = encoder(enc_inputs)
+
+    difference = 0.0
+    for compiled_state, eager_state in zip(compiled_states, eager_states):
+        for name in ("memory", "m2c_align_mat", "m2t_align_mat"):
+            difference = max(
+                difference,
+                (getattr(compiled_state, name) - getattr(eager_state, name))
+                .abs()
+                .max()
+                .item(),
+            )
+    logger.info(f"Compiled encoder differs from eager mode by up to {difference:.2e}")
+    return difference
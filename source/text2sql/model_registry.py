@@ -0,0 +1,199 @@
+import os
+import copy
+import json
+import logging
+import threading
+import functools
+import _jsonnet
+import torch
+from typing import Any, Dict, Optional, Tuple
+from source.text2sql.multitask import load_joint_sql_weights
+from source.text2sql.ratsql.commands.infer import Inferer
+from source.text2sql.quantization import quantize_model
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _evaluate_experiment_config(
+    experiment_config_path: str, model_ckpt_dir_path: Optional[str]
+) -> Dict[str, Any]:
+    exp_config = json.loads(_jsonnet.evaluate_file(experiment_config_path))
+    model_config_file = exp_config["model_config"]
+    model_config_args = exp_config["model_config_args"]
+    model_config = json.loads(
+        _jsonnet.evaluate_file(
+            model_config_file,
+            tla_codes={"args": json.dumps(model_config_args)},
+        )
+    )
+    if model_ckpt_dir_path is not None:
+        model_config["model"]["encoder_preproc"]["save_path"] = model_ckpt_dir_path
+        model_config["model"]["decoder_preproc"]["save_path"] = model_ckpt_dir_path
+    return model_config
+
+
+def load_experiment_config(
+    experiment_config_path: str, model_ckpt_dir_path: Optional[str] = None
+) -> Dict[str, Any]:
+    """Evaluate an experiment jsonnet file into its model config.
+
+    Each (experiment config, checkpoint) pair is evaluated only once per process;
+    callers receive their own copy and may modify it freely.
+
+    Args:
+        experiment_config_path: Path to the experiment config.jsonnet
+        model_ckpt_dir_path: If given, used as save_path of the encoder/decoder preprocs
+
+    Returns:
+        Evaluated model config
+
+    Raises:
+        RuntimeError: If experiment config file does not exist
+    """
+    if not os.path.isfile(experiment_config_path):
+        raise RuntimeError(f"config file does not exist: {experiment_config_path}")
+    return copy.deepcopy(
+        _evaluate_experiment_config(experiment_config_path, model_ckpt_dir_path)
+    )
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models.
+
+    Models are keyed by (model config, checkpoint directory, device,
+    quantization, joint weights), so asking twice for the same model returns
+    the same instance. Models built from different configs but restored from the same
+    checkpoint on the same device (e.g. the plain and the Captum variant of the
+    text2sql model) share every parameter and buffer that is identical in both;
+    quantized layers have no such tensors and are never shared.
+
+    Models from different checkpoints can be loaded concurrently from several
+    threads; loads from the same checkpoint run one after the other so that
+    the later ones can share the weights of the first.
+    """
+
+    def __init__(self):
+        self._models: Dict[
+            Tuple[str, str, str, Optional[str], Optional[str]], torch.nn.Module
+        ] = {}
+        self._lock = threading.Lock()
+        self._ckpt_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def get_model(
+        self,
+        model_config: Dict[str, Any],
+        model_ckpt_dir_path: str,
+        device: Optional[str] = None,
+        quantize: Optional[str] = None,
+        joint_weights_path: Optional[str] = None,
+    ) -> torch.nn.Module:
+        """Return the model for a config and checkpoint, loading it on first use.
+
+        Args:
+            model_config: Evaluated model config
+            model_ckpt_dir_path: Directory with the model checkpoint
+            device: Device to load the model on (default: the Inferer's device)
+            quantize: Quantization scheme applied after loading (see
+                source.text2sql.quantization), or None for full precision
+            joint_weights_path: Multi-task checkpoint whose jointly trained
+                text2sql weights, if it has any, replace those of the
+                checkpoint (see source.text2sql.multitask). The result is a
+                model of its own, so models without them are never changed
+
+        Returns:
+            Shared model instance in eval mode
+        """
+        config_key = json.dumps(model_config["model"], sort_keys=True)
+        ckpt_key = os.path.abspath(model_ckpt_dir_path)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if joint_weights_path is not None:
+            joint_weights_path = os.path.abspath(joint_weights_path)
+        key = (config_key, ckpt_key, str(device), quantize, joint_weights_path)
+        with self._lock:
+            ckpt_lock = self._ckpt_locks.setdefault(
+                (ckpt_key, str(device)), threading.Lock()
+            )
+        with ckpt_lock:
+            with self._lock:
+                if key in self._models:
+                    logger.info(f"Reusing loaded model from {model_ckpt_dir_path}")
+                    return self._models[key]
+                others = [
+                    other
+                    for other_key, other in self._models.items()
+                    if other_key[1:3] == (ckpt_key, str(device))
+                ]
+
+            inferer = Inferer(model_config)
+            model, _ = inferer.load_model(model_ckpt_dir_path)
+            model.to(device)
+            if joint_weights_path is not None:
+                state_dict = load_joint_sql_weights(joint_weights_path, device)
+                if state_dict is not None:
+                    model.load_state_dict(state_dict)
+                    logger.info(
+                        f"Loaded the jointly trained text2sql weights from "
+                        f"{joint_weights_path}"
+                    )
+            if quantize is not None:
+                quantize_model(model, quantize)
+
+            if others:
+                num_shared = share_weights(model, others[0])
+                logger.info(
+                    f"Shared {num_shared} tensors with an already loaded model "
+                    f"from {model_ckpt_dir_path}"
+                )
+
+            with self._lock:
+                self._models[key] = model
+            return model
+
+    def clear(self) -> None:
+        """Drop all references held by the registry."""
+        with self._lock:
+            self._models.clear()
+            self._ckpt_locks.clear()
+
+
+def share_weights(model: torch.nn.Module, source: torch.nn.Module) -> int:
+    """Point the parameters and buffers of model to identical tensors of source.
+
+    Only tensors with the same name, shape, dtype and value are replaced, so the
+    outputs of model do not change.
+
+    Args:
+        model: Model whose tensors are replaced
+        source: Model providing the shared tensors
+
+    Returns:
+        Number of tensors now shared
+    """
+    source_tensors = dict(source.named_parameters())
+    source_tensors.update(source.named_buffers())
+
+    num_shared = 0
+    targets = list(model.named_parameters()) + list(model.named_buffers())
+    for name, tensor in targets:
+        shared = source_tensors.get(name)
+        if (
+            shared is None
+            or shared is tensor
+            or shared.shape != tensor.shape
+            or shared.dtype != tensor.dtype
+            or not torch.equal(shared, tensor)
+        ):
+            continue
+        module_name, _, attr_name = name.rpartition(".")
+        module = model.get_submodule(module_name) if module_name else model
+        if attr_name in module._parameters:
+            module._parameters[attr_name] = shared
+        else:
+            module._buffers[attr_name] = shared
+        num_shared += 1
+    return num_shared
+
+
+model_registry = ModelRegistry()
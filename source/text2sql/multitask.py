@@ -0,0 +1,276 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from source.text2sql.ratsql.models.nl2intent.decoder import OUTPUT_CLASSES
+
+logger = logging.getLogger(__name__)
+
+# Beam features the confidence head reads besides the encoder state
+NUM_BEAM_FEATURES = 4
+
+
+@dataclass
+class HeadPredictions:
+    """Intent and confidence of one translated question, from its SQL encoding."""
+
+    intent: str
+    confidence: float
+
+
+def beam_features(beams: Sequence[Any]) -> torch.Tensor:
+    """Score features of the beams of one translation, best beam first.
+
+    The log-probability of the best beam, its margin over the second one, its
+    softmax probability among all beams (the score Text2Confidence.calculate
+    starts from) and its length in decoding steps, divided by 100.
+    """
+    if not beams:
+        return torch.zeros(NUM_BEAM_FEATURES)
+    scores = torch.tensor([float(beam.score) for beam in beams], dtype=torch.float)
+    margin = scores[0] - scores[1] if len(scores) > 1 else scores.new_tensor(0.0)
+    return torch.stack(
+        [
+            scores[0],
+            margin,
+            torch.softmax(scores, dim=0)[0],
+            scores.new_tensor(len(beams[0].choice_history) / 100),
+        ]
+    )
+
+
+class IntentHead(torch.nn.Module):
+    """Intent classifier on the pooled encoder state, laid out as NL2IntentDecoder."""
+
+    def __init__(
+        self,
+        hidden_size: int,
+        recurrent_size: int = 256,
+        num_classes: int = len(OUTPUT_CLASSES),
+        dropout: float = 0.1,
+    ):
+        super().__init__()
+        self.layers = torch.nn.Sequential(
+            torch.nn.Linear(hidden_size, recurrent_size),
+            torch.nn.Dropout(dropout),
+            torch.nn.ReLU(),
+            torch.nn.Linear(recurrent_size, recurrent_size),
+            torch.nn.Dropout(dropout),
+            torch.nn.ReLU(),
+            torch.nn.Linear(recurrent_size, num_classes),
+        )
+
+    def forward(self, pooled: torch.Tensor) -> torch.Tensor:
+        return self.layers(pooled)
+
+
+class ConfidenceHead(torch.nn.Module):
+    """Probability that the best beam is correct, with temperature scaling.
+
+    A logistic regression on the pooled encoder state and the beam features.
+    The temperature is fitted after training, on held-out translations (see
+    fit_temperature), so that the probabilities match the observed accuracy.
+    """
+
+    def __init__(self, hidden_size: int, dropout: float = 0.1):
+        super().__init__()
+        self.state_layer = torch.nn.Sequential(
+            torch.nn.Dropout(dropout), torch.nn.Linear(hidden_size, 1)
+        )
+        self.beam_layer = torch.nn.Linear(NUM_BEAM_FEATURES, 1)
+        self.register_buffer("temperature", torch.ones(()))
+
+    def logits(self, pooled: torch.Tensor, features: torch.Tensor) -> torch.Tensor:
+        """Uncalibrated logits, as trained."""
+        return (self.state_layer(pooled) + self.beam_layer(features)).squeeze(-1)
+
+    def forward(self, pooled: torch.Tensor, features: torch.Tensor) -> torch.Tensor:
+        return torch.sigmoid(self.logits(pooled, features) / self.temperature)
+
+    def fit_temperature(
+        self, logits: torch.Tensor, labels: torch.Tensor, steps: int = 100
+    ) -> float:
+        """Set the temperature minimizing the log loss of held-out logits."""
+        log_temperature = torch.zeros((), requires_grad=True)
+        optimizer = torch.optim.LBFGS([log_temperature], lr=0.1, max_iter=steps)
+
+        def closure():
+            optimizer.zero_grad()
+            loss = F.binary_cross_entropy_with_logits(
+                logits / log_temperature.exp(), labels
+            )
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        self.temperature.fill_(log_temperature.exp().item())
+        return self.temperature.item()
+
+
+class MultiTaskHeads(torch.nn.Module):
+    """Intent and confidence heads reading the encoder of the text2sql model.
+
+    Both heads take the BERT output at [CLS] that SpiderEncoderBert computes
+    for the SQL decoder anyway, so a question is encoded once for its SQL,
+    its intent and the confidence in its SQL.
+    """
+
+    def __init__(
+        self, hidden_size: int, intent_classes: Sequence[str] = OUTPUT_CLASSES
+    ):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.intent_classes = list(intent_classes)
+        self.intent = IntentHead(hidden_size, num_classes=len(self.intent_classes))
+        self.confidence = ConfidenceHead(hidden_size)
+
+    @property
+    def _device(self):
+        return next(self.parameters()).device
+
+    def predict(
+        self, enc_states: Sequence[Any], beams: Sequence[Sequence[Any]]
+    ) -> List[HeadPredictions]:
+        """Intent and confidence of translations, from their encoder states and beams."""
+        pooled = torch.stack([enc_state.pooled for enc_state in enc_states])
+        features = torch.stack([beam_features(item) for item in beams]).to(self._device)
+        with torch.no_grad():
+            intent_ids = self.intent(pooled).argmax(dim=1).tolist()
+            confidences = self.confidence(pooled, features).tolist()
+        return [
+            HeadPredictions(self.intent_classes[intent_id], confidence)
+            for intent_id, confidence in zip(intent_ids, confidences)
+        ]
+
+
+class MultiTaskModel(torch.nn.Module):
+    """The text2sql model with intent and confidence heads, for joint training.
+
+    A training step encodes the SQL examples and the intent examples in one
+    encoder pass. The SQL examples go on to the SQL decoder and the intent
+    examples to the intent head, and the sum of both losses trains the shared
+    encoder. The confidence head is trained afterwards, on the outcome of beam
+    search with the trained model (see confidence_loss).
+    """
+
+    def __init__(self, sql_model: torch.nn.Module, heads: MultiTaskHeads):
+        super().__init__()
+        self.sql_model = sql_model
+        self.heads = heads
+
+    def compute_loss(
+        self,
+        sql_batch: List[Tuple[Dict, Any]],
+        intent_batch: List[Tuple[Dict, str]],
+        intent_weight: float = 1.0,
+    ) -> Tuple[torch.Tensor, Dict[str, float]]:
+        """Joint loss of a batch of SQL examples and a batch of intent examples.
+
+        Args:
+            sql_batch: (enc_input, dec_output) pairs of the text2sql preprocessor;
+                may be empty, to train the intent head only
+            intent_batch: (enc_input, intent label) pairs
+            intent_weight: Weight of the intent loss
+
+        Returns:
+            Loss to minimize, and its parts by task
+        """
+        enc_states = self.sql_model.encoder(
+            [enc_input for enc_input, _ in sql_batch]
+            + [enc_input for enc_input, _ in intent_batch]
+        )
+        losses = {}
+        loss = 0.0
+        if sql_batch:
+            sql_loss = torch.stack(
+                [
+                    self.sql_model.decoder.compute_loss(
+                        enc_input, dec_output, enc_state, False
+                    )
+                    for (enc_input, dec_output), enc_state in zip(sql_batch, enc_states)
+                ]
+            ).mean()
+            losses["sql"] = sql_loss.item()
+            loss = loss + sql_loss
+        if intent_batch:
+            pooled = torch.stack(
+                [enc_state.pooled for enc_state in enc_states[len(sql_batch) :]]
+            )
+            gold = torch.tensor(
+                [self.heads.intent_classes.index(label) for _, label in intent_batch],
+                device=pooled.device,
+            )
+            intent_loss = F.cross_entropy(self.heads.intent(pooled), gold)
+            losses["intent"] = intent_loss.item()
+            loss = loss + intent_weight * intent_loss
+        return loss, losses
+
+    def confidence_loss(
+        self, pooled: torch.Tensor, features: torch.Tensor, correct: torch.Tensor
+    ) -> torch.Tensor:
+        """Log loss of the confidence head on translations known to be right or wrong."""
+        return F.binary_cross_entropy_with_logits(
+            self.heads.confidence.logits(pooled, features), correct
+        )
+
+    def save(self, path: str, with_sql_model: bool) -> None:
+        """Save the heads, and the text2sql weights if the encoder was trained too."""
+        checkpoint = {
+            "hidden_size": self.heads.hidden_size,
+            "intent_classes": self.heads.intent_classes,
+            "heads": self.heads.state_dict(),
+        }
+        if with_sql_model:
+            checkpoint["sql_model"] = self.sql_model.state_dict()
+        torch.save(checkpoint, path)
+
+
+def load_multitask_heads(
+    path: str, sql_model: torch.nn.Module, device: Optional[str] = None
+) -> MultiTaskHeads:
+    """Load heads saved by MultiTaskModel.save onto a loaded text2sql model.
+
+    sql_model is not modified. If the encoder was trained jointly with the
+    heads, sql_model must already hold those weights: ModelRegistry.get_model
+    loads them (see load_joint_sql_weights) into a model of its own, so that
+    other users of the plain checkpoint keep the weights they were trained
+    with.
+
+    Args:
+        path: Checkpoint of text2sql.multitask.heads_path
+        sql_model: Text2SQL model the heads read the encoder of
+        device: Device of the heads (default: that of sql_model)
+
+    Returns:
+        Heads in eval mode
+    """
+    if device is None:
+        device = next(sql_model.parameters()).device
+    checkpoint = torch.load(path, map_location=device)
+    heads = MultiTaskHeads(checkpoint["hidden_size"], checkpoint["intent_classes"])
+    heads.load_state_dict(checkpoint["heads"])
+    heads.to(device)
+    heads.eval()
+    logger.info(
+        f"Intent and confidence heads loaded from {path} "
+        f"(temperature {heads.confidence.temperature.item():.2f})"
+    )
+    return heads
+
+
+def load_joint_sql_weights(
+    path: str, device: Optional[str] = None
+) -> Optional[Dict[str, torch.Tensor]]:
+    """Text2SQL weights saved by MultiTaskModel.save with the heads, if any.
+
+    Args:
+        path: Checkpoint of text2sql.multitask.heads_path
+        device: Device to map the weights to
+
+    Returns:
+        State dict of the text2sql model, or None if only the heads were trained
+    """
+    return torch.load(path, map_location=device).get("sql_model")
@@ -0,0 +1,67 @@
+import logging
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Quantization schemes accepted by text2sql.quantize
+INT8_DYNAMIC = "int8_dynamic"
+
+# Layer types whose weights are quantized; their activations stay float and
+# are quantized on the fly, so no calibration data is needed
+DYNAMIC_QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM}
+
+
+def quantize_model(model: torch.nn.Module, scheme: str) -> torch.nn.Module:
+    """Quantize the encoder and decoder of a text2sql model in place for CPU inference.
+
+    With INT8_DYNAMIC, the linear and LSTM layers of the encoder (both BERT
+    models of SpiderEncoderBert and the relational transformer) and of the
+    NL2Code decoder get int8 weights. The decoder's RecurrentDropoutLSTMCell is
+    a TorchScript module with raw parameters, so it stays in float32.
+
+    Args:
+        model: Text2SQL model in eval mode on the CPU
+        scheme: Quantization scheme (INT8_DYNAMIC)
+
+    Returns:
+        model, with its encoder and decoder quantized
+
+    Raises:
+        ValueError: If the scheme is unknown or the model is not on the CPU
+    """
+    if scheme != INT8_DYNAMIC:
+        raise ValueError(f"Unknown quantization scheme: {scheme}")
+    device = next(model.parameters()).device
+    if device.type != "cpu":
+        raise ValueError(f"Dynamic quantization runs on the CPU, not on {device}")
+
+    for name in ("encoder", "decoder"):
+        module = getattr(model, name)
+        num_layers = sum(
+            type(layer) in DYNAMIC_QUANTIZED_LAYERS for layer in module.modules()
+        )
+        torch.ao.quantization.quantize_dynamic(
+            module, DYNAMIC_QUANTIZED_LAYERS, dtype=torch.qint8, inplace=True
+        )
+        logger.info(f"Quantized {num_layers} layers of the {name} to int8")
+    return model
+
+
+def set_torch_threads(
+    intra_op_threads: Optional[int], inter_op_threads: Optional[int] = None
+) -> None:
+    """Set the CPU thread pools of torch; None keeps the library default.
+
+    Must be called before the first model runs, as the inter-op pool cannot be
+    resized once used.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        torch.set_num_interop_threads(inter_op_threads)
+    logger.info(
+        f"Torch uses {torch.get_num_threads()} intra-op and "
+        f"{torch.get_num_interop_threads()} inter-op threads"
+    )
@@ -166,12 +166,15 @@ class EncDecModel(torch.nn.Module):
         result = {"loss": mean_loss * batch_size, "total": batch_size}
         return result, acc
 
-    def begin_inference(self, orig_item, preproc_item):
-        enc_input, _ = preproc_item
+    def encode_batch(self, preproc_items):
+        enc_inputs = [enc_input for enc_input, _ in preproc_items]
         if getattr(self.encoder, "batched"):
-            (enc_state,) = self.encoder([enc_input])
-        else:
-            enc_state = self.encoder(enc_input)
+            return self.encoder(enc_inputs)
+        return [self.encoder(enc_input) for enc_input in enc_inputs]
+
+    def begin_inference(self, orig_item, preproc_item, enc_state=None):
+        if enc_state is None:
+            (enc_state,) = self.encode_batch([preproc_item])
         return self.decoder.begin_inference(enc_state, orig_item)
 
     def begin_inference_captum(
@@ -471,6 +471,9 @@ class NL2CodeDecoder(torch.nn.Module):
             self.compute_pointer_with_align = (
                 lambda *args: spider_dec_func.compute_pointer_with_align(self, *args)
             )
+            self.pointer_logits_with_align = (
+                lambda *args: spider_dec_func.pointer_logits_with_align(self, *args)
+            )
 
         if self.preproc.use_seq_elem_rules:
             self.node_type_vocab = vocab.Vocab(
@@ -861,14 +864,18 @@ class NL2CodeDecoder(torch.nn.Module):
         # - h_n: batch (=1) x emb_size
         # - c_n: batch (=1) x emb_size
         query = prev_state[0]
+        # The memories have batch 1; step_batch queries them with several states
+        batch_size = query.shape[0]
         if self.attn_type != "sep":
-            return self.desc_attn(query, desc_enc.memory, attn_mask=None)
+            return self.desc_attn(
+                query, desc_enc.memory.expand(batch_size, -1, -1), attn_mask=None
+            )
         else:
             question_context, question_attention_logits = self.question_attn(
-                query, desc_enc.question_memory
+                query, desc_enc.question_memory.expand(batch_size, -1, -1)
             )
             schema_context, schema_attention_logits = self.schema_attn(
-                query, desc_enc.schema_memory
+                query, desc_enc.schema_memory.expand(batch_size, -1, -1)
             )
             return question_context + schema_context, schema_attention_logits
 
@@ -890,9 +897,14 @@ class NL2CodeDecoder(torch.nn.Module):
         # desc_context shape: batch (=1) x emb_size
         desc_context, attention_probs = self._desc_attention(prev_state, desc_enc)
         # node_type_emb shape: batch (=1) x emb_size
-        node_type_emb = self.node_type_embedding(
-            self._index(self.node_type_vocab, node_type)
-        )
+        if isinstance(node_type, list):
+            # One node type per row, from step_batch
+            node_type_idx = self._tensor(
+                [self.node_type_vocab.index(row_type) for row_type in node_type]
+            )
+        else:
+            node_type_idx = self._index(self.node_type_vocab, node_type)
+        node_type_emb = self.node_type_embedding(node_type_idx)
 
         state_input = torch.cat(
             (
@@ -911,6 +923,76 @@ class NL2CodeDecoder(torch.nn.Module):
         )
         return new_state, attention_probs
 
+    def step_batch(self, calls, desc_enc):
+        """Run the decoder calls of several inference traversals as one batch.
+
+        Args:
+            calls: (method, node_type, prev_state, prev_action_emb, parent_h,
+                parent_action_emb) of each traversal, method being apply_rule,
+                gen_token or compute_pointer_with_align
+            desc_enc: the encoding of the description all traversals decode
+
+        Returns:
+            For each call, what its method returns when called alone. The
+            recurrent state of all calls is updated in one step; the heads run
+            once per method (and per pointer type).
+        """
+        new_state, attention_probs = self._update_state(
+            [node_type for _, node_type, *_ in calls],
+            tuple(
+                torch.cat([prev_state[i] for _, _, prev_state, *_ in calls])
+                for i in range(2)
+            ),
+            *(torch.cat([call[i] for call in calls]) for i in range(3, 6)),
+            desc_enc,
+        )
+        # output shape: batch x emb_size
+        output = new_state[0]
+
+        rows_by_head = collections.defaultdict(list)
+        for row, (method, node_type, *_) in enumerate(calls):
+            pointer_type = node_type if method == "compute_pointer_with_align" else None
+            rows_by_head[method, pointer_type].append(row)
+        head_outputs = [None] * len(calls)
+        for (method, pointer_type), rows in rows_by_head.items():
+            rows_output = output[rows]
+            if method == "apply_rule":
+                heads = (self.rule_logits(rows_output),)
+            elif method == "gen_token":
+                heads = (self.gen_logodds(rows_output).squeeze(1),)
+            else:
+                heads = self.pointer_logits_with_align(
+                    pointer_type, rows_output, desc_enc
+                )
+            for i, row in enumerate(rows):
+                head_outputs[row] = tuple(head[i : i + 1] for head in heads)
+
+        results = []
+        for row, (method, *_) in enumerate(calls):
+            row_state = tuple(state[row : row + 1] for state in new_state)
+            row_output = output[row : row + 1]
+            row_attention_probs = attention_probs[row : row + 1]
+            if method == "apply_rule":
+                (rule_logits,) = head_outputs[row]
+                results.append(
+                    (row_output, row_state, rule_logits, row_attention_probs)
+                )
+            elif method == "gen_token":
+                (gen_logodds,) = head_outputs[row]
+                results.append((row_state, row_output, gen_logodds))
+            else:
+                pointer_logits, memory_pointer_probs = head_outputs[row]
+                results.append(
+                    (
+                        row_output,
+                        row_state,
+                        pointer_logits,
+                        row_attention_probs,
+                        memory_pointer_probs,
+                    )
+                )
+        return results
+
     def apply_rule(
         self,
         node_type,
@@ -83,6 +83,7 @@ class TreeTraversal:
         self.next_item_id = 1
 
         self.update_prev_action_emb = TreeTraversal._update_prev_action_emb_apply_rule
+        self.model_output = None
 
     def clone(self):
         other = self.__class__(None, None)
@@ -95,23 +96,121 @@ class TreeTraversal:
         other.next_item_id = self.next_item_id
         other.actions = self.actions
         other.update_prev_action_emb = self.update_prev_action_emb
+        other.model_output = None
         return other
 
     def step(self, last_choice, extra_choice_info=None, attention_offset=None):
+        model_call, last_choice = self._advance(
+            last_choice, extra_choice_info, attention_offset
+        )
+        if model_call is None:
+            return last_choice
+        return self._handle(last_choice)
+
+    @classmethod
+    def step_batch(cls, traversals, last_choices):
+        """step for several traversals of the same description.
+
+        Each traversal runs up to its next decoder call, all those calls run as
+        one batch (NL2CodeDecoder.step_batch), and each traversal then takes
+        its choices from its own row of the outputs.
+
+        Returns:
+            The next choices of each traversal, as step returns them
+        """
+        results = [None] * len(traversals)
+        pending = []
+        for i, (traversal, last_choice) in enumerate(zip(traversals, last_choices)):
+            model_call, value = traversal._advance(last_choice)
+            if model_call is None:
+                results[i] = value
+            else:
+                pending.append((i, model_call, value))
+        if not pending:
+            return results
+
+        model = traversals[pending[0][0]].model
+        desc_enc = traversals[pending[0][0]].desc_enc
+        model_outputs = model.step_batch(
+            [
+                (method, node_type) + traversals[i]._model_inputs()
+                for i, (method, node_type), _ in pending
+            ],
+            desc_enc,
+        )
+        for (i, _, last_choice), model_output in zip(pending, model_outputs):
+            traversal = traversals[i]
+            traversal.model_output = model_output
+            results[i] = traversal._handle(last_choice)
+        return results
+
+    def _advance(self, last_choice, extra_choice_info=None, attention_offset=None):
+        """Run step until it needs the decoder.
+
+        Returns:
+            The (method, node_type) of the decoder call and the last choice to
+            hand to its handler, or None and the choices step returns
+        """
         while True:
             assert not extra_choice_info
             self.update_using_last_choice(
                 last_choice, extra_choice_info, attention_offset
             )
 
-            handler_name = TreeTraversal.Handler.handlers[self.cur_item.state]
-            handler = getattr(self, handler_name)
-            choices, continued = handler(last_choice)
+            model_call = self._model_call(last_choice)
+            if model_call is not None:
+                return model_call, last_choice
+
+            choices, continued = self._handler()(last_choice)
             if continued:
                 last_choice = choices
                 continue
             else:
-                return choices
+                return None, choices
+
+    def _handle(self, last_choice):
+        choices, continued = self._handler()(last_choice)
+        assert not continued
+        return choices
+
+    def _handler(self):
+        handler_name = TreeTraversal.Handler.handlers[self.cur_item.state]
+        return getattr(self, handler_name)
+
+    def _model_call(self, last_choice):
+        """The decoder method and node type the handler of cur_item calls, if any."""
+        state = self.cur_item.state
+        node_type = self.cur_item.node_type
+        if state == TreeTraversal.State.SUM_TYPE_INQUIRE:
+            return "apply_rule", node_type
+        elif state == TreeTraversal.State.CHILDREN_INQUIRE:
+            if self.model.ast_wrapper.singular_types[node_type].fields:
+                return "apply_rule", node_type
+        elif state == TreeTraversal.State.LIST_LENGTH_INQUIRE:
+            return "apply_rule", node_type + "*"
+        elif state == TreeTraversal.State.GEN_TOKEN:
+            if last_choice != vocab.EOS:
+                return "gen_token", node_type
+        elif state == TreeTraversal.State.POINTER_INQUIRE:
+            return "compute_pointer_with_align", node_type
+        return None
+
+    def _model_inputs(self):
+        return (
+            self.recurrent_state,
+            self.prev_action_emb,
+            self.cur_item.parent_h,
+            self.cur_item.parent_action_emb,
+        )
+
+    def _call_model(self, method, node_type):
+        # step_batch leaves the output of the batched call here
+        if self.model_output is not None:
+            model_output, self.model_output = self.model_output, None
+            return model_output
+        return getattr(self.model, method)(
+            node_type, *self._model_inputs(), self.desc_enc
+        )
 
     def update_using_last_choice(
         self, last_choice, extra_choice_info, attention_offset
@@ -150,15 +249,8 @@ class TreeTraversal:
     def process_sum_inquire(self, last_choice):
         # 1. ApplyRule, like expr -> Call
         # a. Ask which one to choose
-        output, self.recurrent_state, rule_logits, attention_probs = (
-            self.model.apply_rule(
-                self.cur_item.node_type,
-                self.recurrent_state,
-                self.prev_action_emb,
-                self.cur_item.parent_h,
-                self.cur_item.parent_action_emb,
-                self.desc_enc,
-            )
+        output, self.recurrent_state, rule_logits, attention_probs = self._call_model(
+            "apply_rule", self.cur_item.node_type
         )
         self.cur_item = attr.evolve(
             self.cur_item, state=TreeTraversal.State.SUM_TYPE_APPLY, parent_h=output
@@ -197,15 +289,8 @@ class TreeTraversal:
                 return None, False
 
         # a. Ask about presence
-        output, self.recurrent_state, rule_logits, attention_probs = (
-            self.model.apply_rule(
-                self.cur_item.node_type,
-                self.recurrent_state,
-                self.prev_action_emb,
-                self.cur_item.parent_h,
-                self.cur_item.parent_action_emb,
-                self.desc_enc,
-            )
+        output, self.recurrent_state, rule_logits, attention_probs = self._call_model(
+            "apply_rule", self.cur_item.node_type
         )
         self.cur_item = attr.evolve(
             self.cur_item, state=TreeTraversal.State.CHILDREN_APPLY, parent_h=output
@@ -287,15 +372,8 @@ class TreeTraversal:
     @Handler.register_handler(State.LIST_LENGTH_INQUIRE)
     def process_list_length_inquire(self, last_choice):
         list_type = self.cur_item.node_type + "*"
-        output, self.recurrent_state, rule_logits, attention_probs = (
-            self.model.apply_rule(
-                list_type,
-                self.recurrent_state,
-                self.prev_action_emb,
-                self.cur_item.parent_h,
-                self.cur_item.parent_action_emb,
-                self.desc_enc,
-            )
+        output, self.recurrent_state, rule_logits, attention_probs = self._call_model(
+            "apply_rule", list_type
         )
         self.cur_item = attr.evolve(
             self.cur_item, state=TreeTraversal.State.LIST_LENGTH_APPLY, parent_h=output
@@ -353,13 +431,8 @@ class TreeTraversal:
             else:
                 return None, False
 
-        self.recurrent_state, output, gen_logodds = self.model.gen_token(
-            self.cur_item.node_type,
-            self.recurrent_state,
-            self.prev_action_emb,
-            self.cur_item.parent_h,
-            self.cur_item.parent_action_emb,
-            self.desc_enc,
+        self.recurrent_state, output, gen_logodds = self._call_model(
+            "gen_token", self.cur_item.node_type
         )
         self.update_prev_action_emb = TreeTraversal._update_prev_action_emb_gen_token
         choices = self.token_choice(output, gen_logodds)
@@ -369,14 +442,7 @@ class TreeTraversal:
     def process_pointer_inquire(self, last_choice):
         # a. Ask which one to choose
         output, self.recurrent_state, logits, attention_probs, memory_pointer_probs = (
-            self.model.compute_pointer_with_align(
-                self.cur_item.node_type,
-                self.recurrent_state,
-                self.prev_action_emb,
-                self.cur_item.parent_h,
-                self.cur_item.parent_action_emb,
-                self.desc_enc,
-            )
+            self._call_model("compute_pointer_with_align", self.cur_item.node_type)
         )
         self.cur_item = attr.evolve(
             self.cur_item, state=TreeTraversal.State.POINTER_APPLY, parent_h=output
@@ -14,6 +14,24 @@ from source.text2sql.ratsql.datasets.utils import db_utils
 from source.text2sql.ratsql.models import abstract_preproc, attention
 from source.text2sql.ratsql.utils import registry
 
+# Intent labels, in the order of the classifier outputs
+OUTPUT_CLASSES = [
+    "ambiguous",
+    "infer_sql",
+    "addtion",
+    "sorry",
+    "cannot_answer",
+    "not_related",
+    "greeting",
+    "good_bye",
+    "cannot_understand",
+    "inform_sql:",
+    "affirm",
+    "negate",
+    "thank_you",
+    "inform_sql",
+]
+
 
 @attr.s
 class NL2IntentDecoderPreprocItem:
@@ -93,22 +111,7 @@ class NL2IntentDecoder(torch.nn.Module):
     ):
         super().__init__()
         self.preproc = preproc
-        self.output_classes = [
-            "ambiguous",
-            "infer_sql",
-            "addtion",
-            "sorry",
-            "cannot_answer",
-            "not_related",
-            "greeting",
-            "good_bye",
-            "cannot_understand",
-            "inform_sql:",
-            "affirm",
-            "negate",
-            "thank_you",
-            "inform_sql",
-        ]
+        self.output_classes = list(OUTPUT_CLASSES)
         self.enc_recurrent_size = enc_recurrent_size
         self.recurrent_size = recurrent_size
 
@@ -1,6 +1,7 @@
 import operator
 
 import attr
+import torch
 import networkx as nx
 
 from source.text2sql.ratsql.beam_search import Hypothesis
@@ -19,13 +20,60 @@ class Hypothesis4Filtering(Hypothesis):
     column_index = attr.ib(factory=list)
 
 
+def top_candidates(hyps, size):
+    """The size best expansions of hyps, as (hyp, choice, choice_score, cum_score).
+
+    The scores of all expansions are ranked in one tensor, and only those of
+    the kept ones are copied to the host, in one transfer. Expansions are
+    ordered as by a stable sort of the candidates of hyps on cum_score, so
+    that ties resolve as with a list sort. Scores are added in double
+    precision, as Python floats would.
+    """
+    expansions = [(hyp, choice) for hyp in hyps for choice, _ in hyp.next_choices]
+    size = min(size, len(expansions))
+    if size <= 0:
+        return []
+    choice_scores = torch.cat(
+        [
+            torch.stack([choice_score for _, choice_score in hyp.next_choices])
+            for hyp in hyps
+            if hyp.next_choices
+        ]
+    ).double()
+    hyp_scores = torch.tensor(
+        [float(hyp.score) for hyp in hyps for _ in hyp.next_choices],
+        dtype=torch.double,
+        device=choice_scores.device,
+    )
+    cum_scores = choice_scores + hyp_scores
+    _, indices = torch.sort(cum_scores, descending=True, stable=True)
+    indices = indices[:size]
+    top = torch.stack(
+        [indices.double(), choice_scores[indices], cum_scores[indices]]
+    ).tolist()
+    return [
+        (*expansions[int(index)], choice_score, cum_score)
+        for index, choice_score, cum_score in zip(*top)
+    ]
+
+
 def beam_search_with_heuristics(
-    model, orig_item, preproc_item, beam_size, max_steps, from_cond=True
+    model,
+    orig_item,
+    preproc_item,
+    beam_size,
+    max_steps,
+    from_cond=True,
+    enc_state=None,
 ):
     """
     Find the valid FROM clasue with beam search
+
+    enc_state can be given when the item was already encoded as part of a batch
     """
-    inference_state, next_choices = model.begin_inference(orig_item, preproc_item)
+    inference_state, next_choices = model.begin_inference(
+        orig_item, preproc_item, enc_state=enc_state
+    )
     beam = [Hypothesis4Filtering(inference_state, next_choices)]
 
     cached_finished_seqs = []  # cache filtered trajectories
@@ -37,7 +85,7 @@ def beam_search_with_heuristics(
             if len(prefixes2fill_from) >= beam_size:
                 break
 
-            candidates = []
+            expanded = []
             for hyp in beam_prefix:
                 # print(hyp.inference_state.cur_item.state, hyp.inference_state.cur_item.node_type )
                 if (
@@ -47,23 +95,12 @@ def beam_search_with_heuristics(
                 ):
                     prefixes2fill_from.append(hyp)
                 else:
-                    candidates += [
-                        (
-                            hyp,
-                            choice,
-                            choice_score.item(),
-                            hyp.score + choice_score.item(),
-                        )
-                        for choice, choice_score in hyp.next_choices
-                    ]
-            candidates.sort(key=operator.itemgetter(3), reverse=True)
-            candidates = candidates[: beam_size - len(prefixes2fill_from)]
+                    expanded.append(hyp)
+            candidates = top_candidates(expanded, beam_size - len(prefixes2fill_from))
 
             # Create the new hypotheses from the expansions
-            beam_prefix = []
+            histories = []
             for hyp, choice, choice_score, cum_score in candidates:
-                inference_state = hyp.inference_state.clone()
-
                 # cache column choice
                 column_history = hyp.column_history[:]
                 if (
@@ -74,29 +111,13 @@ def beam_search_with_heuristics(
                     column_history = column_history + [choice]
                     column_index = len(hyp.choice_history)
 
-                next_choices = inference_state.step(choice)
-                assert next_choices is not None
                 if column_history == []:
-                    beam_prefix.append(
-                        Hypothesis4Filtering(
-                            inference_state,
-                            next_choices,
-                            cum_score,
-                            hyp.choice_history + [choice],
-                            hyp.score_history + [choice_score],
-                            column_history,
-                        )
-                    )
+                    histories.append((column_history, []))
                 else:
-                    beam_prefix.append(
-                        Hypothesis4Filtering(
-                            inference_state,
-                            next_choices,
-                            cum_score,
-                            hyp.choice_history + [choice],
-                            hyp.score_history + [choice_score],
+                    histories.append(
+                        (
                             column_history,
-                            column_index=(
+                            (
                                 hyp.column_index
                                 if column_index in hyp.column_index
                                 else hyp.column_index + [column_index]
@@ -104,6 +125,30 @@ def beam_search_with_heuristics(
                         )
                     )
 
+            inference_states = [hyp.inference_state.clone() for hyp, *_ in candidates]
+            all_next_choices = TreeTraversal.step_batch(
+                inference_states, [choice for _, choice, *_ in candidates]
+            )
+            beam_prefix = []
+            for (
+                (hyp, choice, choice_score, cum_score),
+                (column_history, column_index),
+                inference_state,
+                next_choices,
+            ) in zip(candidates, histories, inference_states, all_next_choices):
+                assert next_choices is not None
+                beam_prefix.append(
+                    Hypothesis4Filtering(
+                        inference_state,
+                        next_choices,
+                        cum_score,
+                        hyp.choice_history + [choice],
+                        hyp.score_history + [choice_score],
+                        column_history,
+                        column_index=column_index,
+                    )
+                )
+
         prefixes2fill_from.sort(key=operator.attrgetter("score"), reverse=True)
         # assert len(prefixes) == beam_size
 
@@ -116,7 +161,7 @@ def beam_search_with_heuristics(
             if len(unfiltered_finished) + len(prefixes_unfinished) > max_size:
                 break
 
-            candidates = []
+            expanded = []
             for hyp in beam_from:
                 if (
                     step > 0
@@ -126,22 +171,19 @@ def beam_search_with_heuristics(
                 ):
                     prefixes_unfinished.append(hyp)
                 else:
-                    candidates += [
-                        (
-                            hyp,
-                            choice,
-                            choice_score.item(),
-                            hyp.score + choice_score.item(),
-                        )
-                        for choice, choice_score in hyp.next_choices
-                    ]
-            candidates.sort(key=operator.itemgetter(3), reverse=True)
-            candidates = candidates[: max_size - len(prefixes_unfinished)]
+                    expanded.append(hyp)
+            candidates = top_candidates(expanded, max_size - len(prefixes_unfinished))
 
+            inference_states = [hyp.inference_state.clone() for hyp, *_ in candidates]
+            all_next_choices = TreeTraversal.step_batch(
+                inference_states, [choice for _, choice, *_ in candidates]
+            )
             beam_from = []
-            for hyp, choice, choice_score, cum_score in candidates:
-                inference_state = hyp.inference_state.clone()
-
+            for (
+                (hyp, choice, choice_score, cum_score),
+                inference_state,
+                next_choices,
+            ) in zip(candidates, inference_states, all_next_choices):
                 # cache table choice
                 table_history = hyp.table_history[:]
                 key_column_history = hyp.key_column_history[:]
@@ -154,7 +196,6 @@ def beam_search_with_heuristics(
                     elif hyp.inference_state.cur_item.node_type == "column":
                         key_column_history = key_column_history + [choice]
 
-                next_choices = inference_state.step(choice)
                 if next_choices is None:
                     unfiltered_finished.append(
                         Hypothesis4Filtering(
@@ -53,11 +53,18 @@ def compute_pointer_with_align(
         parent_action_emb, desc_enc)
     # output shape: batch (=1) x emb_size
     output = new_state[0]
+    pointer_logits, memory_pointer_probs = pointer_logits_with_align(
+        model, node_type, output, desc_enc)
+    return output, new_state, pointer_logits, attention_weights, memory_pointer_probs
+
+
+def pointer_logits_with_align(model, node_type, output, desc_enc):
+    '''output: batch x emb_size, with several rows from step_batch'''
     memory_pointer_logits = model.pointers[node_type](
-        output, desc_enc.memory)
+        output, desc_enc.memory.expand(output.shape[0], -1, -1))
     memory_pointer_probs = torch.nn.functional.softmax(
         memory_pointer_logits, dim=1)
-    # pointer_logits shape: batch (=1) x num choices
+    # pointer_logits shape: batch x num choices
     if node_type == "column":
         pointer_probs = torch.mm(memory_pointer_probs, desc_enc.m2c_align_mat)
     else:
@@ -65,4 +72,4 @@ def compute_pointer_with_align(
         pointer_probs = torch.mm(memory_pointer_probs, desc_enc.m2t_align_mat)
     pointer_probs = pointer_probs.clamp(min=1e-9)
     pointer_logits = torch.log(pointer_probs)
-    return output, new_state, pointer_logits, attention_weights, memory_pointer_probs
+    return pointer_logits, memory_pointer_probs
@@ -39,6 +39,9 @@ class SpiderEncoderState:
 
     return_dic = attr.ib(default=None)
 
+    # BERT output at [CLS], read by the intent and confidence heads
+    pooled = attr.ib(default=None)
+
     def find_word_occurrences(self, word):
         return [i for i, w in enumerate(self.words) if w == word]
 
@@ -1144,6 +1147,9 @@ class SpiderEncoderBert(torch.nn.Module):
         self.bert_model.resize_token_embeddings(
             len(self.tokenizer)
         )  # several tokens added
+        # Shape-bucketed graph of bert_model for inference, installed by
+        # source.text2sql.compiled_encoder.compile_encoder
+        self.compiled_bert = None
 
     @property
     def _device(self):
@@ -1356,12 +1362,18 @@ class SpiderEncoderBert(torch.nn.Module):
                     )
                     bert_attentions = bert_output.attentions
                     bert_output = bert_output[0]
+                elif self.compiled_bert is not None:
+                    bert_output = self.compiled_bert(
+                        tokens_tensor, att_masks_tensor, tok_type_tensor
+                    )
                 else:
                     bert_output = self.bert_model(
                         tokens_tensor,
                         attention_mask=att_masks_tensor,
                         token_type_ids=tok_type_tensor,
                     )[0]
+            elif self.compiled_bert is not None and not debug:
+                bert_output = self.compiled_bert(tokens_tensor, att_masks_tensor)
             else:
                 bert_output = self.bert_model(
                     tokens_tensor, attention_mask=att_masks_tensor
@@ -1468,6 +1480,7 @@ class SpiderEncoderBert(torch.nn.Module):
                     m2c_align_mat=align_mat_item[0],
                     m2t_align_mat=align_mat_item[1],
                     return_dic=return_dic,
+                    pooled=enc_output[bert_batch_idx][0],
                 )
             )
         return result
@@ -495,6 +495,9 @@ class RelationalTransformerUpdate(torch.nn.Module):
         self.align_attn = transformer.PointerWithRelations(
             hidden_size, len(self.relation_ids), dropout, like_t5
         )
+        # Shape-bucketed graph of self.encoder for inference, installed by
+        # source.text2sql.compiled_encoder.compile_encoder
+        self.compiled_encoder = None
 
     @property
     def _device(self):
@@ -532,7 +535,10 @@ class RelationalTransformerUpdate(torch.nn.Module):
         )
 
         relations_t = torch.tensor(relations, dtype=torch.long, device=self._device)
-        enc_new, return_dic = self.encoder(enc, relations_t, mask=None, debug=debug)
+        if self.compiled_encoder is not None and not debug:
+            enc_new, return_dic = self.compiled_encoder(enc, relations_t), None
+        else:
+            enc_new, return_dic = self.encoder(enc, relations_t, mask=None, debug=debug)
 
         # Split updated_enc again
         c_base = q_enc.shape[0]
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+import contextlib
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+from source.text2sql.ratsql.datasets.spider import load_tables
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """Spider schemas with lazily loaded in-memory copies of their databases.
+
+    Schemas are read once from tables.json. The sqlite database of a schema is
+    copied into memory the first time it is acquired and stays there while it
+    is hot; once the loaded databases exceed ``max_bytes``, the least recently
+    used ones that are not in use are dropped again.
+    """
+
+    def __init__(self, db_path: str, table_path: str, max_bytes: Optional[int] = None):
+        """Read the schemas without opening any database.
+
+        Args:
+            db_path: Directory containing <db_id>/<db_id>.sqlite files
+            table_path: Path to the Spider tables.json
+            max_bytes: Memory budget for loaded databases (None for unlimited)
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.schemas = load_tables([table_path], True)[0]
+        self.total_bytes = 0
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Counter = Counter()
+        self._lock = threading.Lock()
+        self._preprocessed_schemas: Dict[str, Dict] = {}
+        self._versions: Dict[str, str] = {}
+
+    def preprocessed_schemas(self, preproc_key: str) -> Dict:
+        """Return the shared db_id -> preprocessed schema dict of one preproc config."""
+        with self._lock:
+            return self._preprocessed_schemas.setdefault(preproc_key, {})
+
+    def schema_version(self, db_id: str) -> Optional[str]:
+        """Return a hash of the tables.json entry of db_id (None if unknown)."""
+        if db_id not in self.schemas:
+            return None
+        if db_id not in self._versions:
+            data = json.dumps(self.schemas[db_id].orig, sort_keys=True)
+            self._versions[db_id] = hashlib.blake2b(
+                data.encode("utf-8"), digest_size=8
+            ).hexdigest()
+        return self._versions[db_id]
+
+    @contextlib.contextmanager
+    def acquire(self, db_id: str) -> Iterator:
+        """Yield the schema of db_id with its in-memory connection attached.
+
+        The database is loaded if needed and cannot be evicted until the
+        context exits.
+        """
+        schema = self.schemas[db_id]
+        with self._lock:
+            self._pins[db_id] += 1
+            if db_id in self._sizes:
+                self._sizes.move_to_end(db_id)
+            else:
+                self._load(db_id)
+                self._evict()
+        try:
+            yield schema
+        finally:
+            with self._lock:
+                self._pins[db_id] -= 1
+                if self._pins[db_id] == 0:
+                    del self._pins[db_id]
+                self._evict()
+
+    def _load(self, db_id: str) -> None:
+        schema = self.schemas[db_id]
+        sqlite_path = Path(self.db_path) / db_id / f"{db_id}.sqlite"
+        size = 0
+        if os.path.isfile(sqlite_path):
+            with sqlite3.connect(str(sqlite_path), check_same_thread=False) as source:
+                dest = sqlite3.connect(":memory:", check_same_thread=False)
+                dest.row_factory = sqlite3.Row
+                source.backup(dest)
+            page_count = dest.execute("PRAGMA page_count").fetchone()[0]
+            page_size = dest.execute("PRAGMA page_size").fetchone()[0]
+            size = page_count * page_size
+            schema.connection = dest
+            logger.info(f"Loaded database {db_id} into memory ({size} bytes)")
+        self._sizes[db_id] = size
+        self.total_bytes += size
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        for db_id in list(self._sizes):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if db_id in self._pins:
+                continue
+            self.total_bytes -= self._sizes.pop(db_id)
+            schema = self.schemas[db_id]
+            if schema.connection is not None:
+                schema.connection.close()
+                schema.connection = None
+            logger.info(f"Evicted database {db_id} from memory")
+
+
+_schema_caches: Dict[Tuple[str, str], SchemaCache] = {}
+_schema_caches_lock = threading.Lock()
+
+
+def get_schema_cache(
+    db_path: str, table_path: str, max_bytes: Optional[int] = None
+) -> SchemaCache:
+    """Return the process-wide SchemaCache for a database directory and tables.json.
+
+    The budget given by the first caller is the one used.
+    """
+    key = (os.path.abspath(db_path), os.path.abspath(table_path))
+    with _schema_caches_lock:
+        if key not in _schema_caches:
+            _schema_caches[key] = SchemaCache(db_path, table_path, max_bytes)
+        return _schema_caches[key]
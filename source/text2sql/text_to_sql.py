@@ -1,12 +1,19 @@
-import os
-import json
 import hydra
-import _jsonnet
-from typing import Tuple, List, Any
+import torch
+import numpy as np
+from typing import Tuple, List, Any, Optional
 from config.path import ABS_CONFIG_DIR
 from omegaconf import DictConfig
-from source.utils import One_time_Preprocesser, add_value_one_sql
-from source.text2sql.ratsql.commands.infer import Inferer
+from source.utils import One_time_Preprocesser
+from source.text2sql.value_store import (
+    build_value_store,
+    fill_values,
+    fill_values_async,
+)
+from source.text2sql.model_registry import load_experiment_config, model_registry
+from source.text2sql.compiled_encoder import compile_encoder, max_difference_from_eager
+from source.text2sql.multitask import HeadPredictions, load_multitask_heads
+from source.serving.metrics import stage_timer
 from source.text2sql.ratsql.models.spider import spider_beam_search
 
 
@@ -22,7 +29,8 @@ class Text2SQL:
 
         Args:
             global_cfg: Global configuration containing database and table paths
-            cfg: Text2SQL-specific configuration with model paths and beam search params
+            cfg: Text2SQL-specific configuration with model paths, beam search params,
+                the quantization scheme of the model and its multi-task heads
             device: Device to load the model on (default: "cuda:0")
 
         Raises:
@@ -34,68 +42,213 @@ class Text2SQL:
         db_path = global_cfg.data.database_path
         table_path = global_cfg.data.table_path
 
-        if os.path.isfile(experiment_config_path):
-            exp_config = json.loads(_jsonnet.evaluate_file(experiment_config_path))
-            model_config_file = exp_config["model_config"]
-            model_config_args = exp_config["model_config_args"]
-            model_config = json.loads(
-                _jsonnet.evaluate_file(
-                    model_config_file,
-                    tla_codes={"args": json.dumps(model_config_args)},
-                )
-            )
-            model_config["model"]["encoder_preproc"]["save_path"] = model_ckpt_dir_path
-            model_config["model"]["decoder_preproc"]["save_path"] = model_ckpt_dir_path
-        else:
-            raise RuntimeError(f"config file does not exist: {experiment_config_path}")
+        model_config = load_experiment_config(
+            experiment_config_path, model_ckpt_dir_path
+        )
 
         self.preprocessor = One_time_Preprocesser(
-            db_path, table_path, model_config["model"]["encoder_preproc"]
+            db_path,
+            table_path,
+            model_config["model"]["encoder_preproc"],
+            db_cache_max_bytes=global_cfg.data.db_cache_max_mb * 2**20,
+            item_cache_size=global_cfg.serving.preproc_cache_size,
+            item_cache_ttl_s=global_cfg.serving.preproc_cache_ttl_s,
         )
 
-        inferer = Inferer(model_config)
-        model, _ = inferer.load_model(model_ckpt_dir_path)
-        model.to(device)
-        self.model = model
+        self.model = model_registry.get_model(
+            model_config,
+            model_ckpt_dir_path,
+            device,
+            quantize=cfg.quantize,
+            joint_weights_path=cfg.multitask.heads_path,
+        )
+        self.heads = None
+        if cfg.multitask.heads_path is not None:
+            self.heads = load_multitask_heads(cfg.multitask.heads_path, self.model)
+        if cfg.compiled_encoder.backend is not None:
+            compile_encoder(self.model, cfg.compiled_encoder)
+        self.value_store = build_value_store(global_cfg.data)
 
     def translate(
-        self, text: str, text_history: str, db_id: str
-    ) -> Tuple[List[Any], str]:
+        self,
+        text: str,
+        text_history: str,
+        db_id: str,
+        item: Optional[Tuple[Any, Any]] = None,
+        beam_size: Optional[int] = None,
+    ) -> Tuple[List[Any], str, Optional[HeadPredictions]]:
         """Translate natural language text to SQL query.
 
         Args:
             text: Current user query text
             text_history: Conversation history with previous queries
             db_id: Database identifier for schema context
+            item: (orig_item, preproc_item) from preprocess, computed if not given
+            beam_size: Beam size overriding the configured one
 
         Returns:
             Tuple containing:
                 - beams: List of beam search results with scores
                 - inferred_code: Generated SQL query string with values filled
+                - heads: Intent and confidence from the multi-task heads, or
+                  None if text2sql.multitask.heads_path is not set
+        """
+        return self.translate_batch([(text, text_history, db_id, item, beam_size)])[0]
+
+    def translate_batch(
+        self,
+        requests: List[Tuple[str, str, str, Optional[Tuple[Any, Any]], Optional[int]]],
+        fill_values: bool = True,
+    ) -> List[Tuple[List[Any], str, Optional[HeadPredictions]]]:
+        """Translate several requests, encoding all of them in one forward pass.
+
+        With multi-task heads loaded, the intent and confidence of each
+        request are read off the same encoder states.
+
+        Args:
+            requests: List of (text, text_history, db_id, item, beam_size)
+                tuples, where item is a precomputed (orig_item, preproc_item)
+                pair or None, and beam_size overrides the configured beam size
+                unless None
+            fill_values: Whether to fill in values from the DB. Callers that do
+                not want DB I/O on the model thread pass False and call
+                fill_values themselves.
+
+        Returns:
+            List of (beams, inferred_code, heads) tuples in the same order as
+            requests (see translate)
+        """
+        items = [
+            item or self.preprocess(text, text_history, db_id)
+            for text, text_history, db_id, item, _ in requests
+        ]
+
+        results = []
+        with torch.no_grad():
+            with stage_timer("encoder"):
+                enc_states = self.model.encode_batch(
+                    [(preproc_item, None) for _, preproc_item in items]
+                )
+            for request, (orig_item, preproc_item), enc_state in zip(
+                requests, items, enc_states
+            ):
+                text, text_history, db_id, _, beam_size = request
+                with stage_timer("beam_search"):
+                    beams = spider_beam_search.beam_search_with_heuristics(
+                        self.model,
+                        orig_item,
+                        (preproc_item, None),
+                        beam_size=beam_size or self.cfg.beam_size,
+                        max_steps=self.cfg.max_steps,
+                        enc_state=enc_state,
+                    )
+
+                _, inferred_code = beams[0].inference_state.finalize()
+
+                if fill_values:
+                    inferred_code = self.fill_values(
+                        text, text_history, db_id, inferred_code
+                    )
+                results.append((beams, inferred_code))
+
+            if self.heads is None:
+                predictions = [None] * len(results)
+            else:
+                with stage_timer("heads"):
+                    predictions = self.heads.predict(
+                        enc_states, [beams for beams, _ in results]
+                    )
+
+        return [
+            (beams, inferred_code, heads)
+            for (beams, inferred_code), heads in zip(results, predictions)
+        ]
+
+    def check_compiled_encoder(self, questions: List[Tuple[str, str]]) -> None:
+        """Compare the compiled encoder path with eager mode on some questions.
+
+        Does nothing unless text2sql.compiled_encoder.backend is set.
+
+        Args:
+            questions: (text, db_id) pairs, encoded as one batch
+
+        Raises:
+            RuntimeError: If the outputs differ by more than the configured
+                tolerance
+        """
+        if self.cfg.compiled_encoder.backend is None:
+            return
+        enc_inputs = [
+            preproc_item
+            for _, preproc_item in (
+                self.preprocess(text, "", db_id) for text, db_id in questions
+            )
+        ]
+        difference = max_difference_from_eager(self.model, enc_inputs)
+        if difference > self.cfg.compiled_encoder.tolerance:
+            raise RuntimeError(
+                f"Compiled encoder differs from eager mode by {difference:.2e}"
+            )
+
+    def fill_values(
+        self, text: str, text_history: str, db_id: str, inferred_code: str
+    ) -> str:
+        """Replace the value placeholders of a translation with values from the DB.
+
+        Args:
+            text: Current user query text
+            text_history: Conversation history with previous queries
+            db_id: Database identifier
+            inferred_code: SQL returned by translate_batch(..., fill_values=False)
+
+        Returns:
+            SQL query string with values filled
         """
-        orig_item, preproc_item = self.preprocess(text, text_history, db_id)
         if not text_history.endswith(text):
             text_history += " <s> " + text
+        with stage_timer("value_filling"):
+            return fill_values(
+                self.value_store, text, db_id, inferred_code, text_history
+            )
 
-        beams = spider_beam_search.beam_search_with_heuristics(
-            self.model,
-            orig_item,
-            (preproc_item, None),
-            beam_size=self.cfg.beam_size,
-            max_steps=self.cfg.max_steps,
-        )
+    async def fill_values_async(
+        self, text: str, text_history: str, db_id: str, inferred_code: str
+    ) -> str:
+        """Variant of fill_values that queries the DB without blocking the event loop."""
+        if not text_history.endswith(text):
+            text_history += " <s> " + text
+        with stage_timer("value_filling"):
+            return await fill_values_async(
+                self.value_store, text, db_id, inferred_code, text_history
+            )
 
-        _, inferred_code = beams[0].inference_state.finalize()
+    def schema_version(self, db_id: str) -> Optional[str]:
+        """Hash of the schema of db_id, to tell apart results cached for older schemas."""
+        return self.preprocessor.schema_cache.schema_version(db_id)
 
-        inferred_code = add_value_one_sql(
-            question=text, db_name=db_id, sql=inferred_code, history=text_history
-        )
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed input texts with the BERT model of the loaded encoder.
 
-        return beams, inferred_code
+        Args:
+            texts: Input texts as built by preprocess ("<s> " + text + text_history)
 
-    def preprocess(
-        self, text: str, text_history: str, db_id: str
-    ) -> Tuple[Any, Any]:
+        Returns:
+            Array of shape (len(texts), hidden_size) with L2-normalized mean-pooled
+            token embeddings
+        """
+        encoder = self.model.encoder
+        device = next(encoder.bert_model.parameters()).device
+        with torch.no_grad():
+            batch = encoder.tokenizer(
+                texts, padding=True, truncation=True, return_tensors="pt"
+            ).to(device)
+            hidden = encoder.bert_model(**batch).last_hidden_state
+            mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
+        return embeddings.cpu().numpy()
+
+    def preprocess(self, text: str, text_history: str, db_id: str) -> Tuple[Any, Any]:
         """Preprocess input text with conversation history for model inference.
 
         Args:
@@ -107,9 +260,14 @@ class Text2SQL:
             Tuple containing:
                 - orig_item: Original preprocessed item with schema information
                 - preproc_item: Model-ready preprocessed item with encoded features
+
+        Note:
+            Recently preprocessed inputs are served from a short-lived cache, so
+            the returned items are shared and must not be modified.
         """
         input_text = "<s> " + text + text_history
-        orig_item, preproc_item = self.preprocessor.run(input_text, db_id)
+        with stage_timer("preprocess"):
+            orig_item, preproc_item = self.preprocessor.run(input_text, db_id)
         return orig_item, preproc_item
 
 
@@ -117,7 +275,7 @@ class Text2SQL:
 def main(cfg: DictConfig) -> None:
     """Main function for testing Text2SQL translation."""
     translator = Text2SQL(cfg, cfg.text2sql)
-    _, inferred_code = translator.translate(
+    _, inferred_code, _ = translator.translate(
         "<s> How many concerts are there in",
         "<s> How many concerts are there in",
         "concert_singer",
@@ -0,0 +1,76 @@
+import asyncio
+import sqlite3
+import contextlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+from source.utils import (
+    add_value_one_sql,
+    all_values_from_db,
+    all_values_from_db_async,
+    terminal_columns,
+)
+
+
+class PostgresValueStore:
+    """Column values from the Postgres copies of the databases."""
+
+    def fetch(self, db_id: str, table: str, column: str) -> List[str]:
+        return all_values_from_db(db_id, table, column)
+
+    async def fetch_async(self, db_id: str, table: str, column: str) -> List[str]:
+        return await all_values_from_db_async(db_id, table, column)
+
+
+class SqliteValueStore:
+    """Column values read from the Spider sqlite files, for setups without Postgres."""
+
+    def __init__(self, database_path: str):
+        """Initialize the store.
+
+        Args:
+            database_path: Directory containing <db_id>/<db_id>.sqlite files
+        """
+        self.database_path = Path(database_path)
+
+    def fetch(self, db_id: str, table: str, column: str) -> List[str]:
+        sqlite_path = self.database_path / db_id / f"{db_id}.sqlite"
+        with contextlib.closing(
+            sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        ) as conn:
+            return [
+                str(row[0]) for row in conn.execute(f"SELECT {column} FROM {table}")
+            ]
+
+    async def fetch_async(self, db_id: str, table: str, column: str) -> List[str]:
+        return await asyncio.to_thread(self.fetch, db_id, table, column)
+
+
+def fill_values(store, question: str, db_id: str, sql: str, history: str) -> str:
+    """Run add_value_one_sql with the column values fetched from store."""
+    columns = list(dict.fromkeys(terminal_columns(sql)))
+    column_values: Dict[Tuple[str, str], List[str]] = {
+        (table, column): store.fetch(db_id, table, column) for table, column in columns
+    }
+    return add_value_one_sql(question, db_id, sql, history, column_values=column_values)
+
+
+async def fill_values_async(
+    store, question: str, db_id: str, sql: str, history: str
+) -> str:
+    """fill_values with the column values fetched concurrently on the event loop."""
+    columns = list(dict.fromkeys(terminal_columns(sql)))
+    values = await asyncio.gather(
+        *(store.fetch_async(db_id, table, column) for table, column in columns)
+    )
+    return add_value_one_sql(
+        question, db_id, sql, history, column_values=dict(zip(columns, values))
+    )
+
+
+def build_value_store(data_cfg):
+    """Create the value store selected by data.value_store ("postgres" or "sqlite")."""
+    if data_cfg.value_store == "postgres":
+        return PostgresValueStore()
+    elif data_cfg.value_store == "sqlite":
+        return SqliteValueStore(data_cfg.database_path)
+    raise ValueError(f"Unknown value store: {data_cfg.value_store}")
@@ -1,45 +1,75 @@
-import os
-import tqdm
-import sqlite3
-from pathlib import Path
+import json
 from source.text2sql.ratsql.models.spider.spider_enc import (
     SpiderEncoderBertPreproc,
     Bertokens,
 )
-from source.text2sql.ratsql.datasets.spider import load_tables, SpiderItem
+from source.text2sql.ratsql.datasets.spider import SpiderItem
+from source.text2sql.schema_cache import get_schema_cache
+from source.serving.lru import TTLCache
+from source.serving.metrics import record_cache_lookup
 
 from typing import *
 
+import threading
 import en_core_web_trf
+import psycopg
 import psycopg2
 import spacy
 
-model = spacy.load("en_core_web_trf")
-model = en_core_web_trf.load()
+_spacy_model: Optional[spacy.Language] = None
+_spacy_model_lock = threading.Lock()
+
+
+def get_spacy_model() -> spacy.Language:
+    """spaCy pipeline used to find nouns, loaded once on first use."""
+    global _spacy_model
+    with _spacy_model_lock:
+        if _spacy_model is None:
+            _spacy_model = en_core_web_trf.load()
+        return _spacy_model
 
 
 class One_time_Preprocesser:
-    def __init__(self, db_path, table_path, preproc_args):
+    def __init__(
+        self,
+        db_path,
+        table_path,
+        preproc_args,
+        db_cache_max_bytes=None,
+        item_cache_size=0,
+        item_cache_ttl_s=60,
+    ):
         self.enc_preproc = SpiderEncoderBertPreproc(**preproc_args)
         self.bert_version = preproc_args["bert_version"]
-        self.schemas = load_tables([table_path], True)[0]
-        self._conn(db_path)
-
-    def _conn(self, db_path):
-        # Backup in-memory copies of all the DBs and create the live connections
-        for db_id, schema in tqdm.tqdm(self.schemas.items(), desc="DB connections"):
-            sqlite_path = Path(db_path) / db_id / f"{db_id}.sqlite"
-            source: sqlite3.Connection
-            if os.path.isfile(sqlite_path):
-                with sqlite3.connect(
-                    str(sqlite_path), check_same_thread=False
-                ) as source:
-                    dest = sqlite3.connect(":memory:", check_same_thread=False)
-                    dest.row_factory = sqlite3.Row
-                    source.backup(dest)
-                schema.connection = dest
+        # Schemas and in-memory DB copies are shared by all preprocessors
+        self.schema_cache = get_schema_cache(db_path, table_path, db_cache_max_bytes)
+        self.schemas = self.schema_cache.schemas
+        self.enc_preproc.preprocessed_schemas = self.schema_cache.preprocessed_schemas(
+            json.dumps(preproc_args, sort_keys=True)
+        )
+        # Recently preprocessed items, so that all stages of a request (and
+        # repeated questions) share one preprocessing pass. The cached items
+        # are shared and must not be modified by callers.
+        self.item_cache = (
+            TTLCache(maxsize=item_cache_size, ttl_seconds=item_cache_ttl_s)
+            if item_cache_size > 0
+            else None
+        )
 
     def run(self, text, db_id):
+        # Whitespace does not change the BERT tokenization
+        text = " ".join(text.split())
+        if self.item_cache is None:
+            return self._run(text, db_id)
+        key = (text, db_id)
+        items = self.item_cache.get(key)
+        record_cache_lookup("preproc", items is not None)
+        if items is None:
+            items = self._run(text, db_id)
+            self.item_cache.set(key, items)
+        return items
+
+    def _run(self, text, db_id):
         schema = self.schemas[db_id]
         # Validate
         question = self.enc_preproc._tokenize(text.split(" "), text)
@@ -59,7 +89,9 @@ class One_time_Preprocesser:
             preproc_schema.normalized_column_names,
             preproc_schema.normalized_table_names,
         )
-        cv_link = question_bert_tokens.bert_cv_linking(schema)
+        # The DB is loaded on first use and kept in memory while it is linked
+        with self.schema_cache.acquire(db_id):
+            cv_link = question_bert_tokens.bert_cv_linking(schema)
         spider_item = SpiderItem(
             text=text,
             code=None,
@@ -89,12 +121,13 @@ class One_time_Preprocesser:
 
 
 def extract_nouns(
-    sentence: str, enable_PROPN: bool = False, model: spacy.Language = model
+    sentence: str, enable_PROPN: bool = False, model: Optional[spacy.Language] = None
 ) -> List[str]:
     # Define target POS tags
     target_pos = ["PROPN", "NOUN"] if enable_PROPN else ["NOUN"]
 
     # Perform parsing
+    model = model or get_spacy_model()
     parsed_doc = model(sentence)
 
     print(sentence)
@@ -205,11 +238,13 @@ def token_score_to_word_score(
     return final_words, final_scores
 
 
+def _values_db_config(db_name: str) -> str:
+    return f"host=localhost port=5434 user=sqlbot password=sqlbot_pw dbname={db_name}"
+
+
 def all_values_from_db(db_name: str, table_name: str, column_name: str) -> List[str]:
     # Connect to DB
-    pg_config = (
-        f"host=localhost port=5434 user=sqlbot password=sqlbot_pw dbname={db_name}"
-    )
+    pg_config = _values_db_config(db_name)
     # Find value from DB (For string values)
     with psycopg2.connect(pg_config) as conn:
         with conn.cursor() as cursor:
@@ -221,8 +256,44 @@ def all_values_from_db(db_name: str, table_name: str, column_name: str) -> List[
             return [str(result[0]) for result in results]
 
 
-def add_value_one_sql(question: str, db_name: str, sql: str, history: str) -> str:
-    """Assumption: There are no repeated values in the question."""
+async def all_values_from_db_async(
+    db_name: str, table_name: str, column_name: str
+) -> List[str]:
+    """Non-blocking variant of all_values_from_db for the event loop."""
+    async with await psycopg.AsyncConnection.connect(
+        _values_db_config(db_name)
+    ) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"SELECT {column_name} FROM {table_name}")
+            results = await cursor.fetchall()
+            return [str(result[0]) for result in results]
+
+
+def terminal_columns(sql: str) -> List[Tuple[str, str]]:
+    """(table, column) compared against each 'terminal' placeholder of sql."""
+    columns = []
+    start = 0
+    while "'terminal'" in sql[start:]:
+        terminal_start_idx = sql.index("'terminal'", start)
+        tab_col = sql[:terminal_start_idx].strip().split(" ")[-2]
+        table, column = tab_col.split(".")
+        columns.append((table, column))
+        start = terminal_start_idx + len("'terminal'")
+    return columns
+
+
+def add_value_one_sql(
+    question: str,
+    db_name: str,
+    sql: str,
+    history: str,
+    column_values: Optional[Dict[Tuple[str, str], List[str]]] = None,
+) -> str:
+    """Assumption: There are no repeated values in the question.
+
+    column_values optionally provides prefetched values of the columns compared
+    against the placeholders (see terminal_columns) instead of querying the DB.
+    """
     # Parse history
     history_list = history.lower().split("<s>")
 
@@ -244,7 +315,10 @@ def add_value_one_sql(question: str, db_name: str, sql: str, history: str) -> st
         tab_col = sql[:terminal_start_idx].strip().split(" ")[-2]
         table, column = tab_col.split(".")
         # Find all possible values for the column
-        values = all_values_from_db(db_name, table, column)
+        if column_values is not None:
+            values = column_values[(table, column)]
+        else:
+            values = all_values_from_db(db_name, table, column)
         # Check if any of the values are in the question
         for value in values:
             if value.lower() in target_text:
@@ -0,0 +1,44 @@
+import socket
+import asyncio
+import threading
+from typing import Callable, Iterator
+
+import pytest
+from aiohttp import web
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def serve_app() -> Iterator[Callable[..., str]]:
+    """Serve aiohttp apps on local ports from a thread of their own.
+
+    Yields a function taking an app (and optionally a port) and returning the
+    base URL it is served on; the apps are stopped after the test.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    def serve(app: web.Application, port: int = 0) -> str:
+        port = port or _free_port()
+        runner = web.AppRunner(app)
+
+        async def start() -> None:
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+
+        asyncio.run_coroutine_threadsafe(start(), loop).result()
+        runners.append(runner)
+        return f"http://127.0.0.1:{port}"
+
+    yield serve
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
@@ -0,0 +1,248 @@
+import time
+import asyncio
+import concurrent.futures
+from typing import Dict, List
+
+import pytest
+from aiohttp import web
+
+from source.serving import llm_gateway
+from source.serving.fake_llm import CHARS_PER_TOKEN, fake_llm_app
+from source.serving.llm_gateway import LLMGateway, LLMGatewayError
+from source.serving.metrics import LLM_PROMPT_TOKENS
+
+SUMMARY = "The table lists the requested rows."
+SAMPLING = {"max_new_tokens": 16}
+
+
+class Recorder:
+    """Requests seen by a fake LLM server, which can also fail the first ones."""
+
+    def __init__(self, fail_first: int = 0, failure: str = "503"):
+        self.fail_first = fail_first
+        self.failure = failure
+        self.requests: List[Dict] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests.append(await request.json())
+        if len(self.requests) <= self.fail_first:
+            if self.failure == "drop":
+                request.transport.close()
+            return web.json_response({"error": "overloaded"}, status=503)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.fixture
+def fake_llm(serve_app):
+    """Start a fake LLM server; returns its /generate URL and its Recorder."""
+
+    def start(latency_ms: float = 20, **recorder_args):
+        recorder = Recorder(**recorder_args)
+        app = fake_llm_app(latency_ms=latency_ms)
+        app.middlewares.append(recorder.middleware)
+        return serve_app(app) + "/generate", recorder
+
+    return start
+
+
+@pytest.fixture
+def gateways():
+    """Build LLMGateways closed after the test."""
+    built = []
+
+    def build(**kwargs) -> LLMGateway:
+        built.append(LLMGateway(**kwargs))
+        return built[-1]
+
+    yield build
+    for gateway in built:
+        gateway.close()
+
+
+def _texts(requests: List[Dict]) -> List[List[str]]:
+    return [request["text"] for request in requests]
+
+
+def test_concurrency_is_bounded(fake_llm, gateways):
+    address, recorder = fake_llm(latency_ms=100)
+    gateway = gateways(max_concurrency=2, prime_prefixes=False)
+    futures = [
+        gateway.submit(address, f"question {i}", SAMPLING, timeout_s=10)
+        for i in range(8)
+    ]
+    assert [future.result() for future in futures] == [SUMMARY] * 8
+    assert len(recorder.requests) == 8
+    assert recorder.max_in_flight == 2
+
+
+@pytest.mark.parametrize("failure", ["503", "drop"])
+def test_failures_are_retried_with_jitter(fake_llm, gateways, monkeypatch, failure):
+    address, recorder = fake_llm(fail_first=2, failure=failure)
+    bounds = []
+
+    def uniform(low: float, high: float) -> float:
+        bounds.append((low, high))
+        return high / 2
+
+    monkeypatch.setattr(llm_gateway.random, "uniform", uniform)
+    gateway = gateways(retries=2, backoff_ms=40, prime_prefixes=False)
+    assert gateway.generate(address, "question", SAMPLING, timeout_s=10) == SUMMARY
+    assert len(recorder.requests) == 3
+    # Full jitter below a bound doubling per attempt
+    assert bounds == [(0, 0.04), (0, 0.08)]
+
+
+def test_retries_are_limited(fake_llm, gateways):
+    address, recorder = fake_llm(fail_first=5)
+    gateway = gateways(retries=1, backoff_ms=1, prime_prefixes=False)
+    with pytest.raises(LLMGatewayError):
+        gateway.generate(address, "question", SAMPLING, timeout_s=10)
+    assert len(recorder.requests) == 2
+
+
+def test_slow_answer_fails_at_the_deadline(fake_llm, gateways):
+    address, _ = fake_llm(latency_ms=3000)
+    gateway = gateways(prime_prefixes=False)
+    start = time.monotonic()
+    with pytest.raises(LLMGatewayError):
+        gateway.generate(address, "question", SAMPLING, timeout_s=0.3)
+    assert time.monotonic() - start < 1
+
+
+def test_wait_for_a_slot_is_bounded_by_the_deadline(fake_llm, gateways):
+    address, recorder = fake_llm(latency_ms=2000)
+    gateway = gateways(max_concurrency=1, prime_prefixes=False)
+    busy = gateway.submit(address, "first", SAMPLING, timeout_s=10)
+    while not recorder.requests:
+        time.sleep(0.01)
+    start = time.monotonic()
+    with pytest.raises(LLMGatewayError, match="No free slot"):
+        gateway.generate(address, "second", SAMPLING, timeout_s=0.3)
+    assert time.monotonic() - start < 1
+    assert busy.result() == SUMMARY
+    assert len(recorder.requests) == 1
+
+
+def test_generate_returns_when_the_gateway_loop_stalls(fake_llm, gateways):
+    address, _ = fake_llm()
+    gateway = gateways(prime_prefixes=False)
+    # Block the event loop of the gateway, as a stuck callback would
+    gateway._loop.call_soon_threadsafe(time.sleep, 1.5)
+    start = time.monotonic()
+    with pytest.raises(LLMGatewayError):
+        gateway.generate(address, "question", SAMPLING, timeout_s=0.2)
+    elapsed = time.monotonic() - start
+    assert elapsed < 0.2 + llm_gateway.RESULT_GRACE_S + 0.5
+
+
+def test_generate_async_returns_when_the_gateway_loop_stalls(fake_llm, gateways):
+    address, _ = fake_llm()
+    gateway = gateways(prime_prefixes=False)
+    gateway._loop.call_soon_threadsafe(time.sleep, 1.5)
+
+    async def generate() -> str:
+        return await gateway.generate_async(address, "question", SAMPLING, 0.2)
+
+    start = time.monotonic()
+    with pytest.raises(LLMGatewayError):
+        asyncio.run(generate())
+    assert time.monotonic() - start < 0.2 + llm_gateway.RESULT_GRACE_S + 0.5
+
+
+def test_prompts_are_batched(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways(batch_window_ms=100, max_batch_size=8, prime_prefixes=False)
+    futures = [
+        gateway.submit(address, f"question {i}", SAMPLING, timeout_s=10)
+        for i in range(5)
+    ]
+    assert [future.result() for future in futures] == [SUMMARY] * 5
+    assert _texts(recorder.requests) == [[f"question {i}" for i in range(5)]]
+
+
+def test_batches_are_cut_at_max_batch_size(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways(batch_window_ms=100, max_batch_size=2, prime_prefixes=False)
+    futures = [
+        gateway.submit(address, f"question {i}", SAMPLING, timeout_s=10)
+        for i in range(5)
+    ]
+    concurrent.futures.wait(futures)
+    assert sorted(len(texts) for texts in _texts(recorder.requests)) == [1, 2, 2]
+
+
+def test_only_prompts_with_the_same_sampling_share_a_batch(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways(batch_window_ms=100, prime_prefixes=False)
+    futures = [
+        gateway.submit(address, "short", {"max_new_tokens": 8}, timeout_s=10),
+        gateway.submit(address, "long", {"max_new_tokens": 64}, timeout_s=10),
+    ]
+    concurrent.futures.wait(futures)
+    assert sorted(_texts(recorder.requests)) == [["long"], ["short"]]
+
+
+def _prefix(name: str) -> str:
+    # Instruction and few-shot examples, ending at a line break
+    return "".join(
+        f"{name} example {i}: a question and its answer\n" for i in range(20)
+    )
+
+
+def _primings(recorder: Recorder, prefix: str) -> int:
+    return sum(texts == [prefix] for texts in _texts(recorder.requests))
+
+
+def test_prefix_is_primed_once(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways()
+    prefix = _prefix("tune")
+    hits = LLM_PROMPT_TOKENS.value(cache="hit")
+    futures = [
+        gateway.submit(address, f"user: question {i}\n", SAMPLING, 10, prefix)
+        for i in range(5)
+    ]
+    assert [future.result() for future in futures] == [SUMMARY] * 5
+    assert gateway.generate(address, "user: last\n", SAMPLING, 10, prefix) == SUMMARY
+    # The prefix went alone first, then every prompt found it cached
+    assert _texts(recorder.requests)[0] == [prefix]
+    assert _primings(recorder, prefix) == 1
+    assert len(recorder.requests) == 7
+    cached = len(prefix) // CHARS_PER_TOKEN
+    assert LLM_PROMPT_TOKENS.value(cache="hit") - hits >= 6 * cached
+
+
+def test_prefix_is_primed_again_after_ttl(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways(prime_ttl_s=0.3)
+    prefix = _prefix("tune")
+    gateway.generate(address, "user: first\n", SAMPLING, 10, prefix)
+    gateway.generate(address, "user: second\n", SAMPLING, 10, prefix)
+    assert _primings(recorder, prefix) == 1
+    # The server may have evicted the prefix since
+    time.sleep(0.4)
+    gateway.generate(address, "user: third\n", SAMPLING, 10, prefix)
+    assert _primings(recorder, prefix) == 2
+
+
+def test_primed_prefixes_are_bounded(fake_llm, gateways):
+    address, recorder = fake_llm()
+    gateway = gateways(max_primed=2)
+    prefixes = [_prefix(name) for name in ["tune", "table", "intent"]]
+    for prefix in prefixes:
+        gateway.generate(address, "user: question\n", SAMPLING, 10, prefix)
+    assert len(gateway._primed) == 2
+    # The least recently used prefix was forgotten and is primed again
+    gateway.generate(address, "user: question\n", SAMPLING, 10, prefixes[0])
+    assert len(gateway._primed) == 2
+    assert [_primings(recorder, prefix) for prefix in prefixes] == [2, 1, 1]
+    gateway.generate(address, "user: question\n", SAMPLING, 10, prefixes[2])
+    assert [_primings(recorder, prefix) for prefix in prefixes] == [2, 1, 1]
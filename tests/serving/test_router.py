@@ -0,0 +1,53 @@
+import asyncio
+
+from aiohttp import ClientSession, web
+
+from source.serving.router import AffinityRouter, WorkerPool, affinity_worker
+
+
+def _worker_app(index: int) -> web.Application:
+    async def text_to_sql(request: web.Request) -> web.Response:
+        return web.json_response({"worker": index, **await request.json()})
+
+    app = web.Application()
+    app.router.add_post("/text_to_sql", text_to_sql)
+    return app
+
+
+def _start_router(serve_app, num_workers: int = 2) -> str:
+    # Workers listen on consecutive ports; find a free range by trial
+    for base_port in range(41000, 42000, num_workers):
+        try:
+            for index in range(num_workers):
+                serve_app(_worker_app(index), base_port + index)
+        except OSError:
+            continue
+        pool = WorkerPool([], num_workers, "127.0.0.1", base_port)
+        return serve_app(AffinityRouter(pool).app())
+    raise RuntimeError("No free ports for the workers")
+
+
+async def _post(url: str, data: str):
+    async with ClientSession() as session:
+        async with session.post(
+            url, data=data, headers={"Content-Type": "application/json"}
+        ) as response:
+            return response.status, await response.json()
+
+
+def test_text_to_sql_routes_by_db_id(serve_app):
+    url = _start_router(serve_app)
+    for db_id in ["concert_singer", "pets_1", "world_1"]:
+        status, body = asyncio.run(
+            _post(url + "/text_to_sql", f'{{"db_id": "{db_id}"}}')
+        )
+        assert status == 200
+        assert body == {"worker": affinity_worker(db_id, 2), "db_id": db_id}
+
+
+def test_text_to_sql_rejects_bodies_other_than_objects(serve_app):
+    url = _start_router(serve_app)
+    for data in ["[1, 2]", '"concert_singer"', "null", "not json"]:
+        status, body = asyncio.run(_post(url + "/text_to_sql", data))
+        assert status == 400
+        assert "error" in body
@@ -0,0 +1,39 @@
+import math
+
+import numpy as np
+
+from source.text2intent.tune_classifier import TuneClassifier, sigmoid
+
+
+def test_sigmoid_extreme_logits():
+    assert sigmoid(0) == 0.5
+    assert sigmoid(-1e4) == 0.0
+    assert sigmoid(1e4) == 1.0
+    assert math.isclose(sigmoid(-3), 1 - sigmoid(3))
+
+
+def test_probability_extreme_logit():
+    classifier = TuneClassifier(
+        {"w:vacuum": 0, "w:slow": 1},
+        idf=np.ones(2),
+        weights=np.array([-1e4, 1e4]),
+        bias=0.0,
+    )
+    assert classifier.probability("vacuum") == 0.0
+    assert classifier.decide("vacuum") is False
+    assert classifier.probability("slow") == 1.0
+    assert classifier.decide("slow") is True
+
+
+def test_fit_decides_training_texts():
+    texts = [
+        "please tune the database",
+        "the queries are slow, optimize the knobs",
+        "improve the performance of postgres",
+        "how many singers are there",
+        "list the names of all students",
+        "show the oldest employee",
+    ]
+    labels = [True, True, True, False, False, False]
+    classifier = TuneClassifier.fit(texts, labels, low=0.4, high=0.6)
+    assert [classifier.decide(text) for text in texts] == labels
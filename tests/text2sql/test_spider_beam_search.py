@@ -0,0 +1,254 @@
+import collections
+import operator
+import random
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+asdl = pytest.importorskip("asdl")
+
+from source.text2sql.ratsql import ast_util
+from source.text2sql.ratsql.models.nl2code.decoder import NL2CodeDecoder
+from source.text2sql.ratsql.models.nl2code.tree_traversal import TreeTraversal
+from source.text2sql.ratsql.models.spider import spider_beam_search
+from source.text2sql.ratsql.utils import serialization, vocab
+
+GRAMMAR = """
+module Tiny
+{
+    sql = (agg* select, from from, cond? where)
+    from = (table_unit* table_units)
+    table_unit = Table(table table_id)
+    agg = Column(column col_id)
+        | Value(string s)
+    cond = Eq(agg left, agg right)
+         | In(agg left, sql right)
+}
+"""
+
+
+def _sql(select, tables, where=None):
+    tree = {
+        "_type": "sql",
+        "select": select,
+        "from": {
+            "_type": "from",
+            "table_units": [{"_type": "Table", "table_id": t} for t in tables],
+        },
+    }
+    if where is not None:
+        tree["where"] = where
+    return tree
+
+
+def _column(col_id):
+    return {"_type": "Column", "col_id": col_id}
+
+
+EXAMPLES = [
+    _sql([_column(0)], [0]),
+    _sql(
+        [_column(1), {"_type": "Value", "s": "x"}],
+        [0, 1],
+        {"_type": "In", "left": _column(2), "right": _sql([_column(3)], [1])},
+    ),
+    _sql(
+        [_column(2)],
+        [1],
+        {"_type": "Eq", "left": _column(2), "right": {"_type": "Value", "s": "y"}},
+    ),
+]
+
+
+def _preproc(grammar_path):
+    ast_wrapper = ast_util.ASTWrapper(
+        asdl.parse(str(grammar_path)),
+        custom_primitive_type_checkers={
+            "table": lambda x: isinstance(x, int),
+            "column": lambda x: isinstance(x, int),
+        },
+    )
+    preproc = types.SimpleNamespace(
+        grammar=types.SimpleNamespace(root_type="sql", pointers={"column", "table"}),
+        ast_wrapper=ast_wrapper,
+        use_seq_elem_rules=False,
+        vocab=vocab.Vocab(["x", "y", "z"]),
+        sum_type_constructors=collections.defaultdict(set),
+        field_presence_infos=collections.defaultdict(set),
+        seq_lengths=collections.defaultdict(set),
+        primitive_types=set(),
+    )
+    for tree in EXAMPLES:
+        NL2CodeDecoder.Preproc._record_productions(preproc, tree)
+    preproc.sum_type_constructors = serialization.to_dict_with_sorted_values(
+        preproc.sum_type_constructors
+    )
+    preproc.field_presence_infos = serialization.to_dict_with_sorted_values(
+        preproc.field_presence_infos, key=str
+    )
+    preproc.seq_lengths = serialization.to_dict_with_sorted_values(preproc.seq_lengths)
+    preproc.primitive_types = sorted(preproc.primitive_types)
+    preproc.all_rules, preproc.rules_mask = NL2CodeDecoder.Preproc._calculate_rules(
+        preproc
+    )
+    return preproc
+
+
+class _Model:
+    """What beam search needs of a text-to-SQL model."""
+
+    def __init__(self, decoder, desc_enc):
+        self.decoder = decoder
+        self.desc_enc = desc_enc
+
+    def begin_inference(self, orig_item, preproc_item, enc_state=None):
+        return self.decoder.begin_inference(self.desc_enc, orig_item)
+
+
+@pytest.fixture(scope="module", params=[0, 1, 2])
+def model(request, tmp_path_factory):
+    grammar_path = tmp_path_factory.mktemp("grammar") / "Tiny.asdl"
+    grammar_path.write_text(GRAMMAR)
+    preproc = _preproc(grammar_path)
+
+    torch.manual_seed(request.param)
+    decoder = NL2CodeDecoder(
+        "cpu",
+        preproc,
+        rule_emb_size=8,
+        node_embed_size=4,
+        enc_recurrent_size=8,
+        recurrent_size=8,
+        desc_attn="mha-1h",
+        use_align_mat=True,
+    )
+    words = ["show", "x", "where", "y", "in", "z"]
+    desc_enc = types.SimpleNamespace(
+        memory=torch.randn(1, len(words), 8),
+        words=words,
+        pointer_memories={
+            "column": torch.randn(1, 4, 8),
+            "table": torch.randn(1, 2, 8),
+        },
+        pointer_maps={},
+        m2c_align_mat=torch.softmax(torch.randn(len(words), 4), dim=1),
+        m2t_align_mat=torch.softmax(torch.randn(len(words), 2), dim=1),
+    )
+    decoder.eval()
+    # Mostly end strings after a token or two, so that searches finish
+    with torch.no_grad():
+        decoder.gen_logodds.bias.fill_(4.0)
+        decoder.terminal_logits[-1].bias[decoder.terminal_vocab.index(vocab.EOS)] = 2.0
+
+    tables = [types.SimpleNamespace(id=0), types.SimpleNamespace(id=1)]
+    orig_item = types.SimpleNamespace(
+        text=words,
+        schema=types.SimpleNamespace(
+            columns=[
+                types.SimpleNamespace(table=table)
+                for table in [None, tables[0], tables[0], tables[1]]
+            ]
+        ),
+    )
+    return _Model(decoder, desc_enc), orig_item
+
+
+def _step_one_at_a_time(traversals, last_choices):
+    return [
+        traversal.step(last_choice)
+        for traversal, last_choice in zip(traversals, last_choices)
+    ]
+
+
+def _top_candidates_by_list_sort(hyps, size):
+    candidates = [
+        (hyp, choice, choice_score.item(), hyp.score + choice_score.item())
+        for hyp in hyps
+        for choice, choice_score in hyp.next_choices
+    ]
+    candidates.sort(key=operator.itemgetter(3), reverse=True)
+    return candidates[:size]
+
+
+def _assert_same_choices(batched, reference):
+    if reference is None:
+        assert batched is None
+        return
+    assert [choice for choice, _ in batched] == [choice for choice, _ in reference]
+    assert torch.allclose(
+        torch.stack([score for _, score in batched]),
+        torch.stack([score for _, score in reference]),
+        atol=1e-6,
+    )
+
+
+def test_step_batch_matches_stepping_one_at_a_time(model, monkeypatch):
+    model, orig_item = model
+    rng = random.Random(0)
+    calls = collections.Counter()
+    step_batch = model.decoder.step_batch
+
+    def counting_step_batch(decoder_calls, desc_enc):
+        calls.update(method for method, *_ in decoder_calls)
+        return step_batch(decoder_calls, desc_enc)
+
+    monkeypatch.setattr(model.decoder, "step_batch", counting_step_batch)
+
+    # Walks of random choices, each stepped at its own depth
+    live = [model.begin_inference(orig_item, None) for _ in range(12)]
+    finished = ragged = 0
+    for _ in range(200):
+        if not live:
+            break
+        last_choices = [rng.choice(choices)[0] for _, choices in live]
+        reference = [traversal.clone() for traversal, _ in live]
+        reference_choices = _step_one_at_a_time(reference, last_choices)
+        batched = [traversal.clone() for traversal, _ in live]
+        batched_choices = TreeTraversal.step_batch(batched, last_choices)
+
+        ragged += len({len(traversal.actions) for traversal, _ in live}) > 1
+        next_live = []
+        for traversal, expected, choices, expected_choices in zip(
+            batched, reference, batched_choices, reference_choices
+        ):
+            _assert_same_choices(choices, expected_choices)
+            assert traversal.actions == expected.actions
+            assert torch.allclose(
+                traversal.recurrent_state[0], expected.recurrent_state[0], atol=1e-6
+            )
+            if choices is None:
+                finished += 1
+            else:
+                next_live.append((traversal, choices))
+        live = next_live
+
+    assert finished
+    assert ragged
+    assert calls["compute_pointer_with_align"]
+    assert calls["gen_token"]
+    assert calls["apply_rule"]
+
+
+def test_beam_search_matches_stepping_one_at_a_time(model, monkeypatch):
+    model, orig_item = model
+
+    def search():
+        beams = spider_beam_search.beam_search_with_heuristics(
+            model, orig_item, None, beam_size=4, max_steps=100
+        )
+        return [(beam.choice_history, beam.score) for beam in beams]
+
+    batched = search()
+    monkeypatch.setattr(TreeTraversal, "step_batch", staticmethod(_step_one_at_a_time))
+    monkeypatch.setattr(
+        spider_beam_search, "top_candidates", _top_candidates_by_list_sort
+    )
+    reference = search()
+
+    # Finished beams of different lengths
+    assert len({len(history) for history, _ in batched}) > 1
+    assert [history for history, _ in batched] == [history for history, _ in reference]
+    assert [score for _, score in batched] == pytest.approx(
+        [score for _, score in reference]
+    )
@@ -15,6 +15,23 @@ async function getModelResult(dbName: string, question: string, resetHistory: bo
     }).then((res) => res.json());
 }
 
+// The analysis runs as a background job on the model server; wait for it so
+// the chat window still receives analyse_result with the translation.
+async function getAnalysisResult(jobId: string): Promise<any> {
+    const addr = MODEL_API_ADDR + "/analysis/" + jobId + "?wait=30"
+    for (let attempt = 0; attempt < 4; attempt++) {
+        const res = await fetch(addr);
+        if (res.status == 200) {
+            return (await res.json()).analyse_result;
+        }
+        else if (res.status != 202) {
+            console.log(`analysis job ${jobId} status: ${res.status}`);
+            return undefined;
+        }
+    }
+    return undefined;
+}
+
 export async function GET(request: Request) {
     const { searchParams } = new URL(request.url);
     const dbName = searchParams.get("dbName") ?? "";
@@ -34,6 +51,9 @@ export async function GET(request: Request) {
     console.log(`dbdbdbdbdb: ${dbName}, question: ${question}, resetHistory: ${resetHistory}`)
 
     // Handle query
-    const data = await getModelResult(dbName, question, resetHistory=="true");
+    const data: any = await getModelResult(dbName, question, resetHistory=="true");
+    if (data.analysis_job && !data.analyse_result) {
+        data.analyse_result = await getAnalysisResult(data.analysis_job);
+    }
     return new Response(JSON.stringify(data), { ...responseHeaderJson, ...responseStatusValid });
 }
\ No newline at end of file
@@ -8,6 +8,7 @@ export type translationResult = {
     pred_sql: string;
     confidence: number;
     user_intent: string;
+    analysis_job?: string;
     analyse_result: {
         raw_input: string;
         word_attributions: number;